@@ -0,0 +1,234 @@
+"""Spending totals per link, per month and per category, computed over whole columns with Arrow instead of row by row.
+
+The columns are copied out of postgres with `COPY ... TO STDOUT` as CSV, which skips building a Python object per value,
+and parsed by Arrow's multithreaded CSV reader straight into columnar buffers a block at a time. Each block is
+aggregated with Arrow's vectorized group by and only the partial sums are kept, so memory use depends on the number of
+groups rather than the number of transactions.
+
+Amounts are summed as integer cents so the totals are exact. Transactions cached before amounts were stored (migration
+5) have none and are left out, sync those links again from an empty cursor to fill them in.
+"""
+
+import dataclasses
+import os
+import threading
+from datetime import datetime
+from typing import IO, Any, Callable
+
+import db
+import sqlalchemy
+
+# Each is a group by over these keys, `currency` is always included as amounts in different currencies can't be added.
+GROUPINGS = {
+    "link": ("link_id", "currency"),
+    "month": ("month", "currency"),
+    "category": ("category", "currency"),
+}
+UNCATEGORIZED = "uncategorized"
+
+
+@dataclasses.dataclass
+class Analysis:
+    # An Arrow table per grouping, with its keys and `transactions`, `spent_cents` and `received_cents` columns.
+    totals: dict[str, Any]
+    rows: int
+
+
+def select_columns(
+    link_id: str | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    pending: bool | None = None,
+) -> sqlalchemy.Select:
+    """The columns `analyze` reads, optionally filtered like `export`. Not ordered, the aggregates don't need it."""
+    stmt = sqlalchemy.select(
+        db.Transaction.link_id,
+        sqlalchemy.cast(db.Transaction.timestamp, sqlalchemy.Date).label("date"),
+        sqlalchemy.cast(db.Transaction.amount * 100, sqlalchemy.BigInteger).label(
+            "cents"
+        ),
+        db.Transaction.type,
+        db.Transaction.currency,
+        db.Transaction.category,
+    ).where(db.Transaction.amount.is_not(None))
+    if link_id is not None:
+        stmt = stmt.join(db.Link, db.Transaction.link_id == db.Link.id).where(
+            db.Link.moneykit_id == link_id
+        )
+    if since is not None:
+        stmt = stmt.where(db.Transaction.timestamp >= since)
+    if until is not None:
+        stmt = stmt.where(db.Transaction.timestamp < until)
+    if pending is not None:
+        stmt = stmt.where(db.Transaction.pending == pending)
+    return stmt
+
+
+def analyze(
+    engine: sqlalchemy.Engine, stmt: sqlalchemy.Select, block_size: int = 1 << 24
+) -> Analysis:
+    """Run `stmt`, which must select the columns of `select_columns`, and total them up per grouping."""
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        compiled = stmt.compile(engine)
+        query = cursor.mogrify(str(compiled), compiled.params).decode()
+        copy = f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)"
+        with _piped(lambda out: cursor.copy_expert(copy, out)) as csv_file:
+            analysis = aggregate_csv(csv_file, block_size)
+    finally:
+        connection.close()
+
+    analysis.totals["link"] = _with_moneykit_ids(engine, analysis.totals["link"])
+    return analysis
+
+
+def aggregate_csv(csv_file: IO[bytes], block_size: int = 1 << 24) -> Analysis:
+    """Total up CSV with a header and the columns of `select_columns`, reading `block_size` bytes at a time."""
+    pa, pc, csv = _import_pyarrow()
+    reader = csv.open_csv(
+        csv_file,
+        read_options=csv.ReadOptions(block_size=block_size),
+        convert_options=csv.ConvertOptions(
+            # COPY writes NULL unquoted and an empty string as `""`.
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=False,
+            column_types={
+                "link_id": pa.int32(),
+                "date": pa.date32(),
+                "cents": pa.int64(),
+                "type": pa.dictionary(pa.int32(), pa.string()),
+                "currency": pa.dictionary(pa.int32(), pa.string()),
+                "category": pa.string(),
+            },
+        ),
+    )
+
+    partials: dict[str, list] = {name: [] for name in GROUPINGS}
+    rows = 0
+    for batch in reader:
+        rows += batch.num_rows
+        table = _measures(pa, pc, batch)
+        for name, keys in GROUPINGS.items():
+            partials[name].append(_sum_by(table, keys))
+
+    totals = {}
+    for name, keys in GROUPINGS.items():
+        if partials[name]:
+            combined = pa.concat_tables(partials[name])
+        else:
+            combined = _measures(pa, pc, reader.schema.empty_table())
+        totals[name] = _sum_by(combined, keys)
+    totals["month"] = _with_month_labels(pa, totals["month"])
+    return Analysis(totals=totals, rows=rows)
+
+
+def _measures(pa: Any, pc: Any, batch: Any) -> Any:
+    """The grouping keys and, per transaction, the cents spent or received."""
+    cents = batch.column("cents")
+    is_credit = pc.equal(pc.cast(batch.column("type"), pa.string()), "credit")
+    date = batch.column("date")
+    return pa.table(
+        {
+            "link_id": batch.column("link_id"),
+            "month": pc.add(pc.multiply(pc.year(date), 100), pc.month(date)),
+            "category": pc.fill_null(batch.column("category"), UNCATEGORIZED),
+            "currency": pc.cast(batch.column("currency"), pa.string()),
+            "transactions": pc.cast(pc.is_valid(cents), pa.int64()),
+            "spent_cents": pc.if_else(is_credit, 0, cents),
+            "received_cents": pc.if_else(is_credit, cents, 0),
+        }
+    )
+
+
+def _with_month_labels(pa: Any, totals: Any) -> Any:
+    """Replace the `YYYYMM` month numbers with `YYYY-MM`, once per month rather than per transaction."""
+    labels = [
+        f"{month // 100}-{month % 100:02d}" for month in totals["month"].to_pylist()
+    ]
+    return totals.set_column(
+        totals.column_names.index("month"), "month", pa.array(labels, pa.string())
+    )
+
+
+def _sum_by(table: Any, keys: tuple[str, ...]) -> Any:
+    aggregated = table.group_by(list(keys)).aggregate(
+        [
+            ("transactions", "sum"),
+            ("spent_cents", "sum"),
+            ("received_cents", "sum"),
+        ]
+    )
+    return aggregated.rename_columns(
+        [name.removesuffix("_sum") for name in aggregated.column_names]
+    )
+
+
+def _with_moneykit_ids(engine: sqlalchemy.Engine, totals: Any) -> Any:
+    """Replace the database's link ids with MoneyKit's, with one query for just the links in `totals`."""
+    pa, pc, _ = _import_pyarrow()
+    link_ids = totals.column("link_id").to_pylist()
+    with engine.connect() as connection:
+        rows = connection.execute(
+            sqlalchemy.select(db.Link.id, db.Link.moneykit_id).where(
+                db.Link.id.in_(set(link_ids))
+            )
+        ).all()
+    moneykit_ids = dict(rows)
+    return totals.set_column(
+        totals.column_names.index("link_id"),
+        "link_id",
+        pa.array([moneykit_ids.get(link_id, str(link_id)) for link_id in link_ids]),
+    )
+
+
+class _piped:
+    """Run `write` on a thread with the write end of a pipe, and hand the read end to the `with` block.
+
+    This streams `COPY ... TO STDOUT`, which psycopg2 only writes to a file object, into Arrow's reader without
+    buffering the whole output.
+    """
+
+    def __init__(self, write: Callable[[IO[bytes]], Any]) -> None:
+        self._write = write
+        self._error: BaseException | None = None
+
+    def __enter__(self) -> IO[bytes]:
+        read_fd, write_fd = os.pipe()
+        self._reader = os.fdopen(read_fd, "rb")
+        self._thread = threading.Thread(
+            target=self._run, args=(os.fdopen(write_fd, "wb"),), daemon=True
+        )
+        self._thread.start()
+        return self._reader
+
+    def _run(self, out: IO[bytes]) -> None:
+        try:
+            with out:
+                self._write(out)
+        except BaseException as err:
+            self._error = err
+
+    def __exit__(self, *exc_info: Any) -> None:
+        # Closing the read end first makes a writer that is still going fail instead of blocking on a full pipe.
+        self._reader.close()
+        self._thread.join()
+        if self._error is None:
+            return
+        # Only a result of closing the read end above, the `with` block's own error is the one to report.
+        if exc_info[0] is not None and isinstance(self._error, BrokenPipeError):
+            return
+        # Otherwise the writer failing, e.g. COPY being cancelled, is why the block's reader failed too.
+        raise self._error from exc_info[1]
+
+
+def _import_pyarrow() -> tuple[Any, Any, Any]:
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.csv
+    except ImportError:
+        raise RuntimeError(
+            "analyze needs pyarrow, install it with `uv sync --extra analyze`"
+        )
+    return pyarrow, pyarrow.compute, pyarrow.csv
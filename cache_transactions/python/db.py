@@ -1,6 +1,7 @@
-from datetime import datetime
+from datetime import date, datetime
+from decimal import Decimal
 
-from sqlalchemy import ForeignKey, create_engine
+from sqlalchemy import ForeignKey, Index, Numeric, UniqueConstraint, create_engine
 from sqlalchemy.orm import (
     DeclarativeBase,
     Mapped,
@@ -16,34 +17,109 @@ class Base(DeclarativeBase):
 
 
 class Link(Base):
+    """A link, its state as last reported by webhook (see `link_state.py`) and when its transactions were last synced."""
+
     __tablename__ = "links"
+    __table_args__ = (
+        Index("ix_links_state", "state"),
+        Index("ix_links_last_synced_at", "last_synced_at"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     moneykit_id: Mapped[str] = mapped_column(unique=True)
     transaction_sync_cursor: Mapped[str | None]
 
+    state: Mapped[str | None]
+    error_code: Mapped[str | None]
+    state_changed_at: Mapped[datetime | None]
+    last_synced_at: Mapped[datetime | None]
+
+    products: Mapped[list["LinkProduct"]] = relationship(back_populates="link")
+
     def __repr__(self) -> str:
         return (
             f'Link(id={self.id}, moneykit_id="{self.moneykit_id}", '
-            f'transaction_sync_cursor="{self.transaction_sync_cursor}")'
+            f'transaction_sync_cursor="{self.transaction_sync_cursor}", state="{self.state}", '
+            f'error_code="{self.error_code}", last_synced_at={self.last_synced_at})'
+        )
+
+
+class LinkProduct(Base):
+    __tablename__ = "link_products"
+
+    link_id: Mapped[int] = mapped_column(ForeignKey("links.id"), primary_key=True)
+    product: Mapped[str] = mapped_column(primary_key=True)
+    state: Mapped[str]
+    state_changed_at: Mapped[datetime]
+    # When the product last finished refreshing successfully.
+    refreshed_at: Mapped[datetime | None]
+    error_message: Mapped[str | None]
+
+    link: Mapped["Link"] = relationship(back_populates="products")
+
+    def __repr__(self) -> str:
+        return (
+            f'LinkProduct(link_id={self.link_id}, product="{self.product}", state="{self.state}", '
+            f"refreshed_at={self.refreshed_at})"
         )
 
 
 class Transaction(Base):
+    """A cached transaction.
+
+    The table is created and changed by `migrations.py`, which can also hash partition it by `link_id`.
+    """
+
     __tablename__ = "transactions"
+    __table_args__ = (
+        UniqueConstraint(
+            "link_id", "moneykit_id", name="transactions_link_id_moneykit_id_key"
+        ),
+        Index("ix_transactions_link_id_timestamp", "link_id", "timestamp"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     link_id: Mapped[int] = mapped_column(ForeignKey("links.id"))
 
-    moneykit_id: Mapped[str] = mapped_column(unique=True)
+    moneykit_id: Mapped[str]
     timestamp: Mapped[datetime]
     description: Mapped[str | None]
     pending: Mapped[bool]
+    # Null for transactions cached before these were stored.
+    account_id: Mapped[str | None]
+    amount: Mapped[Decimal | None] = mapped_column(Numeric(18, 2))
+    # `debit` or `credit`, `amount` itself is never negative.
+    type: Mapped[str | None]
+    currency: Mapped[str | None]
+    category: Mapped[str | None]
 
     link: Mapped["Link"] = relationship()
 
     def __repr__(self) -> str:
         return (
             f'Transaction(id={self.id}, moneykit_id="{self.moneykit_id}", timestamp={self.timestamp}, '
-            f'description="{self.description}", pending={self.pending})'
+            f'description="{self.description}", pending={self.pending}, amount={self.amount} {self.currency}, '
+            f'type="{self.type}", category="{self.category}")'
+        )
+
+
+class TransactionDailyTotal(Base):
+    """The transactions of a link on one day, maintained by `totals.py` as transactions are synced."""
+
+    __tablename__ = "transaction_daily_totals"
+
+    link_id: Mapped[int] = mapped_column(ForeignKey("links.id"), primary_key=True)
+    day: Mapped[date] = mapped_column(primary_key=True)
+    pending: Mapped[bool] = mapped_column(primary_key=True)
+    # `''` for transactions cached before currencies were stored.
+    currency: Mapped[str] = mapped_column(primary_key=True)
+    transactions: Mapped[int]
+    spent: Mapped[Decimal] = mapped_column(Numeric(18, 2))
+    received: Mapped[Decimal] = mapped_column(Numeric(18, 2))
+
+    def __repr__(self) -> str:
+        return (
+            f"TransactionDailyTotal(link_id={self.link_id}, day={self.day}, pending={self.pending}, "
+            f'currency="{self.currency}", transactions={self.transactions}, spent={self.spent}, '
+            f"received={self.received})"
         )
@@ -0,0 +1,174 @@
+"""Stream cached transactions out of the database as CSV, JSON Lines or Parquet.
+
+Rows are read through a server-side cursor in batches of plain tuples (no ORM objects) and each batch is written
+before the next one is fetched, so memory use stays the same however many transactions are exported.
+
+SQLAlchemy is only imported to build the query, so the CLI can parse `ExportFormat` options without it.
+"""
+
+import csv
+import enum
+import io
+import json
+from datetime import datetime
+from decimal import Decimal
+from typing import IO, TYPE_CHECKING, Any, Iterator, Sequence
+
+if TYPE_CHECKING:
+    import sqlalchemy
+
+COLUMNS = (
+    "link_id",
+    "transaction_id",
+    "timestamp",
+    "description",
+    "pending",
+    "account_id",
+    "amount",
+    "type",
+    "currency",
+    "category",
+)
+
+
+class ExportFormat(str, enum.Enum):
+    csv = "csv"
+    jsonl = "jsonl"
+    parquet = "parquet"
+
+
+def select_transactions(
+    link_id: str | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    pending: bool | None = None,
+) -> "sqlalchemy.Select":
+    """Select the exported columns, optionally filtered to a link, a `[since, until)` time range and pending state."""
+    import db
+    import sqlalchemy
+
+    stmt = (
+        sqlalchemy.select(
+            db.Link.moneykit_id.label("link_id"),
+            db.Transaction.moneykit_id.label("transaction_id"),
+            db.Transaction.timestamp,
+            db.Transaction.description,
+            db.Transaction.pending,
+            db.Transaction.account_id,
+            db.Transaction.amount,
+            db.Transaction.type,
+            db.Transaction.currency,
+            db.Transaction.category,
+        )
+        .join(db.Link, db.Transaction.link_id == db.Link.id)
+        .order_by(db.Transaction.link_id, db.Transaction.timestamp)
+    )
+    if link_id is not None:
+        stmt = stmt.where(db.Link.moneykit_id == link_id)
+    if since is not None:
+        stmt = stmt.where(db.Transaction.timestamp >= since)
+    if until is not None:
+        stmt = stmt.where(db.Transaction.timestamp < until)
+    if pending is not None:
+        stmt = stmt.where(db.Transaction.pending == pending)
+    return stmt
+
+
+def stream_batches(
+    connection: "sqlalchemy.Connection", stmt: "sqlalchemy.Select", batch_size: int
+) -> Iterator[Sequence["sqlalchemy.Row"]]:
+    # `stream_results` uses a named (server-side) cursor with psycopg2, `yield_per` sets how many rows it fetches at a
+    # time.
+    result = connection.execution_options(
+        stream_results=True, yield_per=batch_size
+    ).execute(stmt)
+    yield from result.partitions()
+
+
+def check_dependencies(export_format: ExportFormat) -> None:
+    """Raise `RuntimeError` if writing `export_format` needs a package that isn't installed.
+
+    Call this before opening the output, so a missing package doesn't leave an empty file behind.
+    """
+    if export_format == ExportFormat.parquet:
+        _import_pyarrow()
+
+
+def write_export(
+    batches: Iterator[Sequence["sqlalchemy.Row"]],
+    export_format: ExportFormat,
+    out: IO[bytes],
+) -> int:
+    """Write every batch to `out`.
+
+    :returns: The number of rows written.
+    """
+    if export_format == ExportFormat.parquet:
+        return _write_parquet(batches, out)
+
+    rows = 0
+    text = io.TextIOWrapper(out, encoding="utf-8", newline="")
+    if export_format == ExportFormat.csv:
+        writer = csv.writer(text)
+        writer.writerow(COLUMNS)
+        for batch in batches:
+            writer.writerows(batch)
+            rows += len(batch)
+    else:
+        for batch in batches:
+            for row in batch:
+                text.write(json.dumps(dict(zip(COLUMNS, row)), default=_json_default))
+                text.write("\n")
+            rows += len(batch)
+    text.flush()
+    # Leave `out` open, it may be stdout.
+    text.detach()
+    return rows
+
+
+def _write_parquet(
+    batches: Iterator[Sequence["sqlalchemy.Row"]], out: IO[bytes]
+) -> int:
+    pyarrow = _import_pyarrow()
+    schema = pyarrow.schema(
+        [
+            ("link_id", pyarrow.string()),
+            ("transaction_id", pyarrow.string()),
+            ("timestamp", pyarrow.timestamp("us")),
+            ("description", pyarrow.string()),
+            ("pending", pyarrow.bool_()),
+            ("account_id", pyarrow.string()),
+            ("amount", pyarrow.decimal128(18, 2)),
+            ("type", pyarrow.string()),
+            ("currency", pyarrow.string()),
+            ("category", pyarrow.string()),
+        ]
+    )
+    rows = 0
+    # Every batch becomes a row group, only the file footer is held back until the end.
+    with pyarrow.parquet.ParquetWriter(out, schema) as writer:
+        for batch in batches:
+            columns = list(zip(*batch))
+            writer.write_batch(pyarrow.record_batch(columns, schema=schema))
+            rows += len(batch)
+    return rows
+
+
+def _import_pyarrow() -> Any:
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError(
+            "Parquet export needs pyarrow, install it with `uv sync --extra parquet`"
+        )
+    return pyarrow
+
+
+def _json_default(value: Any) -> str:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        # As a string, like MoneyKit sends amounts, so no precision is lost.
+        return str(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
@@ -0,0 +1,147 @@
+"""Keep each link's state, and the state of its products, in the database from MoneyKit's webhooks.
+
+`link.state_changed` and `link.product_refresh` webhooks already carry the new state, so it is written straight from the
+payload without calling `LinksApi.get_link`. Webhooks can arrive out of order or be delivered again, so a row is only
+overwritten by an event that is at least as recent as the one it holds.
+
+Questions about many links, like which are in error or haven't synced for a day, are then a single indexed query
+instead of a `get_link` call per link.
+
+Updating a link's own state locks its row, so it waits while `apply-diff` or `sync-all` holds the lock on that link.
+Timestamps are stored in UTC without a time zone, like the rest of the schema.
+"""
+
+import json
+from datetime import datetime, timedelta, timezone
+
+import db
+import moneykit
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+
+def apply_webhook(session: Session, body: bytes) -> bool:
+    """Update the link state from a verified webhook body.
+
+    :returns: False if the webhook isn't about the state of a link or its products.
+    """
+    event = json.loads(body).get("webhook_event")
+    if event == "link.state_changed":
+        webhook = moneykit.models.AppLinkStateChangedWebhook.from_json(body)
+        apply_link_state_changed(session, webhook)
+    elif event in ("link.product_refresh", "product.state_changed"):
+        webhook = moneykit.models.ProductStateChangedWebhook.from_json(body)
+        apply_product_state_changed(session, webhook)
+    else:
+        return False
+    session.commit()
+    return True
+
+
+def apply_link_state_changed(
+    session: Session, webhook: moneykit.models.AppLinkStateChangedWebhook
+) -> None:
+    changed_at = _utc(webhook.webhook_timestamp)
+    stmt = postgresql.insert(db.Link).values(
+        moneykit_id=webhook.link_id,
+        state=webhook.state.value,
+        error_code=webhook.error.value if webhook.error else None,
+        state_changed_at=changed_at,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[db.Link.moneykit_id],
+        set_={
+            "state": stmt.excluded.state,
+            "error_code": stmt.excluded.error_code,
+            "state_changed_at": stmt.excluded.state_changed_at,
+        },
+        where=sqlalchemy.or_(
+            db.Link.state_changed_at.is_(None),
+            db.Link.state_changed_at <= stmt.excluded.state_changed_at,
+        ),
+    )
+    session.execute(stmt)
+
+
+def apply_product_state_changed(
+    session: Session, webhook: moneykit.models.ProductStateChangedWebhook
+) -> None:
+    changed_at = _utc(webhook.state_changed_at)
+    completed = webhook.state == moneykit.models.LinkProductState.COMPLETED
+    stmt = postgresql.insert(db.LinkProduct).values(
+        link_id=_link_id(session, webhook.link_id),
+        product=webhook.product.value,
+        state=webhook.state.value,
+        state_changed_at=changed_at,
+        refreshed_at=changed_at if completed else None,
+        error_message=webhook.error_message,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[db.LinkProduct.link_id, db.LinkProduct.product],
+        set_={
+            "state": stmt.excluded.state,
+            "state_changed_at": stmt.excluded.state_changed_at,
+            # Only a completed refresh moves it, a refresh in progress or failed keeps the last good one.
+            "refreshed_at": sqlalchemy.func.coalesce(
+                stmt.excluded.refreshed_at, db.LinkProduct.refreshed_at
+            ),
+            "error_message": stmt.excluded.error_message,
+        },
+        where=db.LinkProduct.state_changed_at <= stmt.excluded.state_changed_at,
+    )
+    session.execute(stmt)
+
+
+def links_in_state(session: Session, state: str) -> list[db.Link]:
+    """Uses `ix_links_state`."""
+    stmt = (
+        sqlalchemy.select(db.Link)
+        .where(db.Link.state == state)
+        .order_by(db.Link.state_changed_at)
+    )
+    return list(session.scalars(stmt))
+
+
+def stale_links(session: Session, older_than: timedelta) -> list[db.Link]:
+    """Links whose transactions were last synced more than `older_than` ago, or never. Uses `ix_links_last_synced_at`.
+
+    Deleted links are left out, they will never sync again.
+    """
+    cutoff = utcnow() - older_than
+    stmt = (
+        sqlalchemy.select(db.Link)
+        .where(
+            sqlalchemy.or_(
+                db.Link.last_synced_at < cutoff, db.Link.last_synced_at.is_(None)
+            ),
+            db.Link.state.is_distinct_from(
+                moneykit.models.PublicLinkState.DELETED.value
+            ),
+        )
+        .order_by(db.Link.last_synced_at.nulls_first())
+    )
+    return list(session.scalars(stmt))
+
+
+def utcnow() -> datetime:
+    return _utc(datetime.now(timezone.utc))
+
+
+def _utc(value: datetime) -> datetime:
+    # Naive values are taken to already be UTC.
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _link_id(session: Session, moneykit_id: str) -> int:
+    # Look the link up first, an upsert would lock its row and wait for any sync of the link to finish.
+    select = sqlalchemy.select(db.Link.id).where(db.Link.moneykit_id == moneykit_id)
+    link_id = session.scalar(select)
+    if link_id is None:
+        insert = postgresql.insert(db.Link).values(moneykit_id=moneykit_id)
+        link_id = session.scalar(
+            insert.on_conflict_do_nothing().returning(db.Link.id)
+        ) or session.scalar(select)
+    return link_id
@@ -0,0 +1,284 @@
+"""Versioned schema migrations for the transaction cache.
+
+Each migration runs once, in order, and its version is recorded in `schema_migrations`. `migrate` applies every pending
+migration in a single transaction (postgres DDL is transactional) so a failed upgrade leaves the schema untouched.
+
+`db.py` describes the schema the latest migration produces, so the ORM and the database stay in step. Add a schema
+change as a new migration at the end of `MIGRATIONS`, never by editing one that may already have been applied.
+"""
+
+import dataclasses
+import logging
+
+import sqlalchemy
+
+logger = logging.getLogger("example.migrations")
+
+# Any constant works, it only has to be the same for every process running `migrate`.
+MIGRATION_LOCK_ID = 7_211_403
+
+
+@dataclasses.dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    statements: tuple[str, ...]
+
+
+MIGRATIONS = (
+    # `IF NOT EXISTS` so a database created by the old `create_all` is adopted as is.
+    Migration(
+        1,
+        "initial schema",
+        (
+            """
+            CREATE TABLE IF NOT EXISTS links (
+                id SERIAL NOT NULL,
+                moneykit_id VARCHAR NOT NULL,
+                transaction_sync_cursor VARCHAR,
+                PRIMARY KEY (id),
+                UNIQUE (moneykit_id)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS transactions (
+                id SERIAL NOT NULL,
+                link_id INTEGER NOT NULL,
+                moneykit_id VARCHAR NOT NULL,
+                timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                description VARCHAR,
+                pending BOOLEAN NOT NULL,
+                PRIMARY KEY (id),
+                FOREIGN KEY(link_id) REFERENCES links (id),
+                UNIQUE (moneykit_id)
+            )
+            """,
+        ),
+    ),
+    # `show`, `export --link-id` and date range queries filter on a link and order by time.
+    Migration(
+        2,
+        "index transactions by link and timestamp",
+        (
+            (
+                "CREATE INDEX IF NOT EXISTS ix_transactions_link_id_timestamp "
+                "ON transactions (link_id, timestamp)"
+            ),
+        ),
+    ),
+    # Sync always knows the link, so updates and deletes match on `(link_id, moneykit_id)` and only touch that link's
+    # rows. It is also the only shape of unique constraint a table partitioned by link can have.
+    Migration(
+        3,
+        "make transaction ids unique per link",
+        (
+            (
+                "ALTER TABLE transactions ADD CONSTRAINT transactions_link_id_moneykit_id_key "
+                "UNIQUE (link_id, moneykit_id)"
+            ),
+            "ALTER TABLE transactions DROP CONSTRAINT IF EXISTS transactions_moneykit_id_key",
+        ),
+    ),
+    # Written from webhooks by `link_state.py`, so questions about many links don't need a `get_link` call per link.
+    Migration(
+        4,
+        "store link and product states",
+        (
+            """
+            ALTER TABLE links
+                ADD COLUMN state VARCHAR,
+                ADD COLUMN error_code VARCHAR,
+                ADD COLUMN state_changed_at TIMESTAMP WITHOUT TIME ZONE,
+                ADD COLUMN last_synced_at TIMESTAMP WITHOUT TIME ZONE
+            """,
+            "CREATE INDEX ix_links_state ON links (state)",
+            "CREATE INDEX ix_links_last_synced_at ON links (last_synced_at)",
+            """
+            CREATE TABLE link_products (
+                link_id INTEGER NOT NULL,
+                product VARCHAR NOT NULL,
+                state VARCHAR NOT NULL,
+                state_changed_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                refreshed_at TIMESTAMP WITHOUT TIME ZONE,
+                error_message VARCHAR,
+                PRIMARY KEY (link_id, product),
+                FOREIGN KEY(link_id) REFERENCES links (id)
+            )
+            """,
+        ),
+    ),
+    # For `analyze`. Nullable as transactions cached before this have none, until their link is synced from scratch.
+    Migration(
+        5,
+        "store transaction amounts, accounts and categories",
+        (
+            """
+            ALTER TABLE transactions
+                ADD COLUMN account_id VARCHAR,
+                ADD COLUMN amount NUMERIC(18, 2),
+                ADD COLUMN type VARCHAR,
+                ADD COLUMN currency VARCHAR,
+                ADD COLUMN category VARCHAR
+            """,
+        ),
+    ),
+    # Kept up to date by every sync page, see `totals.py`, and filled in from the transactions already cached.
+    Migration(
+        6,
+        "keep daily transaction totals per link",
+        (
+            """
+            CREATE TABLE transaction_daily_totals (
+                link_id INTEGER NOT NULL,
+                day DATE NOT NULL,
+                pending BOOLEAN NOT NULL,
+                currency VARCHAR NOT NULL,
+                transactions INTEGER NOT NULL,
+                spent NUMERIC(18, 2) NOT NULL,
+                received NUMERIC(18, 2) NOT NULL,
+                PRIMARY KEY (link_id, day, pending, currency),
+                FOREIGN KEY(link_id) REFERENCES links (id)
+            )
+            """,
+            """
+            INSERT INTO transaction_daily_totals
+                (link_id, day, pending, currency, transactions, spent, received)
+            SELECT link_id, timestamp::date, pending, coalesce(currency, ''), count(*),
+                coalesce(sum(amount) FILTER (WHERE type IS DISTINCT FROM 'credit'), 0),
+                coalesce(sum(amount) FILTER (WHERE type = 'credit'), 0)
+            FROM transactions
+            GROUP BY 1, 2, 3, 4
+            """,
+        ),
+    ),
+)
+
+
+def migrate(engine: sqlalchemy.Engine) -> list[Migration]:
+    """Apply every migration newer than the database's current version.
+
+    :returns: The migrations that were applied.
+    """
+    with engine.begin() as connection:
+        # Two processes upgrading at once would otherwise both try to apply the same migration.
+        connection.execute(
+            sqlalchemy.text("SELECT pg_advisory_xact_lock(:id)"),
+            {"id": MIGRATION_LOCK_ID},
+        )
+        connection.execute(
+            sqlalchemy.text(
+                """
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER NOT NULL PRIMARY KEY,
+                    name VARCHAR NOT NULL,
+                    applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()
+                )
+                """
+            )
+        )
+        current = current_version(connection)
+        pending = [migration for migration in MIGRATIONS if migration.version > current]
+        for migration in pending:
+            logger.info(f"Applying migration {migration.version}: {migration.name}")
+            for statement in migration.statements:
+                connection.execute(sqlalchemy.text(statement))
+            connection.execute(
+                sqlalchemy.text(
+                    "INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"
+                ),
+                {"version": migration.version, "name": migration.name},
+            )
+    return pending
+
+
+def current_version(connection: sqlalchemy.Connection) -> int:
+    return connection.scalar(
+        sqlalchemy.text("SELECT coalesce(max(version), 0) FROM schema_migrations")
+    )
+
+
+def drop_all(engine: sqlalchemy.Engine) -> None:
+    """Drop every table, including the migration history."""
+    with engine.begin() as connection:
+        connection.execute(
+            sqlalchemy.text(
+                "DROP TABLE IF EXISTS transaction_daily_totals, transactions, link_products, links, "
+                "schema_migrations CASCADE"
+            )
+        )
+
+
+def is_partitioned(connection: sqlalchemy.Connection) -> bool:
+    return connection.scalar(
+        sqlalchemy.text(
+            "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('transactions')"
+        )
+    )
+
+
+def partition_transactions(engine: sqlalchemy.Engine, partitions: int) -> None:
+    """Rebuild `transactions` as a table hash partitioned by `link_id` into `partitions` partitions.
+
+    All of a link's transactions live in one partition, so the per-link queries and the sync statements only touch a
+    single, smaller, table and index. Existing rows are copied over and the old table dropped in one transaction, which
+    holds an exclusive lock on `transactions` while it runs.
+
+    Postgres requires the partition key in every unique constraint, hence the primary key becomes `(link_id, id)`. `id`
+    is still unique as it keeps drawing from the same sequence. Run `migrate` first, this expects the latest schema.
+    """
+    if partitions < 1:
+        raise ValueError("partitions must be at least 1")
+
+    with engine.begin() as connection:
+        connection.execute(
+            sqlalchemy.text("SELECT pg_advisory_xact_lock(:id)"),
+            {"id": MIGRATION_LOCK_ID},
+        )
+        if is_partitioned(connection):
+            raise RuntimeError("transactions is already partitioned")
+
+        statements = [
+            "LOCK TABLE transactions IN ACCESS EXCLUSIVE MODE",
+            """
+            CREATE TABLE transactions_partitioned (
+                id INTEGER NOT NULL DEFAULT nextval('transactions_id_seq'),
+                link_id INTEGER NOT NULL,
+                moneykit_id VARCHAR NOT NULL,
+                timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                description VARCHAR,
+                pending BOOLEAN NOT NULL,
+                account_id VARCHAR,
+                amount NUMERIC(18, 2),
+                type VARCHAR,
+                currency VARCHAR,
+                category VARCHAR
+            ) PARTITION BY HASH (link_id)
+            """,
+            *(
+                f"CREATE TABLE transactions_p{remainder} PARTITION OF transactions_partitioned "
+                f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})"
+                for remainder in range(partitions)
+            ),
+            # Copying before the indexes exist is much faster than maintaining them row by row.
+            (
+                "INSERT INTO transactions_partitioned SELECT id, link_id, moneykit_id, timestamp, description, pending, "
+                "account_id, amount, type, currency, category FROM transactions"
+            ),
+            # Keep the sequence alive when the old table, which owns it, is dropped.
+            "ALTER SEQUENCE transactions_id_seq OWNED BY transactions_partitioned.id",
+            "DROP TABLE transactions",
+            "ALTER TABLE transactions_partitioned RENAME TO transactions",
+            "ALTER TABLE transactions ADD CONSTRAINT transactions_pkey PRIMARY KEY (link_id, id)",
+            (
+                "ALTER TABLE transactions ADD CONSTRAINT transactions_link_id_fkey "
+                "FOREIGN KEY (link_id) REFERENCES links (id)"
+            ),
+            (
+                "ALTER TABLE transactions ADD CONSTRAINT transactions_link_id_moneykit_id_key "
+                "UNIQUE (link_id, moneykit_id)"
+            ),
+            "CREATE INDEX ix_transactions_link_id_timestamp ON transactions (link_id, timestamp)",
+            "ANALYZE transactions",
+        ]
+        for statement in statements:
+            connection.execute(sqlalchemy.text(statement))
@@ -0,0 +1,343 @@
+"""Functions that sync `/transactions/sync` diffs into the database.
+
+`apply_transactions_diff` issues one statement per transaction which is the simplest to follow.
+`bulk_apply_transactions_diff` turns a whole page into at most three set-based statements which is what you want once a
+link has a lot of history.
+"""
+
+import contextlib
+import dataclasses
+import functools
+import logging
+import queue
+import threading
+from decimal import Decimal
+from typing import Any, Callable, Iterator, TypeVar
+
+import db
+import link_state
+import moneykit
+import sqlalchemy
+import totals
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger("example.sync")
+
+ApplyTransactionsDiff = Callable[[Session, int, moneykit.models.TransactionSync], None]
+
+T = TypeVar("T")
+
+# Everything MoneyKit may change about a transaction, e.g. when it posts.
+UPDATED_COLUMNS = (
+    "timestamp",
+    "description",
+    "pending",
+    "account_id",
+    "amount",
+    "type",
+    "currency",
+    "category",
+)
+
+_DONE = object()
+
+
+def lock_link(session: Session, link_id: str, wait: bool = True) -> db.Link | None:
+    """Select a link `FOR UPDATE` so that only one worker at a time can advance its `transaction_sync_cursor`.
+
+    The row lock is held until the session's transaction ends. With `wait=False` a link that is already locked by
+    another worker (or another process) is skipped and `None` is returned.
+    """
+    stmt = (
+        sqlalchemy.select(db.Link)
+        .where(db.Link.moneykit_id == link_id)
+        .with_for_update(skip_locked=not wait)
+    )
+    return session.scalar(stmt)
+
+
+@dataclasses.dataclass(frozen=True)
+class SyncOptions:
+    # Apply pages with `bulk_apply_transactions_diff` rather than `apply_transactions_diff`.
+    bulk: bool = True
+    # How many pages a background thread may fetch ahead of the database writes, 0 fetches inline.
+    prefetch: int = 0
+    # Commit the applied pages together with the intermediate cursor every N pages and/or M rows, 0 disables.
+    checkpoint_pages: int = 0
+    checkpoint_rows: int = 0
+    # Update `transaction_daily_totals` along with each page, see `totals.py`.
+    maintain_totals: bool = True
+
+    @property
+    def apply_transactions_diff(self) -> ApplyTransactionsDiff:
+        apply = bulk_apply_transactions_diff if self.bulk else apply_transactions_diff
+        if self.maintain_totals:
+            return functools.partial(totals.apply_with_totals, apply)
+        return apply
+
+    def should_checkpoint(self, pages: int, rows: int) -> bool:
+        return (self.checkpoint_pages > 0 and pages >= self.checkpoint_pages) or (
+            self.checkpoint_rows > 0 and rows >= self.checkpoint_rows
+        )
+
+
+class SyncCursorConflictError(Exception):
+    pass
+
+
+def sync_link_transactions(
+    session: Session,
+    link: db.Link,
+    transactions_api: moneykit.TransactionsApi,
+    options: SyncOptions,
+) -> int:
+    """Consume `/transactions/sync` pages from the link's last cursor and apply them, then store the new cursor.
+
+    With `prefetch` > 0 pages are fetched by a background thread up to `prefetch` pages ahead of the database writes
+    so the next HTTP request overlaps with applying the current page. Pages are always applied in order.
+
+    By default everything is committed in one transaction once `has_more` is False. When checkpoints are enabled the
+    applied pages and the cursor that follows them are committed together every `checkpoint_pages` pages or
+    `checkpoint_rows` rows. A crash then only loses the work since the last checkpoint and the next sync resumes from
+    the checkpointed cursor.
+
+    :returns: The number of created, updated and removed transactions applied.
+    """
+    cursor = link.transaction_sync_cursor
+    pages = _fetch_sync_pages(transactions_api, link.moneykit_id, cursor)
+    if options.prefetch > 0:
+        pages = _prefetched(pages, options.prefetch)
+
+    changes = 0
+    pending_pages = pending_rows = 0
+    # Closing the pages makes sure a prefetch thread is stopped straight away if applying a page fails.
+    with contextlib.closing(pages):
+        for response in pages:
+            diff = response.transactions
+            rows = len(diff.created) + len(diff.updated) + len(diff.removed)
+            logger.debug(
+                f"{link.moneykit_id}: {len(diff.created)} created, "
+                f"{len(diff.updated)} updated, {len(diff.removed)} removed"
+            )
+            try:
+                options.apply_transactions_diff(session, link.id, diff)
+            except Exception:
+                logger.error(
+                    f"{link.moneykit_id}: failed to apply the page at cursor {cursor!r}, "
+                    "it can be re-applied with `replay-page`"
+                )
+                raise
+            cursor = response.cursor.next
+            changes += rows
+            pending_pages += 1
+            pending_rows += rows
+
+            if response.has_more and options.should_checkpoint(
+                pending_pages, pending_rows
+            ):
+                _checkpoint(session, link, cursor)
+                pending_pages = pending_rows = 0
+
+    # Only reached once the final page (`has_more` is False) has been applied.
+    link.transaction_sync_cursor = cursor
+    link.last_synced_at = link_state.utcnow()
+    session.commit()
+    return changes
+
+
+def replay_sync_page(
+    session: Session,
+    link: db.Link,
+    transactions_api: moneykit.TransactionsApi,
+    cursor: str | None,
+) -> moneykit.models.TransactionSyncResponse:
+    """Fetch the single page that follows `cursor` and apply it again without moving the link's stored cursor.
+
+    This always uses `bulk_apply_transactions_diff` which upserts created transactions, so re-applying a page that was
+    already (partially) applied leaves the same end result, daily totals included.
+    """
+    response = transactions_api.get_transactions_sync(link.moneykit_id, cursor=cursor)
+    totals.apply_with_totals(
+        bulk_apply_transactions_diff, session, link.id, response.transactions
+    )
+    session.commit()
+    return response
+
+
+def _checkpoint(session: Session, link: db.Link, cursor: str | None) -> None:
+    link.transaction_sync_cursor = cursor
+    session.commit()
+    logger.info(f"{link.moneykit_id}: checkpointed at cursor {cursor!r}")
+
+    # Committing released the row lock taken by `lock_link`, take it again and make sure no other worker moved the
+    # cursor in between.
+    session.refresh(link, with_for_update=True)
+    if link.transaction_sync_cursor != cursor:
+        raise SyncCursorConflictError(
+            f"{link.moneykit_id} was synced by another worker after checkpoint {cursor!r}"
+        )
+
+
+def _fetch_sync_pages(
+    transactions_api: moneykit.TransactionsApi, link_id: str, cursor: str | None
+) -> Iterator[moneykit.models.TransactionSyncResponse]:
+    has_more = True
+    while has_more:
+        # We must consume until `has_more` is False
+        response = transactions_api.get_transactions_sync(link_id, cursor=cursor)
+        has_more = response.has_more
+        cursor = response.cursor.next
+        yield response
+
+
+def _prefetched(items: Iterator[T], depth: int) -> Iterator[T]:
+    """Iterate `items` on a background thread, buffering at most `depth` items ahead of the consumer.
+
+    An exception raised by `items` is re-raised to the consumer. If the consumer stops early (or raises) the
+    background thread is told to stop and joined.
+    """
+    buffer: queue.Queue[tuple[Any, BaseException | None]] = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=_produce, args=(items, buffer, stop), name="sync-prefetch", daemon=True
+    )
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _produce(items: Iterator[Any], buffer: queue.Queue, stop: threading.Event) -> None:
+    try:
+        for item in items:
+            if not _put(buffer, stop, (item, None)):
+                return
+    except BaseException as err:
+        _put(buffer, stop, (_DONE, err))
+    else:
+        _put(buffer, stop, (_DONE, None))
+
+
+def _put(buffer: queue.Queue, stop: threading.Event, entry: tuple) -> bool:
+    # Poll so that a consumer that has gone away can't leave the producer blocked on a full queue forever.
+    while not stop.is_set():
+        try:
+            buffer.put(entry, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def apply_transactions_diff(
+    session: Session, link_id: int, diff: moneykit.models.TransactionSync
+) -> None:
+    """Apply a diff one row at a time."""
+    for mk_txn in diff.created:
+        txn = db.Transaction(**_transaction_values(link_id, mk_txn))
+        session.add(txn)
+    for mk_txn in diff.updated:
+        stmt = (
+            sqlalchemy.update(db.Transaction)
+            .where(
+                db.Transaction.link_id == link_id,
+                db.Transaction.moneykit_id == mk_txn.transaction_id,
+            )
+            .values(
+                {
+                    name: value
+                    for name, value in _transaction_values(link_id, mk_txn).items()
+                    if name in UPDATED_COLUMNS
+                }
+            )
+        )
+        session.execute(stmt)
+    for mk_txn_id in diff.removed:
+        stmt = sqlalchemy.delete(db.Transaction).where(
+            db.Transaction.link_id == link_id, db.Transaction.moneykit_id == mk_txn_id
+        )
+        session.execute(stmt)
+
+
+def bulk_apply_transactions_diff(
+    session: Session, link_id: int, diff: moneykit.models.TransactionSync
+) -> None:
+    """Apply a diff using one statement each for created, updated and removed transactions.
+
+    - created: a multi-row `INSERT ... ON CONFLICT (link_id, moneykit_id) DO UPDATE` so a replayed page is harmless.
+    - updated: a single `UPDATE ... FROM (VALUES ...)` joined on `moneykit_id`.
+    - removed: a single `DELETE ... WHERE moneykit_id = ANY(:ids)`.
+
+    Every statement is also restricted to `link_id`, so it only has to search that link's rows (and partition).
+    """
+    # Postgres refuses to touch the same row twice in one `ON CONFLICT DO UPDATE`, the last value for an id wins.
+    created = {
+        mk_txn.transaction_id: _transaction_values(link_id, mk_txn)
+        for mk_txn in diff.created
+    }
+    if created:
+        stmt = postgresql.insert(db.Transaction).values(list(created.values()))
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[db.Transaction.link_id, db.Transaction.moneykit_id],
+            set_={name: stmt.excluded[name] for name in UPDATED_COLUMNS},
+        )
+        session.execute(stmt)
+
+    updated = {
+        mk_txn.transaction_id: _transaction_values(link_id, mk_txn)
+        for mk_txn in diff.updated
+    }
+    if updated:
+        columns = ("moneykit_id", *UPDATED_COLUMNS)
+        values = sqlalchemy.values(
+            *(
+                sqlalchemy.column(name, db.Transaction.__table__.c[name].type)
+                for name in columns
+            ),
+            name="updated",
+        ).data([tuple(v[name] for name in columns) for v in updated.values()])
+        stmt = (
+            sqlalchemy.update(db.Transaction)
+            .where(
+                db.Transaction.link_id == link_id,
+                db.Transaction.moneykit_id == values.c.moneykit_id,
+            )
+            .values({name: values.c[name] for name in UPDATED_COLUMNS})
+        )
+        session.execute(stmt)
+
+    if diff.removed:
+        removed_ids = sqlalchemy.bindparam(
+            "removed_ids", list(diff.removed), type_=postgresql.ARRAY(sqlalchemy.String)
+        )
+        stmt = sqlalchemy.delete(db.Transaction).where(
+            db.Transaction.link_id == link_id,
+            db.Transaction.moneykit_id == sqlalchemy.any_(removed_ids),
+        )
+        session.execute(stmt)
+
+
+def _transaction_values(
+    link_id: int, mk_txn: moneykit.models.TransactionResponse
+) -> dict[str, Any]:
+    return {
+        "link_id": link_id,
+        "moneykit_id": mk_txn.transaction_id,
+        "timestamp": mk_txn.datetime_ or mk_txn.date_,
+        "description": mk_txn.description,
+        "pending": mk_txn.pending,
+        "account_id": mk_txn.account_id,
+        "amount": Decimal(mk_txn.amount),
+        "type": mk_txn.type.value,
+        "currency": mk_txn.currency,
+        "category": mk_txn.category,
+    }
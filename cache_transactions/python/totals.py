@@ -0,0 +1,173 @@
+"""Daily totals per link, kept up to date by every sync page instead of being recomputed from `transactions`.
+
+`transaction_daily_totals` holds, per link, day, pending or posted and currency, the number of transactions and the
+amounts spent (debits) and received (credits). `apply_with_totals` wraps applying a page: before the page is applied the
+current rows of every transaction it touches are subtracted from their buckets, and afterwards the same transactions are
+added back with their new values. That is two set-based statements per page, run in the page's own database
+transaction, and it stays correct when a page is replayed, a transaction moves day when it posts, or is removed.
+
+Reading a link's totals then touches one row per day (or sums at most 31 of them per month) however many transactions
+the link has. `check` recomputes every bucket from `transactions` and reports the ones that differ, `rebuild` replaces
+them with the recomputed values.
+
+Transactions cached before amounts were stored (migration 5) are counted with an amount of 0 and currency `''`.
+"""
+
+from typing import Callable, Iterable, Sequence
+
+import db
+import moneykit
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+# The contribution of each bucket's transactions, `:sign` is -1 to take them out of the totals.
+_ADD_TRANSACTIONS = sqlalchemy.text(
+    """
+    INSERT INTO transaction_daily_totals AS totals
+        (link_id, day, pending, currency, transactions, spent, received)
+    SELECT link_id, timestamp::date, pending, coalesce(currency, ''),
+        :sign * count(*),
+        :sign * coalesce(sum(amount) FILTER (WHERE type IS DISTINCT FROM 'credit'), 0),
+        :sign * coalesce(sum(amount) FILTER (WHERE type = 'credit'), 0)
+    FROM transactions
+    WHERE link_id = :link_id AND moneykit_id = ANY(:moneykit_ids)
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT (link_id, day, pending, currency) DO UPDATE SET
+        transactions = totals.transactions + excluded.transactions,
+        spent = totals.spent + excluded.spent,
+        received = totals.received + excluded.received
+    """
+).bindparams(
+    sqlalchemy.bindparam("moneykit_ids", type_=postgresql.ARRAY(sqlalchemy.String))
+)
+
+# Every bucket computed from scratch, for the links in `:link_ids` or all links when it is null.
+_EXPECTED = """
+    SELECT link_id, timestamp::date AS day, pending, coalesce(currency, '') AS currency,
+        count(*) AS transactions,
+        coalesce(sum(amount) FILTER (WHERE type IS DISTINCT FROM 'credit'), 0) AS spent,
+        coalesce(sum(amount) FILTER (WHERE type = 'credit'), 0) AS received
+    FROM transactions
+    WHERE CAST(:link_ids AS INTEGER[]) IS NULL OR link_id = ANY(:link_ids)
+    GROUP BY 1, 2, 3, 4
+"""
+
+_CHECK = sqlalchemy.text(
+    f"""
+    WITH expected AS ({_EXPECTED}),
+    stored AS (
+        SELECT * FROM transaction_daily_totals
+        WHERE CAST(:link_ids AS INTEGER[]) IS NULL OR link_id = ANY(:link_ids)
+    )
+    SELECT coalesce(expected.link_id, stored.link_id) AS link_id,
+        coalesce(expected.day, stored.day) AS day,
+        coalesce(expected.pending, stored.pending) AS pending,
+        coalesce(expected.currency, stored.currency) AS currency,
+        expected.transactions AS expected_transactions, stored.transactions AS stored_transactions,
+        expected.spent AS expected_spent, stored.spent AS stored_spent,
+        expected.received AS expected_received, stored.received AS stored_received
+    FROM expected FULL OUTER JOIN stored USING (link_id, day, pending, currency)
+    WHERE (expected.transactions, expected.spent, expected.received)
+        IS DISTINCT FROM (stored.transactions, stored.spent, stored.received)
+    ORDER BY 1, 2, 3, 4
+    """
+).bindparams(
+    sqlalchemy.bindparam("link_ids", type_=postgresql.ARRAY(sqlalchemy.Integer))
+)
+
+
+def apply_with_totals(
+    apply_transactions_diff: Callable[
+        [Session, int, moneykit.models.TransactionSync], None
+    ],
+    session: Session,
+    link_id: int,
+    diff: moneykit.models.TransactionSync,
+) -> None:
+    """Apply `diff` with `apply_transactions_diff` and update the link's daily totals by what it changed."""
+    touched = list(
+        {
+            *(mk_txn.transaction_id for mk_txn in diff.created),
+            *(mk_txn.transaction_id for mk_txn in diff.updated),
+            *diff.removed,
+        }
+    )
+    if not touched:
+        return
+    params = {"link_id": link_id, "moneykit_ids": touched}
+    session.execute(_ADD_TRANSACTIONS, {**params, "sign": -1})
+    apply_transactions_diff(session, link_id, diff)
+    # The per row path only adds ORM objects, they have to be written before they can be counted.
+    session.flush()
+    session.execute(_ADD_TRANSACTIONS, {**params, "sign": 1})
+    session.execute(
+        sqlalchemy.delete(db.TransactionDailyTotal).where(
+            db.TransactionDailyTotal.link_id == link_id,
+            db.TransactionDailyTotal.transactions == 0,
+        )
+    )
+
+
+def daily(session: Session, link_id: int) -> list[db.TransactionDailyTotal]:
+    stmt = (
+        sqlalchemy.select(db.TransactionDailyTotal)
+        .where(db.TransactionDailyTotal.link_id == link_id)
+        .order_by(db.TransactionDailyTotal.day)
+    )
+    return list(session.scalars(stmt))
+
+
+def monthly(session: Session, link_id: int) -> Sequence[sqlalchemy.Row]:
+    """Summed from the daily buckets."""
+    daily_total = db.TransactionDailyTotal
+    month = sqlalchemy.cast(
+        sqlalchemy.func.date_trunc("month", daily_total.day), sqlalchemy.Date
+    ).label("month")
+    stmt = (
+        sqlalchemy.select(
+            month,
+            daily_total.pending,
+            daily_total.currency,
+            sqlalchemy.func.sum(daily_total.transactions).label("transactions"),
+            sqlalchemy.func.sum(daily_total.spent).label("spent"),
+            sqlalchemy.func.sum(daily_total.received).label("received"),
+        )
+        .where(daily_total.link_id == link_id)
+        .group_by(month, daily_total.pending, daily_total.currency)
+        .order_by(month, daily_total.pending, daily_total.currency)
+    )
+    return session.execute(stmt).all()
+
+
+def check(
+    connection: sqlalchemy.Connection, link_ids: Iterable[int] | None = None
+) -> Sequence[sqlalchemy.Row]:
+    """Recompute the buckets of `link_ids`, or of every link, from scratch.
+
+    :returns: The buckets whose stored totals differ, with the expected and stored values.
+    """
+    params = {"link_ids": list(link_ids) if link_ids is not None else None}
+    return connection.execute(_CHECK, params).all()
+
+
+def rebuild(
+    connection: sqlalchemy.Connection, link_ids: Iterable[int] | None = None
+) -> None:
+    """Replace the buckets of `link_ids`, or of every link, with ones recomputed from `transactions`."""
+    params = {"link_ids": list(link_ids) if link_ids is not None else None}
+    ids = sqlalchemy.bindparam("link_ids", type_=postgresql.ARRAY(sqlalchemy.Integer))
+    connection.execute(
+        sqlalchemy.text(
+            "DELETE FROM transaction_daily_totals "
+            "WHERE CAST(:link_ids AS INTEGER[]) IS NULL OR link_id = ANY(:link_ids)"
+        ).bindparams(ids),
+        params,
+    )
+    connection.execute(
+        sqlalchemy.text(
+            "INSERT INTO transaction_daily_totals "
+            f"(link_id, day, pending, currency, transactions, spent, received) {_EXPECTED}"
+        ).bindparams(ids),
+        params,
+    )
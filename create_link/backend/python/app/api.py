@@ -1,49 +1,20 @@
-import functools
 import logging
+import time
 from typing import Annotated
 
 import moneykit
 import moneykit.models
 import pydantic
-from fastapi import APIRouter, Body, status
+from fastapi import APIRouter, BackgroundTasks, Body, HTTPException, status
 
+from app.client import moneykit_client
+from app.link_data import LinkData, link_data_cache
 from app.settings import get_settings
 
 router = APIRouter()
 logger = logging.getLogger("example.api")
 
 
-@functools.lru_cache
-def moneykit_client() -> moneykit.ApiClient:
-    """Generates a Bearer token from your client id and secret to access MoneyKit.
-
-    This bearer token will expire. This method does not show regenerating the token on/before expiry for simplicity.
-
-    :returns: An authenticated client
-    """
-    settings = get_settings()
-
-    # Generate a bearer access token that is valid for 60 minutes.
-    # This client _should_ be cached to avoid regenerating a token on every request.
-    # The bearer token should be regenerated before expiry or after a `api_error.auth.expired_access_token` error code
-    # is returned by a request.
-
-    config = moneykit.Configuration(host=settings.moneykit_url)
-    api_client = moneykit.ApiClient(config)
-
-    logger.debug(f"Authenticating to {settings.moneykit_url} as {settings.moneykit_client_id}")
-    access_token_api = moneykit.AccessTokenApi(api_client)
-    response = access_token_api.create_access_token(
-        client_id=settings.moneykit_client_id,
-        client_secret=settings.moneykit_client_secret.get_secret_value(),
-        grant_type="client_credentials",
-    )
-
-    logger.debug(f"Token will expire in {response.expires_in} seconds")
-    api_client.configuration.access_token = response.access_token
-    return api_client
-
-
 class NewLinkSessionResponse(pydantic.BaseModel):
     link_session_token: str
 
@@ -101,19 +72,46 @@ def new_link_session() -> NewLinkSessionResponse:
 )
 def exchange_token_for_link(
     body: Annotated[ExchangeTokenForLinkRequest, Body()],
+    background_tasks: BackgroundTasks,
 ) -> ExchangeTokenForLinkResponse:
-    """Exchange the Connect SDK's response for a link_id."""
+    """Exchange the Connect SDK's response for a link_id.
+
+    The new link's accounts and transactions are then fetched in the background, after this responds, so the
+    frontend's first request for them is answered locally. See `app/link_data.py`.
+    """
     link_session_api = moneykit.LinkSessionApi(moneykit_client())
     response = link_session_api.exchange_token(
         moneykit.models.ExchangeTokenRequest(exchangeable_token=body.exchangeable_token),
     )
     logger.info(f"MoneyKit link id: {response.link_id}")
+    if get_settings().link_warm_up_enabled:
+        background_tasks.add_task(link_data_cache().warm_up, response.link_id, time.perf_counter())
     return ExchangeTokenForLinkResponse(
         moneykit_link_id=response.link_id,
         institution_name=response.link.institution_name,
     )
 
 
+@router.get(
+    "/links/{link_id}/accounts",
+    status_code=status.HTTP_200_OK,
+)
+def get_accounts(link_id: str) -> dict:
+    """The link's accounts, from the cache the token exchange warmed up."""
+    data = _get_link_data(link_id)
+    return {"accounts": data.accounts, "fetched_at": data.fetched_at}
+
+
+@router.get(
+    "/links/{link_id}/transactions",
+    status_code=status.HTTP_200_OK,
+)
+def get_transactions(link_id: str) -> dict:
+    """The link's transactions as of its initial sync, from the cache the token exchange warmed up."""
+    data = _get_link_data(link_id)
+    return {"transactions": list(data.transactions.values()), "cursor": data.cursor, "fetched_at": data.fetched_at}
+
+
 @router.delete(
     "/links/{link_id}",
     status_code=status.HTTP_204_NO_CONTENT,
@@ -122,4 +120,15 @@ def delete_link(link_id: str) -> None:
     """Delete a link."""
     links_api = moneykit.LinksApi(moneykit_client())
     links_api.delete_link(link_id)
+    link_data_cache().invalidate(link_id)
     logger.info(f"Deleted link id: {link_id}")
+
+
+def _get_link_data(link_id: str) -> LinkData:
+    try:
+        return link_data_cache().get(link_id)
+    except moneykit.ApiException as err:
+        # E.g. the link was deleted.
+        if err.status == status.HTTP_404_NOT_FOUND:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={"error": "Link not found"})
+        raise
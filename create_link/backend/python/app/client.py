@@ -0,0 +1,181 @@
+import dataclasses
+import functools
+import logging
+import threading
+import time
+from typing import Any
+
+import moneykit
+import moneykit.rest
+
+from app import metrics
+from app.ratelimit import RequestScheduler, classify
+from app.settings import get_settings
+
+logger = logging.getLogger("example.mk_client")
+
+# Fetch a new token this many seconds before the current one expires so a request never goes out with an expired one.
+REFRESH_MARGIN_SECONDS = 300
+EXPIRED_ACCESS_TOKEN_ERROR = b"api_error.auth.expired_access_token"
+
+
+@dataclasses.dataclass
+class AccessTokenMetrics:
+    fetches: int = 0
+    expired_token_retries: int = 0
+    last_fetch_seconds: float = 0.0
+    total_fetch_seconds: float = 0.0
+
+
+class AccessTokenManager:
+    """Hands out a MoneyKit bearer token, fetching a new one shortly before the current one expires.
+
+    Fetching is single flight: when the token needs refreshing one thread calls `/auth/token` and any other threads
+    wait for its result instead of each fetching their own.
+    """
+
+    def __init__(self, host: str, client_id: str, client_secret: str) -> None:
+        # Token requests get their own plain client so they don't go through `RefreshingApiClient` themselves.
+        config = moneykit.Configuration(host=host)
+        self._access_token_api = moneykit.AccessTokenApi(moneykit.ApiClient(config))
+        self._host = host
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._lock = threading.Lock()
+        self._access_token = ""
+        self._refresh_at = 0.0
+        self.metrics = AccessTokenMetrics()
+
+    def get_access_token(self) -> str:
+        if time.monotonic() >= self._refresh_at:
+            with self._lock:
+                # Another thread may have fetched a token while this one was waiting for the lock.
+                if time.monotonic() >= self._refresh_at:
+                    self._fetch_access_token()
+        return self._access_token
+
+    def invalidate(self, access_token: str) -> None:
+        """MoneyKit rejected `access_token` as expired, the request is retried with a new one.
+
+        Makes the next `get_access_token` fetch a new token, unless `access_token` has already been replaced.
+        """
+        with self._lock:
+            self.metrics.expired_token_retries += 1
+            if access_token == self._access_token:
+                self._refresh_at = 0.0
+
+    def _fetch_access_token(self) -> None:
+        logger.debug(f"Authenticating to {self._host} as {self._client_id}")
+        started = time.perf_counter()
+        response = self._access_token_api.create_access_token(
+            client_id=self._client_id,
+            client_secret=self._client_secret,
+            grant_type="client_credentials",
+        )
+        elapsed = time.perf_counter() - started
+
+        self.metrics.fetches += 1
+        self.metrics.last_fetch_seconds = elapsed
+        self.metrics.total_fetch_seconds += elapsed
+        logger.debug(
+            f"Token will expire in {response.expires_in}s, fetched in {elapsed * 1000:.0f}ms",
+        )
+
+        self._access_token = response.access_token
+        margin = min(REFRESH_MARGIN_SECONDS, response.expires_in // 2)
+        self._refresh_at = time.monotonic() + response.expires_in - margin
+
+
+class RefreshingApiClient(moneykit.ApiClient):
+    """An `ApiClient` that authenticates every request with the current token from an `AccessTokenManager`.
+
+    If MoneyKit still rejects a token as expired (e.g. the clock drifted or it was revoked) the request is retried once
+    with a newly fetched token.
+
+    Every request is also paced by a `RequestScheduler` and retried when MoneyKit responds `429 Too Many Requests`.
+    """
+
+    def __init__(
+        self,
+        configuration: moneykit.Configuration,
+        token_manager: AccessTokenManager,
+        scheduler: RequestScheduler | None = None,
+    ) -> None:
+        super().__init__(configuration)
+        self.token_manager = token_manager
+        self.scheduler = scheduler or RequestScheduler()
+        self._endpoint = threading.local()
+
+    def param_serialize(self, method: str, resource_path: str, *args: Any, **kwargs: Any) -> tuple:
+        self.configuration.access_token = self.token_manager.get_access_token()
+        # The SDK calls `call_api` next, on the same thread, by which point the path's parameters are filled in.
+        self._endpoint.name = f"{method} {resource_path}"
+        return super().param_serialize(method, resource_path, *args, **kwargs)
+
+    def call_api(
+        self,
+        method: str,
+        url: str,
+        header_params: dict | None = None,
+        body: Any = None,
+        post_params: Any = None,
+        _request_timeout: Any = None,
+    ) -> moneykit.rest.RESTResponse:
+        response = self._call_api_rate_limited(method, url, header_params, body, post_params, _request_timeout)
+        if response.status == 401 and header_params and EXPIRED_ACCESS_TOKEN_ERROR in (response.read() or b""):
+            self.token_manager.invalidate(header_params["Authorization"].removeprefix("Bearer "))
+            header_params = {**header_params, "Authorization": f"Bearer {self.token_manager.get_access_token()}"}
+            response = self._call_api_rate_limited(method, url, header_params, body, post_params, _request_timeout)
+        return response
+
+    def _call_api_rate_limited(
+        self,
+        method: str,
+        url: str,
+        header_params: dict | None,
+        body: Any,
+        post_params: Any,
+        _request_timeout: Any,
+    ) -> moneykit.rest.RESTResponse:
+        endpoint_class, link_id = classify(method, url)
+        endpoint = getattr(self._endpoint, "name", method)
+        attempt = 0
+        while True:
+            self.scheduler.acquire(endpoint_class, link_id)
+            status = "error"
+            started = time.perf_counter()
+            try:
+                with metrics.span(f"MoneyKit {endpoint}"):
+                    response = super().call_api(method, url, header_params, body, post_params, _request_timeout)
+                status = str(response.status)
+            finally:
+                metrics.MONEYKIT_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint, status)
+            if response.status != 429 or attempt >= self.scheduler.max_retries:
+                return response
+            attempt += 1
+            delay = self.scheduler.throttled(endpoint_class, response.getheader("Retry-After"), attempt)
+            logger.info(f"{method} {url} was rate limited, retry {attempt} in {delay:.2f}s")
+
+
+@functools.lru_cache
+def moneykit_client() -> RefreshingApiClient:
+    """Creates a client that authenticates to MoneyKit with your client id and secret.
+
+    The bearer token is fetched on the first request and fetched again shortly before it expires, or if MoneyKit
+    responds with an `api_error.auth.expired_access_token` error code.
+
+    :returns: An authenticated client
+    """
+    settings = get_settings()
+
+    config = moneykit.Configuration(host=settings.moneykit_url)
+    token_manager = AccessTokenManager(
+        settings.moneykit_url,
+        settings.moneykit_client_id,
+        settings.moneykit_client_secret.get_secret_value(),
+    )
+    api_client = RefreshingApiClient(config, token_manager)
+    # urllib3 only keeps 1 connection per host alive by default, concurrent requests would open and throw away a new
+    # connection each time.
+    api_client.rest_client.pool_manager.connection_pool_kw["maxsize"] = settings.moneykit_max_connections
+    return api_client
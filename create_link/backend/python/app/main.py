@@ -1,16 +1,94 @@
+import dataclasses
 import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable
 
-from fastapi import FastAPI
+import anyio.to_thread
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
 
+from app import metrics
 from app.api import router
+from app.client import RefreshingApiClient, moneykit_client
+from app.link_data import LinkDataCache, link_data_cache
 from app.settings import get_settings
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    # Sync route handlers (and so every MoneyKit SDK call) run in this thread pool.
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = get_settings().moneykit_max_connections
+    yield
+
+
+def register_client_metrics(client: Callable[[], RefreshingApiClient]) -> None:
+    """Export the token manager's and rate limiter's own metrics, read from `client()` whenever `/metrics` is
+    scraped."""
+    registry = metrics.REGISTRY
+    registry.callback(
+        "moneykit_access_token_fetches_total",
+        "Access tokens fetched from MoneyKit.",
+        "counter",
+        lambda: {(): client().token_manager.metrics.fetches},
+    )
+    registry.callback(
+        "moneykit_access_token_fetch_seconds_total",
+        "Time spent fetching access tokens.",
+        "counter",
+        lambda: {(): client().token_manager.metrics.total_fetch_seconds},
+    )
+    registry.callback(
+        "moneykit_expired_token_retries_total",
+        "Requests retried because MoneyKit rejected the access token as expired.",
+        "counter",
+        lambda: {(): client().token_manager.metrics.expired_token_retries},
+    )
+    registry.callback(
+        "moneykit_rate_limit_throttled_total",
+        "Requests MoneyKit answered with 429 Too Many Requests.",
+        "counter",
+        lambda: {(name,): m.throttled for name, m in client().scheduler.metrics.items()},
+        ["endpoint_class"],
+    )
+    registry.callback(
+        "moneykit_rate_limit_wait_seconds_total",
+        "Time requests spent waiting for the client side rate limiter.",
+        "counter",
+        lambda: {(name,): m.total_wait_seconds for name, m in client().scheduler.metrics.items()},
+        ["endpoint_class"],
+    )
+    registry.callback(
+        "moneykit_rate_limit_queue_depth",
+        "Requests currently waiting for the client side rate limiter.",
+        "gauge",
+        lambda: {(name,): m.queue_depth for name, m in client().scheduler.metrics.items()},
+        ["endpoint_class"],
+    )
+
+
+def register_link_data_metrics(cache: Callable[[], LinkDataCache]) -> None:
+    metrics.REGISTRY.callback(
+        "link_data_requests_total",
+        "Account and transaction lookups, by whether the link was cached, still being fetched or missing.",
+        "counter",
+        lambda: {
+            ("hit",): cache().metrics.hits,
+            ("wait",): cache().metrics.waits,
+            ("miss",): cache().metrics.misses,
+        },
+        ["result"],
+    )
+
+
 def create_app() -> FastAPI:
-    logging.basicConfig(level=get_settings().log_level)
+    settings = get_settings()
+    logging.basicConfig(level=settings.log_level)
+    metrics.configure_tracing(settings.tracing_enabled)
+    register_client_metrics(moneykit_client)
+    register_link_data_metrics(link_data_cache)
 
-    app = FastAPI(title="Create Link App")
+    app = FastAPI(title="Create Link App", lifespan=lifespan)
     app.include_router(router)
 
     app.add_middleware(
@@ -19,11 +97,29 @@ def create_app() -> FastAPI:
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    # Added last so it's outermost and also times the other middleware.
+    app.add_middleware(metrics.MetricsMiddleware)
 
     @app.get("/health-check", include_in_schema=False)
     async def health_check() -> dict:
         return {"project": "create_link/backend/python"}
 
+    @app.get("/metrics", include_in_schema=False)
+    async def prometheus_metrics() -> Response:
+        return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+    @app.get("/metrics/auth", include_in_schema=False)
+    async def auth_metrics() -> dict:
+        return dataclasses.asdict(moneykit_client().token_manager.metrics)
+
+    @app.get("/metrics/rate-limit", include_in_schema=False)
+    async def rate_limit_metrics() -> dict:
+        return {name: dataclasses.asdict(metrics) for name, metrics in moneykit_client().scheduler.metrics.items()}
+
+    @app.get("/metrics/link-data", include_in_schema=False)
+    async def link_data_metrics() -> dict:
+        return dataclasses.asdict(link_data_cache().metrics)
+
     return app
 
 
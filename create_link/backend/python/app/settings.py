@@ -10,6 +10,18 @@ class Settings(pydantic_settings.BaseSettings):
     moneykit_client_id: str
     moneykit_client_secret: pydantic.SecretStr
     frontend_oauth_redirect_uri: str = "http://localhost:3000"
+    # The SDK is synchronous so each in-flight MoneyKit call occupies one of FastAPI's worker threads. Both the thread
+    # pool and the SDK's connection pool are sized with this so every thread can reuse a kept-alive connection.
+    moneykit_max_connections: int = 40
+    # Fetch a new link's accounts and transactions in the background straight after the token exchange, see
+    # `app/link_data.py`. They're then kept for the TTL, for at most this many links.
+    link_warm_up_enabled: bool = True
+    link_data_ttl_seconds: float = 5 * 60
+    link_data_max_links: int = 1_000
+    # A request for a link that is already being fetched waits this long for it, then fetches the link itself.
+    link_data_wait_seconds: float = 10.0
+    # Create tracing spans for requests and MoneyKit calls, needs `opentelemetry` installed, see `app/metrics.py`.
+    tracing_enabled: bool = False
 
     class Config:
         case_sensitive = False
@@ -1,67 +1,27 @@
-import functools
 import logging
+import time
 from typing import Annotated
 
 import httpx
 import pydantic
-from fastapi import APIRouter, Body, status
+from fastapi import APIRouter, BackgroundTasks, Body, Depends, HTTPException, Request, status
 
+from app.client import MoneyKitClient
+from app.link_data import LinkData, LinkDataCache
 from app.settings import get_settings
 
 router = APIRouter()
 logger = logging.getLogger("example.api")
 
 
-def _get_access_token(moneykit_url: str, client_id: str, client_secret: str) -> str:
-    logger.debug(f"Authenticating to {moneykit_url} as {client_id}")
-    try:
-        token_request_body = {
-            "client_id": client_id,
-            "client_secret": client_secret,
-            "grant_type": "client_credentials",
-        }
-
-        response = httpx.post(f"{moneykit_url}/auth/token", data=token_request_body, timeout=5)
-        response.raise_for_status()
-        response_body = response.json()
-
-        expires_in = response_body["expires_in"]
-        logger.debug(f"Token will expire in {expires_in} seconds")
-
-        return response_body["access_token"]
-    except httpx.HTTPError as err:
-        raise err
-
-
-@functools.lru_cache
-def moneykit_client() -> httpx.Client:
-    """Generates a Bearer token from your client id and secret to access MoneyKit.
+def get_moneykit_client(request: Request) -> MoneyKitClient:
+    """The client shared by all requests, created in the app's lifespan."""
+    return request.app.state.moneykit_client
 
-    This bearer token will expire. This method does not show regenerating the token on/before expiry for simplicity.
-
-    :returns: An authenticated client
-    """
-    settings = get_settings()
-
-    # Generate a bearer access token that is valid for 60 minutes.
-    # This client _should_ be cached to avoid regenerating a token on every request.
-    # The bearer token should be regenerated before expiry or after a `api_error.auth.expired_access_token` error code
-    # is returned by a request.
-
-    access_token = _get_access_token(
-        settings.moneykit_url,
-        settings.moneykit_client_id,
-        settings.moneykit_client_secret.get_secret_value(),
-    )
-    client = httpx.Client(
-        base_url=settings.moneykit_url,
-        headers={
-            "Authorization": f"Bearer {access_token}",
-        },
-        timeout=5.0,
-    )
 
-    return client
+def get_link_data_cache(request: Request) -> LinkDataCache:
+    """Accounts and transactions of new links, warmed up after the token exchange, see `app/link_data.py`."""
+    return request.app.state.link_data_cache
 
 
 class NewLinkSessionResponse(pydantic.BaseModel):
@@ -82,12 +42,14 @@ class ExchangeTokenForLinkResponse(pydantic.BaseModel):
     status_code=status.HTTP_201_CREATED,
     response_model=NewLinkSessionResponse,
 )
-async def new_link_session() -> NewLinkSessionResponse:
+async def new_link_session(
+    client: Annotated[MoneyKitClient, Depends(get_moneykit_client)],
+) -> NewLinkSessionResponse:
     """Create a link session. This example shows overriding default settings and products."""
     settings = get_settings()
-    client = moneykit_client()
     # Prefetch available products for testing.
-    response = client.post(
+    response = await client.request(
+        "POST",
         "/link-session",
         json={
             "customer_user": {"id": "examples-create_link-test-user"},
@@ -102,7 +64,6 @@ async def new_link_session() -> NewLinkSessionResponse:
             },
         },
     )
-    response.raise_for_status()
     response_body = response.json()
     link_session_token = response_body["link_session_token"]
 
@@ -117,35 +78,81 @@ async def new_link_session() -> NewLinkSessionResponse:
 )
 async def exchange_token_for_link(
     body: Annotated[ExchangeTokenForLinkRequest, Body()],
+    client: Annotated[MoneyKitClient, Depends(get_moneykit_client)],
+    link_data: Annotated[LinkDataCache, Depends(get_link_data_cache)],
+    background_tasks: BackgroundTasks,
 ) -> ExchangeTokenForLinkResponse:
-    """Exchange the Connect SDK's response for a link_id."""
-    client = moneykit_client()
-    response = client.post(
+    """Exchange the Connect SDK's response for a link_id.
+
+    The new link's accounts and transactions are then fetched in the background, after this responds, so the
+    frontend's first request for them is answered locally.
+    """
+    response = await client.request(
+        "POST",
         "/link-session/exchange-token",
         json={
             "exchangeable_token": body.exchangeable_token,
         },
     )
-    response.raise_for_status()
     response_body = response.json()
     link_id = response_body["link_id"]
     institution_name = response_body["link"]["institution_name"]
 
     logger.info(f"MoneyKit link id: {link_id}")
+    if get_settings().link_warm_up_enabled:
+        background_tasks.add_task(link_data.warm_up, link_id, time.perf_counter())
     return ExchangeTokenForLinkResponse(
         moneykit_link_id=link_id,
         institution_name=institution_name,
     )
 
 
+@router.get(
+    "/links/{link_id}/accounts",
+    status_code=status.HTTP_200_OK,
+)
+async def get_accounts(
+    link_id: str,
+    link_data: Annotated[LinkDataCache, Depends(get_link_data_cache)],
+) -> dict:
+    """The link's accounts, from the cache the token exchange warmed up."""
+    data = await _get_link_data(link_data, link_id)
+    return {"accounts": data.accounts, "fetched_at": data.fetched_at}
+
+
+@router.get(
+    "/links/{link_id}/transactions",
+    status_code=status.HTTP_200_OK,
+)
+async def get_transactions(
+    link_id: str,
+    link_data: Annotated[LinkDataCache, Depends(get_link_data_cache)],
+) -> dict:
+    """The link's transactions as of its initial sync, from the cache the token exchange warmed up."""
+    data = await _get_link_data(link_data, link_id)
+    return {"transactions": list(data.transactions.values()), "cursor": data.cursor, "fetched_at": data.fetched_at}
+
+
 @router.delete(
     "/links/{link_id}",
     status_code=status.HTTP_204_NO_CONTENT,
 )
-def delete_link(link_id: str) -> None:
+async def delete_link(
+    link_id: str,
+    client: Annotated[MoneyKitClient, Depends(get_moneykit_client)],
+    link_data: Annotated[LinkDataCache, Depends(get_link_data_cache)],
+) -> None:
     """Delete a link."""
-
-    client = moneykit_client()
-    response = client.delete("/links/{link_id}")
-    response.raise_for_status()
+    await client.request("DELETE", f"/links/{link_id}")
+    link_data.invalidate(link_id)
     logger.info(f"Deleted link id: {link_id}")
+
+
+async def _get_link_data(link_data: LinkDataCache, link_id: str) -> LinkData:
+    try:
+        return await link_data.get(link_id)
+    except httpx.HTTPStatusError as err:
+        # E.g. the link was deleted.
+        if err.response.status_code == status.HTTP_404_NOT_FOUND:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={"error": "Link not found"})
+        raise
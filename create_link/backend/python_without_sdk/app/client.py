@@ -0,0 +1,129 @@
+import asyncio
+import dataclasses
+import logging
+import time
+from typing import Any
+
+import httpx
+
+from app import metrics
+from app.ratelimit import LINK_PATH, RequestScheduler, classify
+from app.settings import Settings
+
+logger = logging.getLogger("example.mk_client")
+
+# Fetch a new token this many seconds before the current one expires so a request never goes out with an expired one.
+REFRESH_MARGIN_SECONDS = 300
+EXPIRED_ACCESS_TOKEN_ERROR = "api_error.auth.expired_access_token"
+
+
+@dataclasses.dataclass
+class AccessTokenMetrics:
+    fetches: int = 0
+    expired_token_retries: int = 0
+    last_fetch_seconds: float = 0.0
+    total_fetch_seconds: float = 0.0
+
+
+class MoneyKitClient:
+    """An async MoneyKit API client sharing one pooled `httpx.AsyncClient` between all requests.
+
+    One instance is created in the app's lifespan (see `app.main`) so connections are kept alive and reused instead of
+    being opened per request, and so no request ever blocks the event loop waiting on MoneyKit.
+
+    The bearer token is fetched on the first request and fetched again shortly before it expires. Fetching is single
+    flight: concurrent requests that find the token needs refreshing wait for one `/auth/token` call. A request
+    rejected with `api_error.auth.expired_access_token` is retried once with a new token.
+
+    Every request is also paced by a `RequestScheduler` and retried when MoneyKit responds `429 Too Many Requests`.
+    """
+
+    def __init__(self, settings: Settings) -> None:
+        self._settings = settings
+        self._http = httpx.AsyncClient(
+            base_url=settings.moneykit_url,
+            http2=settings.moneykit_http2,
+            limits=httpx.Limits(
+                max_connections=settings.moneykit_max_connections,
+                max_keepalive_connections=settings.moneykit_max_keepalive_connections,
+                keepalive_expiry=settings.moneykit_keepalive_expiry,
+            ),
+            timeout=5.0,
+        )
+        self._access_token = ""
+        self._refresh_at = 0.0
+        self._access_token_lock = asyncio.Lock()
+        self.token_metrics = AccessTokenMetrics()
+        self.scheduler = RequestScheduler()
+
+    async def request(self, method: str, url: str, **kwargs: Any) -> httpx.Response:
+        """Send an authenticated request to MoneyKit and raise for error responses."""
+        access_token = await self._get_access_token()
+        response = await self._send(method, url, access_token, **kwargs)
+        if response.status_code == httpx.codes.UNAUTHORIZED and EXPIRED_ACCESS_TOKEN_ERROR in response.text:
+            self.token_metrics.expired_token_retries += 1
+            if access_token == self._access_token:
+                self._refresh_at = 0.0
+            response = await self._send(method, url, await self._get_access_token(), **kwargs)
+
+        response.raise_for_status()
+        return response
+
+    async def aclose(self) -> None:
+        await self._http.aclose()
+
+    async def _send(self, method: str, url: str, access_token: str, **kwargs: Any) -> httpx.Response:
+        endpoint_class, link_id = classify(method, url)
+        # The link id is left out so the number of label values stays bounded.
+        endpoint = f"{method} {LINK_PATH.sub('/links/{id}', url)}"
+        attempt = 0
+        while True:
+            await self.scheduler.acquire(endpoint_class, link_id)
+            status = "error"
+            started = time.perf_counter()
+            try:
+                with metrics.span(f"MoneyKit {endpoint}"):
+                    response = await self._http.request(
+                        method, url, headers={"Authorization": f"Bearer {access_token}"}, **kwargs
+                    )
+                status = str(response.status_code)
+            finally:
+                metrics.MONEYKIT_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint, status)
+            if response.status_code != httpx.codes.TOO_MANY_REQUESTS or attempt >= self.scheduler.max_retries:
+                return response
+            attempt += 1
+            delay = await self.scheduler.throttled(endpoint_class, response.headers.get("Retry-After"), attempt)
+            logger.info(f"{method} {url} was rate limited, retry {attempt} in {delay:.2f}s")
+
+    async def _get_access_token(self) -> str:
+        if time.monotonic() >= self._refresh_at:
+            async with self._access_token_lock:
+                # Another request may have fetched a token while this one was waiting for the lock.
+                if time.monotonic() >= self._refresh_at:
+                    await self._fetch_access_token()
+        return self._access_token
+
+    async def _fetch_access_token(self) -> None:
+        logger.debug(f"Authenticating to {self._settings.moneykit_url} as {self._settings.moneykit_client_id}")
+        token_request_body = {
+            "client_id": self._settings.moneykit_client_id,
+            "client_secret": self._settings.moneykit_client_secret.get_secret_value(),
+            "grant_type": "client_credentials",
+        }
+
+        started = time.perf_counter()
+        response = await self._http.post("/auth/token", data=token_request_body)
+        response.raise_for_status()
+        response_body = response.json()
+        elapsed = time.perf_counter() - started
+
+        self.token_metrics.fetches += 1
+        self.token_metrics.last_fetch_seconds = elapsed
+        self.token_metrics.total_fetch_seconds += elapsed
+
+        expires_in = response_body["expires_in"]
+        logger.debug(f"Token will expire in {expires_in} seconds, fetched in {elapsed * 1000:.0f}ms")
+
+        self._access_token = response_body["access_token"]
+        margin = min(REFRESH_MARGIN_SECONDS, expires_in // 2)
+        self._refresh_at = time.monotonic() + expires_in - margin
@@ -0,0 +1,193 @@
+"""A newly connected link's accounts and transactions, fetched in the background as soon as the link is created.
+
+Otherwise the first dashboard view after connecting a link waits while its accounts are fetched and its whole
+transaction history is synced from MoneyKit. Instead `POST /linking/exchange-token` adds `warm_up` as a background
+task, which runs once the 202 response has been sent, and `GET /links/{link_id}/accounts` and
+`GET /links/{link_id}/transactions` answer from what it fetched. A request that arrives while the link is being fetched
+waits for that fetch, for at most `link_data_wait_seconds`, rather than fetching the same data a second time.
+
+Links are kept for `link_data_ttl_seconds`, and past `link_data_max_links` the one fetched longest ago is dropped. Each
+backend process has its own cache, a process that didn't warm a link fetches it on the first request for it.
+"""
+
+import asyncio
+import collections
+import dataclasses
+import logging
+import time
+from typing import Any, Awaitable, Callable
+
+from app import metrics
+from app.client import MoneyKitClient
+
+logger = logging.getLogger("example.link_data")
+
+
+@dataclasses.dataclass
+class LinkData:
+    accounts: list[dict[str, Any]]
+    # By transaction id, with every page of the initial sync applied.
+    transactions: dict[str, dict[str, Any]]
+    # Continue syncing from here to get the changes since.
+    cursor: str | None
+    fetched_at: float
+
+
+@dataclasses.dataclass
+class LinkDataMetrics:
+    warm_ups: int = 0
+    warm_up_failures: int = 0
+    # From the token exchange scheduling the warm-up until the link is cached.
+    last_warm_up_seconds: float = 0.0
+    total_warm_up_seconds: float = 0.0
+    hits: int = 0
+    # Requests that arrived while the link was still being fetched and waited for it.
+    waits: int = 0
+    misses: int = 0
+
+
+class LinkDataCache:
+    """Only used from the event loop, so it needs no locks."""
+
+    def __init__(
+        self, fetch: Callable[[str], Awaitable[LinkData]], max_links: int, ttl_seconds: float, wait_seconds: float
+    ) -> None:
+        self._fetch = fetch
+        self._max_links = max_links
+        self._ttl_seconds = ttl_seconds
+        self._wait_seconds = wait_seconds
+        # Oldest first, with when each link expires.
+        self._links: collections.OrderedDict[str, tuple[float, LinkData]] = collections.OrderedDict()
+        # Resolves to the link's data, or `None` if fetching it failed.
+        self._in_flight: dict[str, asyncio.Future[LinkData | None]] = {}
+        # Links invalidated while being fetched, so that fetch doesn't cache data from before the change.
+        self._invalidated: set[str] = set()
+        self.metrics = LinkDataMetrics()
+
+    async def warm_up(self, link_id: str, scheduled_at: float) -> None:
+        """Fetch a new link, run as a background task once the token exchange has responded. If this fails the first
+        request for the link fetches it instead.
+
+        :param scheduled_at: `time.perf_counter()` when the task was added.
+        """
+        if self._cached(link_id) is not None or link_id in self._in_flight:
+            # A request for the link got here first.
+            return
+        self._in_flight[link_id] = asyncio.get_running_loop().create_future()
+
+        try:
+            await self._load(link_id)
+            result = "ok"
+        except Exception:
+            logger.exception(f"{link_id}: failed to warm up accounts and transactions")
+            result = "error"
+        elapsed = time.perf_counter() - scheduled_at
+        if result == "ok":
+            self.metrics.warm_ups += 1
+            self.metrics.last_warm_up_seconds = elapsed
+            self.metrics.total_warm_up_seconds += elapsed
+        else:
+            self.metrics.warm_up_failures += 1
+        metrics.LINK_WARM_UP_SECONDS.observe(elapsed, result)
+        logger.info(f"{link_id}: warm-up {result} in {elapsed:.3f}s")
+
+    async def get(self, link_id: str) -> LinkData:
+        data = self._cached(link_id)
+        if data is not None:
+            self.metrics.hits += 1
+            return data
+
+        in_flight = self._in_flight.get(link_id)
+        if in_flight is None:
+            self.metrics.misses += 1
+            self._in_flight[link_id] = asyncio.get_running_loop().create_future()
+            return await self._load(link_id)
+
+        self.metrics.waits += 1
+        try:
+            # Shielded, a request that is cancelled or stops waiting mustn't cancel the fetch for everyone else.
+            data = await asyncio.wait_for(asyncio.shield(in_flight), self._wait_seconds)
+        except TimeoutError:
+            logger.warning(f"{link_id}: still being fetched after {self._wait_seconds}s, fetching it for this request")
+            data = None
+        if data is not None:
+            return data
+        # Fetching it failed or is slow. Fetch it for this request only, so it fails with its own error, e.g. a 404
+        # for a link that doesn't exist, and nothing about the failure is cached.
+        return await self._fetch(link_id)
+
+    def invalidate(self, link_id: str) -> None:
+        self._links.pop(link_id, None)
+        if link_id in self._in_flight:
+            self._invalidated.add(link_id)
+
+    async def _load(self, link_id: str) -> LinkData:
+        """Fetch a link whose future is in `_in_flight`, cache it and resolve the future."""
+        future = self._in_flight[link_id]
+        try:
+            data = await self._fetch(link_id)
+        except BaseException:
+            del self._in_flight[link_id]
+            self._invalidated.discard(link_id)
+            future.set_result(None)
+            raise
+
+        del self._in_flight[link_id]
+        if link_id in self._invalidated:
+            self._invalidated.discard(link_id)
+        else:
+            self._links[link_id] = (time.monotonic() + self._ttl_seconds, data)
+            self._links.move_to_end(link_id)
+            while len(self._links) > self._max_links:
+                self._links.popitem(last=False)
+        future.set_result(data)
+        return data
+
+    def _cached(self, link_id: str) -> LinkData | None:
+        entry = self._links.get(link_id)
+        if entry is None:
+            return None
+        expires_at, data = entry
+        if expires_at <= time.monotonic():
+            del self._links[link_id]
+            return None
+        return data
+
+
+async def fetch_link_data(client: MoneyKitClient, link_id: str) -> LinkData:
+    """The link's accounts and its transactions, synced from the start of its history. Both are fetched at once."""
+    try:
+        # If one fails the other is cancelled, rather than left using a connection and rate limit budget for nothing.
+        async with asyncio.TaskGroup() as group:
+            accounts = group.create_task(client.request("GET", f"/links/{link_id}/accounts"))
+            synced = group.create_task(_sync_transactions(client, link_id))
+    except* Exception as group_error:
+        # Raise the request's own error, e.g. an `httpx.HTTPStatusError` for a link that doesn't exist.
+        raise group_error.exceptions[0]
+    transactions, cursor = synced.result()
+    return LinkData(
+        accounts=accounts.result().json()["accounts"],
+        transactions=transactions,
+        cursor=cursor,
+        fetched_at=time.time(),
+    )
+
+
+async def _sync_transactions(client: MoneyKitClient, link_id: str) -> tuple[dict[str, dict[str, Any]], str | None]:
+    transactions: dict[str, dict[str, Any]] = {}
+    cursor: str | None = None
+    has_more = True
+    while has_more:
+        params: dict[str, Any] = {"size": 500}
+        if cursor is not None:
+            params["cursor"] = cursor
+        response = await client.request("GET", f"/links/{link_id}/transactions/sync", params=params)
+        response_body = response.json()
+        diff = response_body["transactions"]
+        for transaction in (*diff["created"], *diff["updated"]):
+            transactions[transaction["transaction_id"]] = transaction
+        for transaction_id in diff["removed"]:
+            transactions.pop(transaction_id, None)
+        has_more = response_body["has_more"]
+        cursor = response_body["cursor"]["next"]
+    return transactions, cursor
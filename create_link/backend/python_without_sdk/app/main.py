@@ -1,16 +1,107 @@
+import dataclasses
+import functools
 import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
 
+from app import metrics
 from app.api import router
+from app.client import MoneyKitClient
+from app.link_data import LinkDataCache, fetch_link_data
 from app.settings import get_settings
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    settings = get_settings()
+    app.state.moneykit_client = MoneyKitClient(settings)
+    app.state.link_data_cache = LinkDataCache(
+        functools.partial(fetch_link_data, app.state.moneykit_client),
+        settings.link_data_max_links,
+        settings.link_data_ttl_seconds,
+        settings.link_data_wait_seconds,
+    )
+    yield
+    await app.state.moneykit_client.aclose()
+
+
+def register_client_metrics(app: FastAPI) -> None:
+    """Export the client's token and rate limiter metrics, read from `app.state.moneykit_client` whenever `/metrics` is
+    scraped."""
+
+    def client() -> MoneyKitClient:
+        return app.state.moneykit_client
+
+    registry = metrics.REGISTRY
+    registry.callback(
+        "moneykit_access_token_fetches_total",
+        "Access tokens fetched from MoneyKit.",
+        "counter",
+        lambda: {(): client().token_metrics.fetches},
+    )
+    registry.callback(
+        "moneykit_access_token_fetch_seconds_total",
+        "Time spent fetching access tokens.",
+        "counter",
+        lambda: {(): client().token_metrics.total_fetch_seconds},
+    )
+    registry.callback(
+        "moneykit_expired_token_retries_total",
+        "Requests retried because MoneyKit rejected the access token as expired.",
+        "counter",
+        lambda: {(): client().token_metrics.expired_token_retries},
+    )
+    registry.callback(
+        "moneykit_rate_limit_throttled_total",
+        "Requests MoneyKit answered with 429 Too Many Requests.",
+        "counter",
+        lambda: {(name,): m.throttled for name, m in client().scheduler.metrics.items()},
+        ["endpoint_class"],
+    )
+    registry.callback(
+        "moneykit_rate_limit_wait_seconds_total",
+        "Time requests spent waiting for the client side rate limiter.",
+        "counter",
+        lambda: {(name,): m.total_wait_seconds for name, m in client().scheduler.metrics.items()},
+        ["endpoint_class"],
+    )
+    registry.callback(
+        "moneykit_rate_limit_queue_depth",
+        "Requests currently waiting for the client side rate limiter.",
+        "gauge",
+        lambda: {(name,): m.queue_depth for name, m in client().scheduler.metrics.items()},
+        ["endpoint_class"],
+    )
+
+
+def register_link_data_metrics(app: FastAPI) -> None:
+    def cache() -> LinkDataCache:
+        return app.state.link_data_cache
+
+    metrics.REGISTRY.callback(
+        "link_data_requests_total",
+        "Account and transaction lookups, by whether the link was cached, still being fetched or missing.",
+        "counter",
+        lambda: {
+            ("hit",): cache().metrics.hits,
+            ("wait",): cache().metrics.waits,
+            ("miss",): cache().metrics.misses,
+        },
+        ["result"],
+    )
+
+
 def create_app() -> FastAPI:
-    logging.basicConfig(level=get_settings().log_level)
-    app = FastAPI(title="Create Link App")
+    settings = get_settings()
+    logging.basicConfig(level=settings.log_level)
+    metrics.configure_tracing(settings.tracing_enabled)
+    app = FastAPI(title="Create Link App", lifespan=lifespan)
     app.include_router(router)
+    register_client_metrics(app)
+    register_link_data_metrics(app)
 
     app.add_middleware(
         CORSMiddleware,
@@ -18,11 +109,30 @@ def create_app() -> FastAPI:
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    # Added last so it's outermost and also times the other middleware.
+    app.add_middleware(metrics.MetricsMiddleware)
 
     @app.get("/health-check", include_in_schema=False)
     async def health_check() -> dict:
         return {"project": "create_link/backend/python_without_sdk"}
 
+    @app.get("/metrics", include_in_schema=False)
+    async def prometheus_metrics() -> Response:
+        return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+    @app.get("/metrics/auth", include_in_schema=False)
+    async def auth_metrics() -> dict:
+        return dataclasses.asdict(app.state.moneykit_client.token_metrics)
+
+    @app.get("/metrics/rate-limit", include_in_schema=False)
+    async def rate_limit_metrics() -> dict:
+        scheduler = app.state.moneykit_client.scheduler
+        return {name: dataclasses.asdict(metrics) for name, metrics in scheduler.metrics.items()}
+
+    @app.get("/metrics/link-data", include_in_schema=False)
+    async def link_data_metrics() -> dict:
+        return dataclasses.asdict(app.state.link_data_cache.metrics)
+
     return app
 
 
@@ -0,0 +1,188 @@
+"""Client side rate limiting for MoneyKit API calls.
+
+Every request first waits for a token from the bucket of its endpoint class (see `classify`), so a burst of concurrent
+requests is spread out before MoneyKit has to reject any. Requests waiting on the same bucket are served round-robin by
+link: a link with hundreds of pages queued gets one request through for every request of each other waiting link,
+instead of starving them.
+
+When MoneyKit does respond `429 Too Many Requests` the whole endpoint class is paused for the `Retry-After` it sent, or
+a jittered exponential backoff without one, and the request is retried.
+"""
+
+import asyncio
+import collections
+import dataclasses
+import random
+import re
+import time
+from urllib.parse import urlparse
+
+LINK_PATH = re.compile(r"^/links/(?P<link_id>[^/]+)")
+
+
+@dataclasses.dataclass(frozen=True)
+class EndpointLimit:
+    # Sustained requests per second and how many may be sent at once after a quiet period.
+    rate: float
+    burst: int
+
+
+# Conservative defaults, raise them to match the limits of your MoneyKit plan.
+DEFAULT_LIMITS = {
+    "link_session": EndpointLimit(rate=10, burst=20),
+    "refresh": EndpointLimit(rate=2, burst=5),
+    "transactions_sync": EndpointLimit(rate=10, burst=20),
+    "links": EndpointLimit(rate=20, burst=40),
+    "default": EndpointLimit(rate=10, burst=20),
+}
+
+
+def classify(method: str, url: str) -> tuple[str, str | None]:
+    """:returns: The endpoint class of a request and the link it is for, if any."""
+    path = urlparse(url).path
+    match = LINK_PATH.match(path)
+    link_id = match["link_id"] if match else None
+    if path.startswith("/link-session"):
+        return "link_session", link_id
+    if link_id is None:
+        return "default", link_id
+    if method == "POST" and path.endswith("/products"):
+        return "refresh", link_id
+    if path.endswith("/transactions/sync"):
+        return "transactions_sync", link_id
+    return "links", link_id
+
+
+@dataclasses.dataclass
+class RateLimitMetrics:
+    requests: int = 0
+    throttled: int = 0
+    # Requests currently waiting for a token, and the most there have been at once.
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+    total_wait_seconds: float = 0.0
+    max_wait_seconds: float = 0.0
+
+
+class TokenBucket:
+    """Not thread safe, `RequestScheduler` only uses it while holding its lock."""
+
+    def __init__(self, limit: EndpointLimit) -> None:
+        self._limit = limit
+        self._tokens = float(limit.burst)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+
+    def take(self, now: float) -> float:
+        """Take a token if there is one.
+
+        :returns: 0 if a token was taken, otherwise how many seconds until one is available.
+        """
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._tokens = min(
+            self._limit.burst,
+            self._tokens + (now - self._updated_at) * self._limit.rate,
+        )
+        self._updated_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self._limit.rate
+
+    def pause(self, now: float, seconds: float) -> None:
+        """Hand out no tokens for `seconds`, and start empty afterwards so requests resume at the sustained rate."""
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0.0
+        self._updated_at = self._paused_until
+
+
+class RequestScheduler:
+    """Decides when each MoneyKit request may be sent. One instance is shared by every request made with a client."""
+
+    def __init__(
+        self,
+        limits: dict[str, EndpointLimit] | None = None,
+        max_retries: int = 5,
+        backoff_seconds: float = 0.5,
+        max_backoff_seconds: float = 30.0,
+    ) -> None:
+        limits = limits or DEFAULT_LIMITS
+        self.max_retries = max_retries
+        self._backoff_seconds = backoff_seconds
+        self._max_backoff_seconds = max_backoff_seconds
+        self._condition = asyncio.Condition()
+        self._buckets = {name: TokenBucket(limit) for name, limit in limits.items()}
+        # Per endpoint class, the requests waiting for each link in the order the links take turns.
+        self._waiting: dict[str, collections.OrderedDict[str | None, collections.deque]] = {
+            name: collections.OrderedDict() for name in limits
+        }
+        self.metrics = {name: RateLimitMetrics() for name in limits}
+
+    async def acquire(self, endpoint_class: str, link_id: str | None) -> None:
+        """Wait until a request to `endpoint_class` for `link_id` may be sent."""
+        endpoint_class = endpoint_class if endpoint_class in self._buckets else "default"
+        bucket = self._buckets[endpoint_class]
+        queues = self._waiting[endpoint_class]
+        metrics = self.metrics[endpoint_class]
+        ticket = object()
+        started = time.monotonic()
+
+        async with self._condition:
+            queues.setdefault(link_id, collections.deque()).append(ticket)
+            metrics.queue_depth += 1
+            metrics.max_queue_depth = max(metrics.max_queue_depth, metrics.queue_depth)
+            try:
+                while True:
+                    # Only the oldest request of the link whose turn it is may take a token.
+                    if next(iter(queues)) != link_id or queues[link_id][0] is not ticket:
+                        await self._condition.wait()
+                        continue
+                    delay = bucket.take(time.monotonic())
+                    if delay == 0:
+                        break
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), delay)
+                    except TimeoutError:
+                        pass
+            finally:
+                # Also when cancelled while waiting, a ticket left behind would block its link forever.
+                queues[link_id].remove(ticket)
+                if queues[link_id]:
+                    # Back of the line, other links go first.
+                    queues.move_to_end(link_id)
+                else:
+                    del queues[link_id]
+                metrics.queue_depth -= 1
+                self._condition.notify_all()
+
+            metrics.requests += 1
+            waited = time.monotonic() - started
+            metrics.total_wait_seconds += waited
+            metrics.max_wait_seconds = max(metrics.max_wait_seconds, waited)
+
+    async def throttled(self, endpoint_class: str, retry_after: str | None, attempt: int) -> float:
+        """Record a `429` response and pause `endpoint_class` before its next request.
+
+        :returns: How long the endpoint class is paused for.
+        """
+        endpoint_class = endpoint_class if endpoint_class in self._buckets else "default"
+        delay = _parse_retry_after(retry_after)
+        if delay is None:
+            delay = min(
+                self._max_backoff_seconds,
+                self._backoff_seconds * 2 ** (attempt - 1),
+            ) * random.uniform(0.5, 1.5)
+        async with self._condition:
+            self.metrics[endpoint_class].throttled += 1
+            self._buckets[endpoint_class].pause(time.monotonic(), delay)
+            self._condition.notify_all()
+        return delay
+
+
+def _parse_retry_after(retry_after: str | None) -> float | None:
+    # Only the delay-seconds form of `Retry-After` is understood, an HTTP date is treated as if there was none.
+    try:
+        return max(0.0, float(retry_after)) if retry_after is not None else None
+    except ValueError:
+        return None
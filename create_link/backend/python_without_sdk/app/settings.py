@@ -11,6 +11,20 @@ class Settings(pydantic_settings.BaseSettings):
     moneykit_client_id: str
     moneykit_client_secret: pydantic.SecretStr
     frontend_oauth_redirect_uri: str = "http://localhost:3000"
+    # Connection pool used for all calls to MoneyKit.
+    moneykit_http2: bool = True
+    moneykit_max_connections: int = 100
+    moneykit_max_keepalive_connections: int = 20
+    moneykit_keepalive_expiry: float = 30.0
+    # Fetch a new link's accounts and transactions in the background straight after the token exchange, see
+    # `app/link_data.py`. They're then kept for the TTL, for at most this many links.
+    link_warm_up_enabled: bool = True
+    link_data_ttl_seconds: float = 5 * 60
+    link_data_max_links: int = 1_000
+    # A request for a link that is already being fetched waits this long for it, then fetches the link itself.
+    link_data_wait_seconds: float = 10.0
+    # Create tracing spans for requests and MoneyKit calls, needs `opentelemetry` installed, see `app/metrics.py`.
+    tracing_enabled: bool = False
 
     class Config:
         case_sensitive = False
@@ -0,0 +1,114 @@
+"""Page through `GET /links/{id}/transactions` with several pages in flight at once.
+
+The first page says how many transactions match in total, which is enough to know every page that needs to be
+fetched. The rest are requested concurrently, at most `concurrency` at a time, and yielded strictly in page order as
+soon as each one (and every page before it) has arrived. Only the pages in that window are held in memory.
+"""
+
+import logging
+import math
+import random
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date
+from typing import Iterator
+
+import moneykit
+import urllib3.exceptions
+from moneykit.models import ApiPublicTransactionsLegacyGetTransactionsResponse
+
+logger = logging.getLogger("example.pagination")
+
+TransactionsPage = ApiPublicTransactionsLegacyGetTransactionsResponse
+
+
+class TransactionPaginator:
+    def __init__(
+        self,
+        transactions_api: moneykit.TransactionsApi,
+        link_id: str,
+        start_date: date,
+        end_date: date,
+        page_size: int | None = None,
+        retries: int = 3,
+        backoff_seconds: float = 0.5,
+    ) -> None:
+        self._transactions_api = transactions_api
+        self._link_id = link_id
+        self._start_date = start_date
+        self._end_date = end_date
+        # `None` uses the API's default page size.
+        self._page_size = page_size
+        self._retries = retries
+        self._backoff_seconds = backoff_seconds
+
+    def pages(self, concurrency: int = 4) -> Iterator[TransactionsPage]:
+        """Yield every page in order, fetching up to `concurrency` pages at a time."""
+        first = self.fetch_page(1)
+        yield first
+        if not first.transactions or len(first.transactions) >= first.total:
+            return
+
+        last_page = math.ceil(first.total / (first.size or len(first.transactions)))
+        remaining = iter(range(2, last_page + 1))
+        window: deque[Future[TransactionsPage]] = deque()
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            for page in remaining:
+                window.append(executor.submit(self.fetch_page, page))
+                if len(window) == concurrency:
+                    break
+            while window:
+                response = window.popleft().result()
+                # Keep the window full while the caller works on this page.
+                next_page = next(remaining, None)
+                if next_page is not None:
+                    window.append(executor.submit(self.fetch_page, next_page))
+                yield response
+        finally:
+            # The caller may stop early, don't wait for pages it will never see.
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def transactions(
+        self, concurrency: int = 4
+    ) -> Iterator[moneykit.models.TransactionResponse]:
+        for response in self.pages(concurrency):
+            yield from response.transactions
+
+    def fetch_page(self, page: int) -> TransactionsPage:
+        """Fetch a single page, retrying connection errors, rate limiting and server errors with backoff."""
+        attempt = 0
+        while True:
+            try:
+                return self._transactions_api.get_transactions(
+                    self._link_id,
+                    start_date=self._start_date,
+                    end_date=self._end_date,
+                    page=page,
+                    size=self._page_size,
+                )
+            except (moneykit.ApiException, urllib3.exceptions.HTTPError) as err:
+                if attempt >= self._retries or not _is_retryable(err):
+                    raise
+                attempt += 1
+                delay = (
+                    self._backoff_seconds
+                    * 2 ** (attempt - 1)
+                    * random.uniform(0.5, 1.5)
+                )
+                reason = (
+                    f"status {err.status}"
+                    if isinstance(err, moneykit.ApiException)
+                    else repr(err)
+                )
+                logger.warning(
+                    f"{self._link_id}: page {page} failed ({reason}), retry {attempt} in {delay:.2f}s"
+                )
+                time.sleep(delay)
+
+
+def _is_retryable(err: Exception) -> bool:
+    if isinstance(err, moneykit.ApiException):
+        return err.status == 429 or (err.status is not None and err.status >= 500)
+    return True
@@ -0,0 +1,206 @@
+"""Fetch every product of many links at once.
+
+Each (link, product) pair is a separate request made from a pool of threads sharing one client, so a single access
+token and connection pool serve the whole run. A link's snapshot is yielded as soon as all of its products are in,
+and only a bounded number of links are in flight at a time, so memory use doesn't grow with the number of links.
+
+The SDK is only imported once a `ProductFetcher` is created, so the CLI can parse `SnapshotProduct` options without it.
+"""
+
+import dataclasses
+import enum
+import json
+import logging
+import statistics
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import date, datetime
+from typing import IO, TYPE_CHECKING, Any, Callable, Iterable, Iterator
+
+if TYPE_CHECKING:
+    import moneykit
+
+logger = logging.getLogger("example.snapshot")
+
+
+class SnapshotProduct(str, enum.Enum):
+    accounts = "accounts"
+    account_numbers = "account_numbers"
+    identity = "identity"
+    transactions = "transactions"
+
+
+@dataclasses.dataclass(frozen=True)
+class ProductResult:
+    link_id: str
+    product: SnapshotProduct
+    seconds: float
+    data: Any = None
+    error: str | None = None
+
+
+@dataclasses.dataclass
+class LinkSnapshot:
+    link_id: str
+    products: dict[str, Any] = dataclasses.field(default_factory=dict)
+    errors: dict[str, str] = dataclasses.field(default_factory=dict)
+
+    def add(self, result: ProductResult) -> None:
+        if result.error is None:
+            self.products[result.product.value] = result.data
+        else:
+            self.errors[result.product.value] = result.error
+
+    @property
+    def received(self) -> int:
+        return len(self.products) + len(self.errors)
+
+    def write(self, out: IO[str]) -> None:
+        """Write the snapshot as a single JSON line."""
+        out.write(json.dumps(dataclasses.asdict(self), default=_json_default))
+        out.write("\n")
+
+
+@dataclasses.dataclass
+class ProductLatencies:
+    """Per product request latencies of a snapshot run."""
+
+    seconds: dict[SnapshotProduct, list[float]] = dataclasses.field(
+        default_factory=dict
+    )
+    errors: dict[SnapshotProduct, int] = dataclasses.field(default_factory=dict)
+
+    def add(self, result: ProductResult) -> None:
+        self.seconds.setdefault(result.product, []).append(result.seconds)
+        if result.error is not None:
+            self.errors[result.product] = self.errors.get(result.product, 0) + 1
+
+    def summary(
+        self,
+    ) -> Iterator[tuple[SnapshotProduct, int, int, float, float, float]]:
+        """:returns: `(product, links, errors, p50, p95, max)` for each product, latencies in seconds."""
+        for product, seconds in self.seconds.items():
+            ordered = sorted(seconds)
+            p95 = ordered[min(len(ordered) - 1, len(ordered) * 95 // 100)]
+            yield (
+                product,
+                len(ordered),
+                self.errors.get(product, 0),
+                statistics.median(ordered),
+                p95,
+                ordered[-1],
+            )
+
+
+class ProductFetcher:
+    """Fetches a single product of a link, returning it as plain JSON-able data."""
+
+    def __init__(
+        self, api_client: "moneykit.ApiClient", start_date: date, end_date: date
+    ) -> None:
+        import moneykit
+
+        self._accounts_api = moneykit.AccountsApi(api_client)
+        self._identity_api = moneykit.IdentityApi(api_client)
+        self._transactions_api = moneykit.TransactionsApi(api_client)
+        self._start_date = start_date
+        self._end_date = end_date
+        self._fetchers: dict[SnapshotProduct, Callable[[str], Any]] = {
+            SnapshotProduct.accounts: self.accounts,
+            SnapshotProduct.account_numbers: self.account_numbers,
+            SnapshotProduct.identity: self.identity,
+            SnapshotProduct.transactions: self.transactions,
+        }
+
+    def fetch(self, link_id: str, product: SnapshotProduct) -> ProductResult:
+        started = time.perf_counter()
+        try:
+            data = self._fetchers[product](link_id)
+        except Exception as err:
+            import moneykit
+
+            # One failing product shouldn't stop the rest of the snapshot, it is recorded in the output instead.
+            error = (
+                f"({err.status}) {err.body}"
+                if isinstance(err, moneykit.ApiException)
+                else repr(err)
+            )
+            logger.warning(f"{link_id}: failed to fetch {product.value}: {error}")
+            return ProductResult(
+                link_id, product, time.perf_counter() - started, error=error
+            )
+        return ProductResult(link_id, product, time.perf_counter() - started, data=data)
+
+    def accounts(self, link_id: str) -> list[dict]:
+        response = self._accounts_api.get_accounts(link_id)
+        return [account.to_dict() for account in response.accounts]
+
+    def account_numbers(self, link_id: str) -> list[dict]:
+        response = self._accounts_api.get_account_numbers(link_id)
+        return [account.to_dict() for account in response.accounts]
+
+    def identity(self, link_id: str) -> list[dict]:
+        response = self._identity_api.get_identities(link_id)
+        return [account.to_dict() for account in response.accounts]
+
+    def transactions(self, link_id: str) -> list[dict]:
+        import pagination
+
+        paginator = pagination.TransactionPaginator(
+            self._transactions_api, link_id, self._start_date, self._end_date
+        )
+        # Links are already fetched concurrently, so each link's pages are fetched one after the other.
+        return [
+            transaction.to_dict()
+            for transaction in paginator.transactions(concurrency=1)
+        ]
+
+
+def snapshot_links(
+    fetcher: ProductFetcher,
+    link_ids: Iterable[str],
+    products: list[SnapshotProduct],
+    workers: int,
+    on_result: Callable[[ProductResult], None] | None = None,
+) -> Iterator[LinkSnapshot]:
+    """Fetch `products` of every link with `workers` threads, yielding each link once all its products are fetched.
+
+    Links are yielded in the order they complete, not the order they were given in.
+    """
+    # A repeated product would be fetched twice but only counted once, and its link never yielded.
+    products = list(dict.fromkeys(products))
+    # Enough queued requests to keep every worker busy, without reading the whole list of links up front.
+    max_in_flight = workers * 2
+    link_ids = iter(link_ids)
+    snapshots: dict[str, LinkSnapshot] = {}
+    in_flight: set[Future[ProductResult]] = set()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            while len(in_flight) < max_in_flight:
+                link_id = next(link_ids, None)
+                if link_id is None:
+                    break
+                snapshots[link_id] = LinkSnapshot(link_id)
+                in_flight.update(
+                    executor.submit(fetcher.fetch, link_id, product)
+                    for product in products
+                )
+            if not in_flight:
+                return
+
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if on_result is not None:
+                    on_result(result)
+                snapshot = snapshots[result.link_id]
+                snapshot.add(result)
+                if snapshot.received == len(products):
+                    yield snapshots.pop(result.link_id)
+
+
+def _json_default(value: Any) -> str:
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
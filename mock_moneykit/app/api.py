@@ -0,0 +1,248 @@
+import asyncio
+import hashlib
+import random
+import time
+import uuid
+from datetime import date, datetime, timezone
+from typing import Annotated
+
+from fastapi import APIRouter, BackgroundTasks, Depends, Form, Header, Query, status
+
+from app import data, webhooks
+from app.settings import Settings, get_settings
+
+
+class MockApiError(Exception):
+    """Rendered as a MoneyKit style `{"error_code": ..., "error_message": ...}` response, see `app.main`."""
+
+    def __init__(
+        self, status_code: int, error_code: str, error_message: str, headers: dict[str, str] | None = None
+    ) -> None:
+        self.status_code = status_code
+        self.error_code = error_code
+        self.error_message = error_message
+        self.headers = headers
+
+
+async def simulated_latency(settings: Annotated[Settings, Depends(get_settings)]) -> None:
+    latency_ms = settings.latency_ms + random.uniform(0, settings.latency_jitter_ms)
+    if latency_ms > 0:
+        await asyncio.sleep(latency_ms / 1000)
+
+
+async def require_access_token(authorization: Annotated[str | None, Header()] = None) -> None:
+    # Tokens are `mock_<client_id>_<expiry unix timestamp>` so expiry can be checked without keeping any state.
+    if not authorization or not authorization.startswith("Bearer mock_"):
+        raise MockApiError(status.HTTP_401_UNAUTHORIZED, "api_error.auth.unauthorized", "Invalid access token")
+    expires_at = int(authorization.rsplit("_", 1)[-1])
+    if time.time() > expires_at:
+        raise MockApiError(
+            status.HTTP_401_UNAUTHORIZED, "api_error.auth.expired_access_token", "Access token has expired"
+        )
+
+
+class RateLimiter:
+    """A fixed one second window shared by every authenticated request, like a single MoneyKit client id would get."""
+
+    def __init__(self) -> None:
+        self._window = 0
+        self._requests = 0
+
+    def allow(self, per_second: float) -> bool:
+        window = int(time.monotonic())
+        if window != self._window:
+            self._window = window
+            self._requests = 0
+        self._requests += 1
+        return self._requests <= per_second
+
+
+rate_limiter = RateLimiter()
+
+
+async def rate_limit(settings: Annotated[Settings, Depends(get_settings)]) -> None:
+    over_limit = settings.rate_limit_per_second > 0 and not rate_limiter.allow(settings.rate_limit_per_second)
+    if over_limit or random.random() < settings.throttle_rate:
+        raise MockApiError(
+            status.HTTP_429_TOO_MANY_REQUESTS,
+            "api_error.rate_limit_exceeded",
+            "Rate limit exceeded",
+            headers={"Retry-After": f"{settings.retry_after_seconds:g}"},
+        )
+
+
+async def server_errors(settings: Annotated[Settings, Depends(get_settings)]) -> None:
+    if random.random() < settings.error_rate:
+        raise MockApiError(
+            status.HTTP_500_INTERNAL_SERVER_ERROR, "api_error.internal_server_error", "Injected server error"
+        )
+
+
+router = APIRouter(dependencies=[Depends(simulated_latency)])
+authenticated = [Depends(require_access_token), Depends(rate_limit), Depends(server_errors)]
+SettingsDep = Annotated[Settings, Depends(get_settings)]
+
+SYNC_CURSOR_PREFIX = "mock_cursor_"
+
+
+def _link(link_id: str) -> dict:
+    return {
+        "link_id": link_id,
+        "institution_id": "mock_institution",
+        "institution_name": "Mock Bank",
+        "institution_avatar": "https://example.com/mock_bank.png",
+        "state": "connected",
+        "last_synced_at": datetime.now(timezone.utc).isoformat(),
+        "provider": "moneykit",
+        "link_tags": [],
+        "products": {
+            "accounts": {"refreshed_at": datetime.now(timezone.utc).isoformat()},
+            "transactions": {"refreshed_at": datetime.now(timezone.utc).isoformat(), "has_history": True},
+        },
+        "available_products": ["accounts", "transactions"],
+    }
+
+
+def _link_id_for(token: str) -> str:
+    # Deterministic so the same exchangeable token always produces the same link.
+    return "mk_" + hashlib.sha256(token.encode()).hexdigest()[:22]
+
+
+@router.post("/auth/token", status_code=status.HTTP_201_CREATED)
+async def create_access_token(
+    client_id: Annotated[str, Form()],
+    client_secret: Annotated[str, Form()],
+    grant_type: Annotated[str, Form()],
+    settings: Annotated[Settings, Depends(get_settings)],
+) -> dict:
+    return {
+        "access_token": f"mock_{client_id}_{int(time.time()) + settings.access_token_expires_in}",
+        "token_type": "bearer",
+        "expires_in": settings.access_token_expires_in,
+    }
+
+
+@router.post("/link-session", status_code=status.HTTP_201_CREATED, dependencies=authenticated)
+async def create_link_session() -> dict:
+    return {"link_session_token": "mock_link_session_token"}
+
+
+@router.post("/link-session/exchange-token", status_code=status.HTTP_201_CREATED, dependencies=authenticated)
+async def exchange_token(body: dict, settings: SettingsDep, background_tasks: BackgroundTasks) -> dict:
+    link_id = _link_id_for(body["exchangeable_token"])
+    _send_webhooks(
+        settings,
+        background_tasks,
+        [webhooks.webhook("link.state_changed", link_id), webhooks.webhook("transactions.updates_available", link_id)],
+    )
+    return {"link_id": link_id, "link": _link(link_id)}
+
+
+@router.get("/.well-known/jwks.json")
+async def get_jwks(settings: SettingsDep) -> dict:
+    return webhooks.jwks(settings.seed)
+
+
+@router.get("/links/{link_id}", dependencies=authenticated)
+async def get_link(link_id: str) -> dict:
+    return _link(link_id)
+
+
+@router.post("/links/{link_id}/products", status_code=status.HTTP_202_ACCEPTED, dependencies=authenticated)
+async def refresh_products(link_id: str, body: dict, settings: SettingsDep, background_tasks: BackgroundTasks) -> dict:
+    # Refreshes complete straight away and report it by webhook, as MoneyKit does once the institution responds.
+    products = body.get("products", [])
+    bodies = [webhooks.webhook("link.product_refresh", link_id, product=product) for product in products]
+    if "transactions" in products:
+        bodies.append(webhooks.webhook("transactions.updates_available", link_id))
+    _send_webhooks(settings, background_tasks, bodies)
+    return _link(link_id)
+
+
+@router.get("/links/{link_id}/accounts", dependencies=authenticated)
+async def get_accounts(link_id: str, settings: SettingsDep) -> dict:
+    return {"accounts": data.accounts(settings, link_id), "link": _link(link_id)}
+
+
+@router.get("/links/{link_id}/accounts/numbers", dependencies=authenticated)
+async def get_account_numbers(link_id: str, settings: SettingsDep) -> dict:
+    return {"accounts": data.account_numbers(settings, link_id), "link": _link(link_id)}
+
+
+@router.get("/links/{link_id}/identity", dependencies=authenticated)
+async def get_identity(link_id: str, settings: SettingsDep) -> dict:
+    return {"accounts": data.identities(settings, link_id), "link": _link(link_id)}
+
+
+@router.get("/links/{link_id}/transactions", dependencies=authenticated)
+async def get_transactions(
+    link_id: str,
+    settings: SettingsDep,
+    page: Annotated[int, Query(ge=1)] = 1,
+    size: Annotated[int, Query(ge=1, le=500)] = 50,
+    start_date: date | None = None,
+    end_date: date | None = None,
+) -> dict:
+    matching = data.transactions_in_range(settings, start_date, end_date)
+    return {
+        "total": len(matching),
+        "page": page,
+        "size": size,
+        "transactions": [
+            data.transaction(settings, link_id, index) for index in matching[(page - 1) * size : page * size]
+        ],
+        "accounts": data.accounts(settings, link_id),
+        "link": _link(link_id),
+    }
+
+
+@router.get("/links/{link_id}/transactions/sync", dependencies=authenticated)
+async def get_transactions_sync(
+    link_id: str,
+    settings: SettingsDep,
+    cursor: str | None = None,
+    size: Annotated[int, Query(ge=1, le=500)] = 100,
+) -> dict:
+    position = _parse_sync_cursor(cursor)
+    changes, next_position = data.sync_page(settings, link_id, position, size)
+    # Once caught up the same cursor keeps being returned, like MoneyKit with no new changes.
+    has_more = next_position < data.sync_feed_length(settings)
+    return {
+        "transactions": changes,
+        "accounts": data.accounts(settings, link_id),
+        "cursor": {"next": f"{SYNC_CURSOR_PREFIX}{next_position}"},
+        "has_more": has_more,
+        "link": _link(link_id),
+    }
+
+
+@router.post("/webhooks/test/link/{link_id}", dependencies=authenticated)
+async def trigger_test_link_webhook(
+    link_id: str, body: dict, settings: SettingsDep, background_tasks: BackgroundTasks
+) -> dict:
+    webhook = webhooks.webhook(body["webhook_event"], link_id, idempotency_key=body.get("webhook_idempotency_key"))
+    delivery_token = uuid.uuid4().hex
+    if settings.webhook_url:
+        background_tasks.add_task(
+            webhooks.deliver, settings.webhook_url, settings.seed, [webhook], delivery_token=delivery_token
+        )
+    return {"delivery_token": delivery_token}
+
+
+def _parse_sync_cursor(cursor: str | None) -> int:
+    if cursor is None:
+        return 0
+    try:
+        return int(cursor.removeprefix(SYNC_CURSOR_PREFIX))
+    except ValueError:
+        raise MockApiError(status.HTTP_400_BAD_REQUEST, "api_error.invalid_cursor", f"Invalid cursor {cursor}")
+
+
+def _send_webhooks(settings: Settings, background_tasks: BackgroundTasks, bodies: list[bytes]) -> None:
+    if settings.webhook_url and bodies:
+        background_tasks.add_task(webhooks.deliver, settings.webhook_url, settings.seed, bodies)
+
+
+@router.delete("/links/{link_id}", status_code=status.HTTP_204_NO_CONTENT, dependencies=authenticated)
+async def delete_link(link_id: str) -> None:
+    return None
@@ -0,0 +1,129 @@
+"""Deterministic accounts and transactions for a link.
+
+Nothing is stored: every value is derived from `Settings.seed`, the link id and the transaction's index, so the same
+settings always serve exactly the same data, from any number of processes.
+
+A link has `transactions_per_link` transactions, newest first, spread evenly over the last `history_days` days. Its
+`/transactions/sync` feed first creates all of them, then settles every pending one (`updated`) and finally removes a
+few. The cursor is simply the position in that feed.
+"""
+
+import bisect
+import random
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Any
+
+from app.settings import Settings
+
+PENDING_EVERY = 10
+REMOVED_EVERY = 25
+
+MERCHANTS = ["Coffee Shop", "Grocery Store", "Gas Station", "Bookstore", "Pharmacy", "Restaurant", "Airline", "Payroll"]
+
+
+def accounts(settings: Settings, link_id: str) -> list[dict[str, Any]]:
+    return [_account(settings, link_id, n) for n in range(settings.accounts_per_link)]
+
+
+def _account(settings: Settings, link_id: str, n: int) -> dict[str, Any]:
+    rng = random.Random(f"{settings.seed}:{link_id}:account:{n}")
+    balance = round(rng.uniform(100, 10_000), 2)
+    return {
+        "account_id": f"acc_{n}",
+        "account_type": "depository.checking" if n == 0 else "depository.savings",
+        "name": "Checking" if n == 0 else f"Savings {n}",
+        "account_mask": f"{rng.randrange(10_000):04d}",
+        "balances": {"currency": "USD", "available": balance, "current": balance},
+    }
+
+
+def account_numbers(settings: Settings, link_id: str) -> list[dict[str, Any]]:
+    return [
+        {
+            **account,
+            "numbers": {
+                "ach": [{"account_number": f"000{account['account_mask']}", "routing_number": "011000015"}],
+                "eft": [],
+                "international": [],
+                "bacs": [],
+            },
+        }
+        for account in accounts(settings, link_id)
+    ]
+
+
+def identities(settings: Settings, link_id: str) -> list[dict[str, Any]]:
+    owner = {"names": ["Alex Mock"], "addresses": [], "phone_numbers": [], "emails": []}
+    return [{**account, "owners": [owner]} for account in accounts(settings, link_id)]
+
+
+def transaction_date(settings: Settings, index: int) -> date:
+    days_ago = index * settings.history_days // max(settings.transactions_per_link, 1)
+    return date.today() - timedelta(days=days_ago)
+
+
+def transaction(settings: Settings, link_id: str, index: int, settled: bool = False) -> dict[str, Any]:
+    """The link's `index`th newest transaction, as first reported, or after it `settled` if it was pending."""
+    rng = random.Random(f"{settings.seed}:{link_id}:transaction:{index}")
+    merchant = rng.choice(MERCHANTS)
+    is_credit = merchant == "Payroll"
+    day = transaction_date(settings, index)
+    return {
+        "transaction_id": f"txn_{index}",
+        "account_id": f"acc_{index % max(settings.accounts_per_link, 1)}",
+        "amount": f"{rng.uniform(1, 2_000 if is_credit else 200):.2f}",
+        "type": "credit" if is_credit else "debit",
+        "currency": "USD",
+        "date": day.isoformat(),
+        "datetime": datetime.combine(day, time(hour=rng.randrange(24)), timezone.utc).isoformat(),
+        "description": merchant.ljust(settings.description_length, "."),
+        "raw_description": merchant.upper(),
+        "pending": index % PENDING_EVERY == 0 and not settled,
+        "category": "income" if is_credit else "shopping",
+    }
+
+
+def transactions_in_range(settings: Settings, start_date: date | None, end_date: date | None) -> range:
+    """Indexes of the transactions dated within `[start_date, end_date]`, which are consecutive as they're by date."""
+    indexes = range(settings.transactions_per_link)
+
+    # Dates descend with the index, so search on the negated ordinal.
+    def key(index: int) -> int:
+        return -transaction_date(settings, index).toordinal()
+
+    first = bisect.bisect_left(indexes, -end_date.toordinal(), key=key) if end_date else 0
+    last = bisect.bisect_right(indexes, -start_date.toordinal(), key=key) if start_date else len(indexes)
+    return indexes[first:last]
+
+
+def _sync_feed(settings: Settings) -> tuple[range, range, range]:
+    """Transaction indexes created, settled and removed, in the order the sync feed reports them."""
+    created = range(settings.transactions_per_link)
+    settled = range(0, settings.transactions_per_link, PENDING_EVERY)
+    # Offset so a removed transaction was never pending, pending transactions aren't reported as removed.
+    removed = range(REMOVED_EVERY // 2, settings.transactions_per_link, REMOVED_EVERY)
+    return created, settled, removed
+
+
+def sync_page(settings: Settings, link_id: str, position: int, size: int) -> tuple[dict[str, list], int]:
+    """The changes at `[position, position + size)` of the link's sync feed.
+
+    :returns: The `created`, `updated` and `removed` lists, and the position of the next page.
+    """
+    created, settled, removed = _sync_feed(settings)
+    page: dict[str, list] = {"created": [], "updated": [], "removed": []}
+    end = position + size
+    # Where the current part of the feed starts within the whole feed.
+    offset = 0
+    for name, indexes in [("created", created), ("updated", settled), ("removed", removed)]:
+        for index in indexes[max(position - offset, 0) : max(end - offset, 0)]:
+            if name == "removed":
+                page[name].append(f"txn_{index}")
+            else:
+                page[name].append(transaction(settings, link_id, index, settled=name == "updated"))
+        offset += len(indexes)
+    return page, max(position, min(end, offset))
+
+
+def sync_feed_length(settings: Settings) -> int:
+    return sum(len(indexes) for indexes in _sync_feed(settings))
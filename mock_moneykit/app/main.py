@@ -0,0 +1,31 @@
+import logging
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from app.api import MockApiError, router
+from app.settings import get_settings
+
+
+def create_app() -> FastAPI:
+    logging.basicConfig(level=get_settings().log_level)
+
+    app = FastAPI(title="Mock MoneyKit API")
+    app.include_router(router)
+
+    @app.exception_handler(MockApiError)
+    async def mock_api_error_handler(request: Request, exc: MockApiError) -> JSONResponse:
+        return JSONResponse(
+            status_code=exc.status_code,
+            content={"error_code": exc.error_code, "error_message": exc.error_message},
+            headers=exc.headers,
+        )
+
+    @app.get("/health-check", include_in_schema=False)
+    async def health_check() -> dict:
+        return {"project": "mock_moneykit"}
+
+    return app
+
+
+app = create_app()
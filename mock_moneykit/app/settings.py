@@ -0,0 +1,39 @@
+import functools
+
+import pydantic_settings
+
+
+class Settings(pydantic_settings.BaseSettings):
+    log_level: str = "WARNING"
+    # Added to every response to stand in for the round trip to api.moneykit.com.
+    latency_ms: float = 50.0
+    # Up to this much extra latency, picked at random for each response.
+    latency_jitter_ms: float = 0.0
+    access_token_expires_in: int = 3600
+    # Reject authenticated requests with `429 Too Many Requests`, either beyond this many per second (0 disables) or
+    # at random for this fraction of requests.
+    rate_limit_per_second: float = 0.0
+    throttle_rate: float = 0.0
+    retry_after_seconds: float = 1.0
+    # Fraction of authenticated requests answered with a `500 Internal Server Error`.
+    error_rate: float = 0.0
+    # Generated data is derived from this and the link id, so every run serves exactly the same accounts,
+    # transactions and webhook signing key.
+    seed: str = "mock_moneykit"
+    accounts_per_link: int = 2
+    transactions_per_link: int = 500
+    # Transactions are spread evenly over this many days, ending today.
+    history_days: int = 365
+    # Pads each transaction's description to make responses bigger.
+    description_length: int = 32
+    # Where signed webhooks are sent after a token exchange or product refresh, none are sent when empty.
+    webhook_url: str = ""
+
+    class Config:
+        case_sensitive = False
+        env_prefix = "mock_"
+
+
+@functools.lru_cache()
+def get_settings() -> Settings:
+    return Settings()
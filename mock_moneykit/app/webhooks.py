@@ -0,0 +1,96 @@
+"""Signed webhooks, verifiable with the keys served at `/.well-known/jwks.json`.
+
+Like MoneyKit, each webhook carries a `MoneyKit-Signature` header: an ES256 JWT, whose `kid` is in the JWKS, holding
+the SHA256 of the request body. The signing key is derived from `Settings.seed` so a load generator in another process
+can sign webhooks that the mock's JWKS verifies.
+"""
+
+import functools
+import hashlib
+import json
+import logging
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any
+
+import httpx
+import jwt
+import jwt.algorithms
+from cryptography.hazmat.primitives.asymmetric import ec
+
+logger = logging.getLogger("mock_moneykit.webhooks")
+
+P256_ORDER = 0xFFFFFFFF00000000FFFFFFFFFFFFFFFFBCE6FAADA7179E84F3B9CAC2FC632551
+
+
+@functools.lru_cache
+def signing_key(seed: str) -> ec.EllipticCurvePrivateKey:
+    secret = int.from_bytes(hashlib.sha256(f"{seed}:webhook_signing_key".encode()).digest())
+    # Any value in `[1, curve order)` is a valid P-256 private key.
+    return ec.derive_private_key(secret % (P256_ORDER - 1) + 1, ec.SECP256R1())
+
+
+def key_id(seed: str) -> str:
+    return "mock_" + hashlib.sha256(seed.encode()).hexdigest()[:16]
+
+
+def jwks(seed: str) -> dict[str, Any]:
+    jwk = json.loads(jwt.algorithms.ECAlgorithm.to_jwk(signing_key(seed).public_key()))
+    return {"keys": [{**jwk, "kid": key_id(seed), "use": "sig", "alg": "ES256"}]}
+
+
+def sign(seed: str, body: bytes) -> str:
+    return jwt.encode(
+        {"request_body_sha256": hashlib.sha256(body).hexdigest(), "iat": int(time.time())},
+        signing_key(seed),
+        algorithm="ES256",
+        headers={"kid": key_id(seed)},
+    )
+
+
+def webhook(event: str, link_id: str, idempotency_key: str | None = None, **fields: Any) -> bytes:
+    """The body of an `event` webhook, with typical values for the event's own fields unless given in `fields`."""
+    return json.dumps(
+        {
+            "webhook_event": event,
+            "webhook_major_version": 1,
+            "webhook_minor_version": 0,
+            "webhook_idempotency_key": idempotency_key or uuid.uuid4().hex,
+            "webhook_timestamp": datetime.now(timezone.utc).isoformat(),
+            "link_id": link_id,
+            "link_tags": [],
+            **_event_fields(event),
+            **fields,
+        }
+    ).encode()
+
+
+def _event_fields(event: str) -> dict[str, Any]:
+    if event == "link.state_changed":
+        return {"state": "connected"}
+    if event in ("link.product_refresh", "product.state_changed"):
+        return {"product": "accounts", "state": "completed", "state_changed_at": datetime.now(timezone.utc).isoformat()}
+    if event == "transactions.updates_available":
+        return {"has_history": True}
+    return {}
+
+
+def headers(seed: str, body: bytes, delivery_token: str | None = None, attempt: int = 1) -> dict[str, str]:
+    return {
+        "Content-Type": "application/json",
+        "MoneyKit-Signature": sign(seed, body),
+        "MoneyKit-Delivery-Token": delivery_token or uuid.uuid4().hex,
+        "MoneyKit-Delivery-Attempt": str(attempt),
+    }
+
+
+async def deliver(url: str, seed: str, bodies: list[bytes], delivery_token: str | None = None) -> None:
+    """Post each webhook to `url` in order. Failures are only logged, there are no retries."""
+    async with httpx.AsyncClient(timeout=10) as client:
+        for body in bodies:
+            try:
+                response = await client.post(url, content=body, headers=headers(seed, body, delivery_token))
+                response.raise_for_status()
+            except httpx.HTTPError as err:
+                logger.warning(f"Failed to deliver webhook to {url}: {err!r}")
@@ -1,4 +1,5 @@
 import logging
+import time
 from typing import Annotated
 
 import moneykit
@@ -6,9 +7,10 @@ import moneykit.models
 import moneykit.models.products_settings
 import moneykit.models.transactions_product_settings
 import pydantic
-from fastapi import APIRouter, Body, status
+from fastapi import APIRouter, BackgroundTasks, Body, status
 
 from app.client import moneykit_client
+from app.link_data import link_data_cache
 from app.ngrok import get_ngrok_tunnel_to_backend
 from app.settings import get_settings
 
@@ -73,13 +75,20 @@ def new_link_session() -> NewLinkSessionResponse:
 )
 def exchange_token_for_link(
     body: Annotated[ExchangeTokenForLinkRequest, Body()],
+    background_tasks: BackgroundTasks,
 ) -> ExchangeTokenForLinkResponse:
-    """Exchange the Connect SDK's response for a link_id."""
+    """Exchange the Connect SDK's response for a link_id.
+
+    The new link's accounts and transactions are then fetched in the background, after this responds, so the
+    frontend's first request for them is answered locally. See `app/link_data.py`.
+    """
     link_session_api = moneykit.LinkSessionApi(moneykit_client())
     response = link_session_api.exchange_token(
         moneykit.models.ExchangeTokenRequest(exchangeable_token=body.exchangeable_token),
     )
     logger.info(f"MoneyKit link id: {response.link_id}")
+    if get_settings().link_warm_up_enabled:
+        background_tasks.add_task(link_data_cache().warm_up, response.link_id, time.perf_counter())
     return ExchangeTokenForLinkResponse(
         moneykit_link_id=response.link_id,
         institution_name=response.link.institution_name,
@@ -3,14 +3,45 @@ from uuid import uuid4
 
 import moneykit
 import moneykit.models
-from fastapi import APIRouter, status
+from fastapi import APIRouter, HTTPException, status
 
 from app.client import moneykit_client
+from app.link_cache import link_cache
+from app.link_data import LinkData, link_data_cache
 
 router = APIRouter(prefix="/links")
 logger = logging.getLogger("example.api.links")
 
 
+@router.get(
+    "/{link_id}",
+    status_code=status.HTTP_200_OK,
+)
+def get_link(link_id: str) -> dict:
+    """The link's state and the state of each of its products, see `app/link_cache.py`."""
+    return link_cache().get(link_id).to_dict()
+
+
+@router.get(
+    "/{link_id}/accounts",
+    status_code=status.HTTP_200_OK,
+)
+def get_accounts(link_id: str) -> dict:
+    """The link's accounts, from the cache the token exchange warmed up, see `app/link_data.py`."""
+    data = _get_link_data(link_id)
+    return {"accounts": data.accounts, "fetched_at": data.fetched_at}
+
+
+@router.get(
+    "/{link_id}/transactions",
+    status_code=status.HTTP_200_OK,
+)
+def get_transactions(link_id: str) -> dict:
+    """The link's transactions as of its initial sync, from the cache the token exchange warmed up."""
+    data = _get_link_data(link_id)
+    return {"transactions": list(data.transactions.values()), "cursor": data.cursor, "fetched_at": data.fetched_at}
+
+
 @router.post(
     "/{link_id}/refresh/{product}",
     status_code=status.HTTP_200_OK,
@@ -94,4 +125,16 @@ def delete_link(link_id: str) -> None:
     """Delete a link"""
     links_api = moneykit.LinksApi(moneykit_client())
     links_api.delete_link(link_id)
+    link_cache().invalidate(link_id)
+    link_data_cache().invalidate(link_id)
     logger.info(f"Deleted link id: {link_id}")
+
+
+def _get_link_data(link_id: str) -> LinkData:
+    try:
+        return link_data_cache().get(link_id)
+    except moneykit.ApiException as err:
+        # E.g. the link was deleted.
+        if err.status == status.HTTP_404_NOT_FOUND:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={"error": "Link not found"})
+        raise
@@ -1,26 +1,70 @@
 import logging
-from typing import Annotated, Union, cast
+import sqlite3
+from typing import Annotated
 
+import anyio.to_thread
 import moneykit
 import moneykit.models
-import pydantic
 from fastapi import APIRouter, Header, HTTPException, Request, status
 
-from app.client import MoneyKitWebHookVerificationError, MoneyKitWebHookVerifier, moneykit_client
+from app.client import MoneyKitWebHookVerificationError, MoneyKitWebHookVerifier, jwks_cache
+from app.jobs import get_job_queue
+from app.link_cache import link_cache
+from app.settings import get_settings
+from app.tasks import do_thing_with_product, sync_transactions, update_link_state
+from app.webhook_registry import DecodedWebhook, WebhookRegistry
 
 router = APIRouter(prefix="")
 logger = logging.getLogger("example.api.webooks")
 
 
-AnyWebhook = Annotated[
-    Union[
-        moneykit.models.ProductStateChangedWebhook,
-        moneykit.models.AppLinkStateChangedWebhook,
-        moneykit.models.TransactionUpdatesAvailableWebhook,
-    ],
-    # Note this disciminator does not take into account breaking changes (`webhook_major_version`)
-    pydantic.Field(discriminator="webhook_event"),
-]
+webhooks = WebhookRegistry()
+
+
+@webhooks.handler("link.state_changed", 1, moneykit.models.AppLinkStateChangedWebhook)
+def handle_link_state_changed(webhook: moneykit.models.AppLinkStateChangedWebhook) -> None:
+    logger.info(f"{webhook.link_id}: {webhook.state=} {webhook.error=} {webhook.error_message=}")
+    link_cache().invalidate(webhook.link_id)
+    # The webhook carries the new state, so the job doesn't need to fetch it again.
+    update_link_state.delay(
+        link_id=webhook.link_id,
+        state=webhook.state.value,
+        error_code=webhook.error.value if webhook.error else None,
+        error_message=webhook.error_message,
+        changed_at=webhook.webhook_timestamp.isoformat(),
+    )
+
+
+@webhooks.handler("link.product_refresh", 1, moneykit.models.ProductStateChangedWebhook)
+def handle_product_refresh(webhook: moneykit.models.ProductStateChangedWebhook) -> None:
+    logger.info(
+        f"{webhook.link_id}: {webhook.product=} {webhook.state=} {webhook.state_changed_at=} {webhook.error_message=}"
+    )
+    link_cache().invalidate(webhook.link_id)
+    do_thing_with_product.delay(link_id=webhook.link_id, product=webhook.product.value)
+
+
+@webhooks.handler("transactions.updates_available", 1, moneykit.models.TransactionUpdatesAvailableWebhook)
+def handle_transaction_updates(webhook: moneykit.models.TransactionUpdatesAvailableWebhook) -> None:
+    logger.info(f"{webhook.link_id}: {webhook.has_history=}")
+    # A burst of these for one link becomes a single sync, see `transactions_sync_debounce_seconds`.
+    sync_transactions.debounce(get_settings().transactions_sync_debounce_seconds, link_id=webhook.link_id)
+
+
+def _handle_once(decoded: DecodedWebhook) -> bool:
+    """Run the webhook's handler unless its idempotency key was already handled.
+
+    Recording the key and enqueueing the job commit together, so a failure here can't make us ignore MoneyKit's retry
+    of this webhook. Both are SQLite writes that can wait on a worker's write lock, so this runs in a worker thread.
+
+    :returns: False if the webhook was a duplicate.
+    """
+    queue = get_job_queue()
+    with queue.transaction():
+        if queue.mark_seen(decoded.envelope.webhook_idempotency_key):
+            return False
+        decoded.handle()
+    return True
 
 
 @router.post(
@@ -36,7 +80,9 @@ async def handle_moneykit_webhook(
     """Verifies and handles incoming moneykit webhooks.
 
     This method should do the least amount of work possible and respond in a timely manner.
-    Here we pseudocode triggering Celery background jobs to do the work once the webhook has been verified and decoded.
+    Once the webhook has been verified and decoded, the handler registered for it enqueues the work as a background job
+    (see `app/jobs.py`), which is a single SQLite insert made in a worker thread, and it is picked up by
+    `python -m app.worker`.
 
     `moneykit_delivery_token` and `moneykit_delivery_attempt` can be used to help debug requests and are valuable to
     include in your backend logs.
@@ -47,67 +93,28 @@ async def handle_moneykit_webhook(
     logger.info(f"Handling webhook {moneykit_delivery_token=}({moneykit_delivery_attempt}) {moneykit_signature=}")
 
     body_bytes = await request.body()
-    client = moneykit_client()
     try:
-        verifier = MoneyKitWebHookVerifier(client)
-        verifier.verify_moneykit_webhook_request(moneykit_signature, body_bytes)
+        verifier = MoneyKitWebHookVerifier(jwks_cache())
+        await verifier.verify_moneykit_webhook_request(moneykit_signature, body_bytes)
     except MoneyKitWebHookVerificationError:
         logger.exception(f"Verification failed {body_bytes=}")
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={"error": "Verification failed"})
 
-    handled = False
+    # Only the schema registered for this event and `webhook_major_version` is used to parse the body.
+    decoded = webhooks.decode(body_bytes)
+    if decoded is None:
+        # Response is only for debugging
+        return {"debug_handled": False}
+    idempotency_key = decoded.envelope.webhook_idempotency_key
+
     try:
-        # Pydantic will correctly deserialize the event body based on the `webhook_event` key.
-        body = pydantic.TypeAdapter(AnyWebhook).validate_json(body_bytes)
-        logger.info(f"Parsed: {body}")
-        match body.webhook_event:
-            case "link.state_changed":
-                state_changed_webhook = cast(moneykit.models.AppLinkStateChangedWebhook, body)
-                logger.info(
-                    f"{state_changed_webhook.link_id}: {state_changed_webhook.state=} "
-                    f"{state_changed_webhook.error=} {state_changed_webhook.error_message=}"
-                )
-                # Next step: start a background job to update the saved link state
-                # update_link_state.delay(link_id=state_changed_webhook.link_id)
-            case "link.product_refresh":
-                product_refresh_webhook = cast(moneykit.models.ProductStateChangedWebhook, body)
-                logger.info(
-                    f"{product_refresh_webhook.link_id}: {product_refresh_webhook.product=} "
-                    f"{product_refresh_webhook.state=} {product_refresh_webhook.state_changed_at=} "
-                    f"{product_refresh_webhook.error_message=}"
-                )
-                # Next step: start a background job that performs whatever you need after your product has updated
-                # do_thing_with_product.delay(link_id=product_refresh_webhook.link_id)
-            case "transactions.updates_available":
-                transaction_udpates_webhook = cast(moneykit.models.TransactionUpdatesAvailableWebhook, body)
-                logger.info(f"{transaction_udpates_webhook.link_id}: {transaction_udpates_webhook.has_history=}")
-                # Next step: start a background job that syncs the latest transactions for this link
-                # sync_transactions.delay(link_id=transaction_udpates_webhook.link_id)
-
-        handled = True
-    except pydantic.ValidationError:
-        logger.info(f"Unhandled webhook '{body_bytes}'")
-
-    # Response is only for debugging
-    return {"debug_handled": handled}
-
-
-# @celery.task
-# def update_link_state(link_id: str) -> None:
-#     # Pseudo code to fetch and store the latest link state in your database
-#     link = db.get_link(link_id)
-#     links_api = moneykit.LinksApi(moneykit_client())
-#     response = links_api.get_link(link_id)
-#     link.moneykit_state = response.state.value
-#     link.moneykit_error = response.error_code.value
-#     link.moneykit_error_message = response.error_message
-#     db.commit()
-
-
-# @celery.task
-# def sync_transactions(link_id: str) -> None:
-#     # Pseudo code background task to sync transactions to your database
-#     link = db.get_link(link_id)
-#     transactions_api = moneykit.TransactionsApi(moneykit_client())
-#     response = transactions_api.get_transactions_sync(link_id, cursor=link.transaction_sync_cursor)
-#     # See `cache_transactions/python` example for how this works
+        handled = await anyio.to_thread.run_sync(_handle_once, decoded)
+    except sqlite3.OperationalError:
+        # E.g. the job queue stayed locked for its whole busy timeout. MoneyKit retries non-2XX responses.
+        logger.exception(f"Failed to enqueue {decoded.envelope.webhook_event} {idempotency_key=}")
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail={"error": "Try again later"})
+    if not handled:
+        logger.info(f"Ignoring already handled {decoded.envelope.webhook_event} {idempotency_key=}")
+        return {"debug_handled": True, "debug_duplicate": True}
+
+    return {"debug_handled": True}
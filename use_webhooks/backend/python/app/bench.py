@@ -0,0 +1,454 @@
+"""Benchmarks for the webhook backend, none of them call MoneyKit.
+
+python -m app.bench jobs [--jobs N] [--processes N]
+python -m app.bench coalesce [--events N] [--links N] [--retries FRACTION]
+python -m app.bench verify [--webhooks N]
+python -m app.bench decode [--webhooks N]
+python -m app.bench flood [--seconds N] [--rate N] [--body-size BYTES] [--jwks-delay SECONDS]
+python -m app.bench rotation [--processes N] [--webhooks N] [--jwks-delay SECONDS]
+"""
+
+import argparse
+import asyncio
+import hashlib
+import http.server
+import json
+import multiprocessing
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Union
+
+import httpx
+import jwt
+import jwt.algorithms
+import moneykit.models
+import pydantic
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from app.client import JwksCache, MoneyKitWebHookVerifier
+from app.jobs import JobQueue, task
+from app.jwks_store import JwksStore
+from app.webhook_registry import WebhookRegistry
+from app.worker import start_workers
+
+
+@task
+def noop() -> None:
+    pass
+
+
+def bench_jobs(jobs: int, processes: int) -> None:
+    """Enqueue latency of the webhook handler's `.delay()` call and how fast the worker processes drain the queue."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = str(Path(tmp) / "jobs.sqlite3")
+        queue = JobQueue(path)
+
+        latencies = []
+        for _ in range(jobs):
+            started = time.perf_counter()
+            queue.enqueue(noop.name, {})
+            latencies.append(time.perf_counter() - started)
+        quantiles = statistics.quantiles(latencies, n=100)
+        print(f"enqueue: {jobs} jobs, p50 {quantiles[49] * 1000:.3f}ms, p99 {quantiles[98] * 1000:.3f}ms")
+
+        stop = multiprocessing.Event()
+        started = time.perf_counter()
+        workers = start_workers(processes, stop, path, queue.max_attempts, task_modules=["app.bench"])
+        while queue.counts().get("done", 0) < jobs:
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - started
+        stop.set()
+        for worker in workers:
+            worker.join()
+        print(f"run: {jobs} jobs, {processes} processes, {elapsed:.2f}s, {jobs / elapsed:,.0f} jobs/sec")
+
+
+def bench_coalesce(events: int, links: int, retries: float) -> None:
+    """Replay a burst of `transactions.updates_available` webhooks, some retried, and count the syncs enqueued."""
+    with tempfile.TemporaryDirectory() as tmp:
+        queue = JobQueue(str(Path(tmp) / "jobs.sqlite3"))
+        idempotency_keys: list[str] = []
+        started = time.perf_counter()
+        for i in range(events):
+            if idempotency_keys and random.random() < retries:
+                idempotency_key = random.choice(idempotency_keys)
+            else:
+                idempotency_key = f"idempotency_key_{i}"
+                idempotency_keys.append(idempotency_key)
+            link_id = f"mk_link_{random.randrange(links)}"
+            # Same as the webhook handler does for `transactions.updates_available`.
+            with queue.transaction():
+                if not queue.mark_seen(idempotency_key):
+                    queue.enqueue("sync_transactions", {"link_id": link_id}, delay=10, coalesce_key=link_id)
+        elapsed = time.perf_counter() - started
+
+        queued = queue.counts().get("queued", 0)
+        counts = queue.coalescing_counts()
+        print(f"{events} webhooks in {elapsed:.2f}s ({events / elapsed:,.0f}/sec) for {links} links")
+        print(f"{counts['duplicates']} duplicates ignored, {counts['coalesced']} coalesced, {queued} syncs queued")
+
+
+def bench_verify(webhooks: int) -> None:
+    """Per webhook verify latency, parsing the JWK for every webhook versus using the cached key object."""
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    jwk = json.loads(jwt.algorithms.ECAlgorithm.to_jwk(private_key.public_key()))
+    jwk["kid"] = "bench_kid"
+
+    body = json.dumps({"webhook_event": "transactions.updates_available", "link_id": "mk_bench_link"}).encode()
+    token = jwt.encode(
+        {"request_body_sha256": hashlib.sha256(body).hexdigest(), "iat": int(time.time())},
+        private_key,
+        algorithm="ES256",
+        headers={"kid": jwk["kid"]},
+    )
+
+    def parse_every_time() -> None:
+        # What `MoneyKitWebHookVerifier` used to do for every webhook.
+        key = jwt.algorithms.ECAlgorithm.from_jwk(jwk)
+        decoded = jwt.decode(token, key, algorithms=["ES256"])
+        assert decoded["request_body_sha256"] == hashlib.sha256(body).hexdigest()
+
+    cache = JwksCache(host="")
+    cache.update([jwk])
+    verifier = MoneyKitWebHookVerifier(cache)
+
+    def cached_key() -> None:
+        # What runs in a worker thread for every webhook now, after looking up the key.
+        key = cache.get(jwk["kid"])
+        assert key is not None
+        verifier.verify_signed_request(token, key, body)
+
+    for name, verify in [("parse every time", parse_every_time), ("cached key", cached_key)]:
+        p50, p99 = _latency_quantiles(verify, webhooks)
+        print(f"{name}: {webhooks} webhooks, p50 {p50 * 1000:.3f}ms, p99 {p99 * 1000:.3f}ms")
+
+
+def bench_decode(webhooks: int) -> None:
+    """Webhooks/sec on one core, building a `TypeAdapter` for every webhook versus the compiled `WebhookRegistry`."""
+    common = {
+        "webhook_major_version": 1,
+        "webhook_minor_version": 0,
+        "webhook_timestamp": "2024-01-01T00:00:00Z",
+        "link_id": "mk_bench_link",
+        "link_tags": ["bench"],
+    }
+    payloads = [
+        json.dumps({**common, **payload, "webhook_idempotency_key": f"bench_{i}"}).encode()
+        for i, payload in enumerate(
+            [
+                {"webhook_event": "link.state_changed", "state": "connected"},
+                {
+                    "webhook_event": "link.product_refresh",
+                    "product": "transactions",
+                    "state": "completed",
+                    "state_changed_at": "2024-01-01T00:00:00Z",
+                },
+                {"webhook_event": "transactions.updates_available", "has_history": True},
+            ]
+        )
+    ]
+    models = [
+        moneykit.models.AppLinkStateChangedWebhook,
+        moneykit.models.ProductStateChangedWebhook,
+        moneykit.models.TransactionUpdatesAvailableWebhook,
+    ]
+
+    def adapter_per_webhook(body: bytes) -> None:
+        # What the webhook handler used to do, without the discriminator which this SDK's models don't support.
+        pydantic.TypeAdapter(Union[tuple(models)]).validate_json(body)
+
+    registry = WebhookRegistry()
+    for model in models:
+        registry.handler(model.model_fields["webhook_event"].default, 1, model)(lambda webhook: None)
+
+    def compiled(body: bytes) -> None:
+        decoded = registry.decode(body)
+        assert decoded is not None
+        decoded.handle()
+
+    for name, decode in [("adapter per webhook", adapter_per_webhook), ("compiled registry", compiled)]:
+        started = time.perf_counter()
+        for i in range(webhooks):
+            decode(payloads[i % len(payloads)])
+        elapsed = time.perf_counter() - started
+        print(f"{name}: {webhooks} webhooks, {webhooks / elapsed:,.0f} webhooks/sec")
+
+
+def bench_flood(seconds: float, rate: float, body_size: int, jwks_delay: float, app_dir: str) -> None:
+    """Health check latency of a running backend while it receives `rate` signed webhooks per second.
+
+    The backend can't fetch the JWKS at startup so the first webhook has to, and the fake JWKS endpoint takes
+    `jwks_delay` seconds to respond. Each webhook carries a valid signature for a different body so it is
+    fully verified and then rejected, which keeps the job queue out of the measurement.
+    """
+    old_key, new_key = ec.generate_private_key(ec.SECP256R1()), ec.generate_private_key(ec.SECP256R1())
+    old_jwk = json.loads(jwt.algorithms.ECAlgorithm.to_jwk(old_key.public_key()))
+    old_jwk["kid"] = "bench_old_kid"
+    new_jwk = json.loads(jwt.algorithms.ECAlgorithm.to_jwk(new_key.public_key()))
+    new_jwk["kid"] = "bench_new_kid"
+    token = jwt.encode(
+        {"request_body_sha256": hashlib.sha256(b"").hexdigest(), "iat": int(time.time())},
+        new_key,
+        algorithm="ES256",
+        headers={"kid": new_jwk["kid"]},
+    )
+    body = b"x" * body_size
+
+    # Stands in for MoneyKit. Fetching the JWKS at startup fails so the first webhook has to fetch it.
+    handler = _fake_moneykit_handler([None, {"keys": [old_jwk, new_jwk]}], jwks_delay)
+    fake_moneykit = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=fake_moneykit.serve_forever, daemon=True).start()
+
+    port = _free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {
+            **os.environ,
+            "MONEYKIT_URL": f"http://127.0.0.1:{fake_moneykit.server_port}",
+            "MONEYKIT_CLIENT_ID": "bench",
+            "MONEYKIT_CLIENT_SECRET": "bench",
+            "JOB_QUEUE_PATH": str(Path(tmp) / "jobs.sqlite3"),
+            "JWKS_STORE_PATH": str(Path(tmp) / "jwks.sqlite3"),
+            "LOG_LEVEL": "CRITICAL",
+        }
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--app-dir", app_dir, "--port", str(port)],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            asyncio.run(_flood(f"http://127.0.0.1:{port}", seconds, rate, token, body))
+        finally:
+            server.terminate()
+            server.wait()
+            fake_moneykit.shutdown()
+
+
+def bench_rotation(processes: int, webhooks: int, jwks_delay: float) -> None:
+    """JWKS fetches when every backend process receives a burst of webhooks, half signed with a key MoneyKit just
+    rotated to and half with made up `kid`s, with the keys and refresh rate limit per process versus shared."""
+    rotated_key = ec.generate_private_key(ec.SECP256R1())
+    rotated_jwk = json.loads(jwt.algorithms.ECAlgorithm.to_jwk(rotated_key.public_key()))
+    rotated_jwk["kid"] = "bench_rotated_kid"
+    fetches = multiprocessing.Value("i", 0)
+
+    class CountingHandler(_fake_moneykit_handler([{"keys": [rotated_jwk]}], jwks_delay)):
+        def do_GET(self) -> None:
+            with fetches.get_lock():
+                fetches.value += 1
+            super().do_GET()
+
+    fake_moneykit = http.server.ThreadingHTTPServer(("127.0.0.1", 0), CountingHandler)
+    threading.Thread(target=fake_moneykit.serve_forever, daemon=True).start()
+    host = f"http://127.0.0.1:{fake_moneykit.server_port}"
+    try:
+        for name, shared in [("per process", False), ("shared store", True)]:
+            fetches.value = 0
+            with tempfile.TemporaryDirectory() as tmp:
+                store_path = str(Path(tmp) / "jwks.sqlite3") if shared else ""
+                found = multiprocessing.Value("i", 0)
+                start = multiprocessing.Barrier(processes)
+                workers = [
+                    multiprocessing.Process(
+                        target=_rotation_worker, args=(host, store_path, webhooks, start, found, rotated_jwk["kid"])
+                    )
+                    for _ in range(processes)
+                ]
+                started = time.perf_counter()
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+                elapsed = time.perf_counter() - started
+            print(
+                f"{name}: {processes} processes x {webhooks} webhooks in {elapsed:.2f}s, {fetches.value} JWKS fetches, "
+                f"rotated key found for {found.value} of {processes * webhooks // 2}"
+            )
+    finally:
+        fake_moneykit.shutdown()
+
+
+def _rotation_worker(host: str, store_path: str, webhooks: int, start: Any, found: Any, rotated_kid: str) -> None:
+    cache = JwksCache(host, JwksStore(store_path) if store_path else None)
+    kids = [rotated_kid if i % 2 == 0 else f"bench_spoofed_kid_{i}" for i in range(webhooks)]
+
+    async def look_up_all() -> int:
+        keys = await asyncio.gather(*(cache.get_or_refresh(kid) for kid in kids))
+        return sum(key is not None for key in keys)
+
+    start.wait()
+    count = asyncio.run(look_up_all())
+    with found.get_lock():
+        found.value += count
+
+
+async def _flood(url: str, seconds: float, rate: float, token: str, body: bytes) -> None:
+    headers = {
+        "MoneyKit-Signature": token,
+        "MoneyKit-Delivery-Token": "bench",
+        "MoneyKit-Delivery-Attempt": "1",
+    }
+    async with httpx.AsyncClient(base_url=url, limits=httpx.Limits(max_connections=None), timeout=60) as client:
+        await _wait_until_up(client)
+        idle = await _health_check_latencies(client, seconds / 2)
+
+        async def send_webhooks() -> list[float]:
+            latencies: list[float] = []
+
+            async def send() -> None:
+                started = time.perf_counter()
+                await client.post("/webhook-handler", content=body, headers=headers)
+                latencies.append(time.perf_counter() - started)
+
+            # Open loop: webhooks keep arriving at `rate` however slowly the backend responds.
+            async with asyncio.TaskGroup() as group:
+                deadline = time.monotonic() + seconds
+                while time.monotonic() < deadline:
+                    group.create_task(send())
+                    await asyncio.sleep(1 / rate)
+            return latencies
+
+        webhooks_task = asyncio.create_task(send_webhooks())
+        flooded = await _health_check_latencies(client, seconds)
+        webhooks = await webhooks_task
+
+    for name, latencies in [("health check idle", idle), ("health check flooded", flooded), ("webhook", webhooks)]:
+        quantiles = statistics.quantiles(latencies, n=100)
+        print(
+            f"{name}: p50 {quantiles[49] * 1000:.1f}ms, p99 {quantiles[98] * 1000:.1f}ms, max {max(latencies) * 1000:.1f}ms"
+        )
+    print(f"{len(webhooks)} webhooks at {rate:,.0f}/sec, {len(body):,} byte bodies")
+
+
+async def _wait_until_up(client: httpx.AsyncClient) -> None:
+    for _ in range(100):
+        try:
+            await client.get("/health-check")
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("Backend didn't start")
+
+
+async def _health_check_latencies(client: httpx.AsyncClient, seconds: float) -> list[float]:
+    latencies = []
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        await client.get("/health-check")
+        latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(0.01)
+    return latencies
+
+
+def _fake_moneykit_handler(
+    jwks_responses: list[dict[str, Any] | None], jwks_delay: float
+) -> type[http.server.BaseHTTPRequestHandler]:
+    """Serves each of `jwks_responses` in turn, repeating the last one, after waiting `jwks_delay` seconds. `None`
+    responds with a 503.
+
+    Also hands out access tokens, for backends that authenticate before fetching the JWKS.
+    """
+    responses = iter(jwks_responses)
+    latest = jwks_responses[0]
+
+    class FakeMoneyKitHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            nonlocal latest
+            latest = next(responses, latest)
+            time.sleep(jwks_delay)
+            if latest is None:
+                self._respond(503, {})
+            else:
+                self._respond(200, latest)
+
+        def do_POST(self) -> None:
+            self._respond(201, {"access_token": "bench", "token_type": "Bearer", "expires_in": 3600})
+
+        def _respond(self, status: int, body: dict[str, Any]) -> None:
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+    return FakeMoneyKitHandler
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _latency_quantiles(func: Callable[[], None], n: int) -> tuple[float, float]:
+    latencies = []
+    for _ in range(n):
+        started = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - started)
+    quantiles = statistics.quantiles(latencies, n=100)
+    return quantiles[49], quantiles[98]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    jobs_parser = commands.add_parser("jobs", help=bench_jobs.__doc__)
+    jobs_parser.add_argument("--jobs", type=int, default=5000)
+    jobs_parser.add_argument("--processes", type=int, default=2)
+
+    coalesce_parser = commands.add_parser("coalesce", help=bench_coalesce.__doc__)
+    coalesce_parser.add_argument("--events", type=int, default=10000)
+    coalesce_parser.add_argument("--links", type=int, default=50)
+    coalesce_parser.add_argument("--retries", type=float, default=0.1)
+
+    verify_parser = commands.add_parser("verify", help=bench_verify.__doc__)
+    verify_parser.add_argument("--webhooks", type=int, default=5000)
+
+    decode_parser = commands.add_parser("decode", help=bench_decode.__doc__)
+    decode_parser.add_argument("--webhooks", type=int, default=20000)
+
+    flood_parser = commands.add_parser("flood", help=bench_flood.__doc__)
+    flood_parser.add_argument("--seconds", type=float, default=10)
+    flood_parser.add_argument("--rate", type=float, default=100)
+    flood_parser.add_argument("--body-size", type=int, default=64 * 1024)
+    flood_parser.add_argument("--jwks-delay", type=float, default=1.0)
+    # Lets the same load run against another checkout of the backend, e.g. to compare with an older version.
+    flood_parser.add_argument("--app-dir", default=".")
+
+    rotation_parser = commands.add_parser("rotation", help=bench_rotation.__doc__)
+    rotation_parser.add_argument("--processes", type=int, default=8)
+    rotation_parser.add_argument("--webhooks", type=int, default=1000)
+    rotation_parser.add_argument("--jwks-delay", type=float, default=0.1)
+
+    args = parser.parse_args()
+    if args.command == "jobs":
+        bench_jobs(args.jobs, args.processes)
+    elif args.command == "coalesce":
+        bench_coalesce(args.events, args.links, args.retries)
+    elif args.command == "verify":
+        bench_verify(args.webhooks)
+    elif args.command == "decode":
+        bench_decode(args.webhooks)
+    elif args.command == "flood":
+        bench_flood(args.seconds, args.rate, args.body_size, args.jwks_delay, args.app_dir)
+    elif args.command == "rotation":
+        bench_rotation(args.processes, args.webhooks, args.jwks_delay)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,49 +1,195 @@
+import asyncio
+import dataclasses
 import functools
 import hashlib
 import hmac
 import logging
+import threading
+import time
 from datetime import datetime, timedelta
-from typing import ClassVar
+from typing import Any
 
+import anyio.to_thread
+import httpx
 import jwt
 import jwt.algorithms
 import moneykit
 import moneykit.models
+import moneykit.rest
 from cachetools import TTLCache
 
+from app import metrics
+from app.jwks_store import JwksStore
+from app.ratelimit import RequestScheduler, classify
 from app.settings import get_settings
 
 logger = logging.getLogger("example.mk_client")
 
 
+# Fetch a new token this many seconds before the current one expires so a request never goes out with an expired one.
+REFRESH_MARGIN_SECONDS = 300
+EXPIRED_ACCESS_TOKEN_ERROR = b"api_error.auth.expired_access_token"
+
+
+@dataclasses.dataclass
+class AccessTokenMetrics:
+    fetches: int = 0
+    expired_token_retries: int = 0
+    last_fetch_seconds: float = 0.0
+    total_fetch_seconds: float = 0.0
+
+
+class AccessTokenManager:
+    """Hands out a MoneyKit bearer token, fetching a new one shortly before the current one expires.
+
+    Fetching is single flight: when the token needs refreshing one thread calls `/auth/token` and any other threads
+    wait for its result instead of each fetching their own.
+    """
+
+    def __init__(self, host: str, client_id: str, client_secret: str) -> None:
+        # Token requests get their own plain client so they don't go through `RefreshingApiClient` themselves.
+        config = moneykit.Configuration(host=host)
+        self._access_token_api = moneykit.AccessTokenApi(moneykit.ApiClient(config))
+        self._host = host
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._lock = threading.Lock()
+        self._access_token = ""
+        self._refresh_at = 0.0
+        self.metrics = AccessTokenMetrics()
+
+    def get_access_token(self) -> str:
+        if time.monotonic() >= self._refresh_at:
+            with self._lock:
+                # Another thread may have fetched a token while this one was waiting for the lock.
+                if time.monotonic() >= self._refresh_at:
+                    self._fetch_access_token()
+        return self._access_token
+
+    def invalidate(self, access_token: str) -> None:
+        """MoneyKit rejected `access_token` as expired, the request is retried with a new one.
+
+        Makes the next `get_access_token` fetch a new token, unless `access_token` has already been replaced.
+        """
+        with self._lock:
+            self.metrics.expired_token_retries += 1
+            if access_token == self._access_token:
+                self._refresh_at = 0.0
+
+    def _fetch_access_token(self) -> None:
+        logger.debug(f"Authenticating to {self._host} as {self._client_id}")
+        started = time.perf_counter()
+        response = self._access_token_api.create_access_token(
+            client_id=self._client_id,
+            client_secret=self._client_secret,
+            grant_type="client_credentials",
+        )
+        elapsed = time.perf_counter() - started
+
+        self.metrics.fetches += 1
+        self.metrics.last_fetch_seconds = elapsed
+        self.metrics.total_fetch_seconds += elapsed
+        logger.debug(
+            f"Token will expire in {response.expires_in}s, fetched in {elapsed * 1000:.0f}ms",
+        )
+
+        self._access_token = response.access_token
+        margin = min(REFRESH_MARGIN_SECONDS, response.expires_in // 2)
+        self._refresh_at = time.monotonic() + response.expires_in - margin
+
+
+class RefreshingApiClient(moneykit.ApiClient):
+    """An `ApiClient` that authenticates every request with the current token from an `AccessTokenManager`.
+
+    If MoneyKit still rejects a token as expired (e.g. the clock drifted or it was revoked) the request is retried once
+    with a newly fetched token.
+
+    Every request is also paced by a `RequestScheduler` and retried when MoneyKit responds `429 Too Many Requests`.
+    """
+
+    def __init__(
+        self,
+        configuration: moneykit.Configuration,
+        token_manager: AccessTokenManager,
+        scheduler: RequestScheduler | None = None,
+    ) -> None:
+        super().__init__(configuration)
+        self.token_manager = token_manager
+        self.scheduler = scheduler or RequestScheduler()
+        self._endpoint = threading.local()
+
+    def param_serialize(self, method: str, resource_path: str, *args: Any, **kwargs: Any) -> tuple:
+        self.configuration.access_token = self.token_manager.get_access_token()
+        # The SDK calls `call_api` next, on the same thread, by which point the path's parameters are filled in.
+        self._endpoint.name = f"{method} {resource_path}"
+        return super().param_serialize(method, resource_path, *args, **kwargs)
+
+    def call_api(
+        self,
+        method: str,
+        url: str,
+        header_params: dict | None = None,
+        body: Any = None,
+        post_params: Any = None,
+        _request_timeout: Any = None,
+    ) -> moneykit.rest.RESTResponse:
+        response = self._call_api_rate_limited(method, url, header_params, body, post_params, _request_timeout)
+        if response.status == 401 and header_params and EXPIRED_ACCESS_TOKEN_ERROR in (response.read() or b""):
+            self.token_manager.invalidate(header_params["Authorization"].removeprefix("Bearer "))
+            header_params = {**header_params, "Authorization": f"Bearer {self.token_manager.get_access_token()}"}
+            response = self._call_api_rate_limited(method, url, header_params, body, post_params, _request_timeout)
+        return response
+
+    def _call_api_rate_limited(
+        self,
+        method: str,
+        url: str,
+        header_params: dict | None,
+        body: Any,
+        post_params: Any,
+        _request_timeout: Any,
+    ) -> moneykit.rest.RESTResponse:
+        endpoint_class, link_id = classify(method, url)
+        endpoint = getattr(self._endpoint, "name", method)
+        attempt = 0
+        while True:
+            self.scheduler.acquire(endpoint_class, link_id)
+            status = "error"
+            started = time.perf_counter()
+            try:
+                with metrics.span(f"MoneyKit {endpoint}"):
+                    response = super().call_api(method, url, header_params, body, post_params, _request_timeout)
+                status = str(response.status)
+            finally:
+                metrics.MONEYKIT_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint, status)
+            if response.status != 429 or attempt >= self.scheduler.max_retries:
+                return response
+            attempt += 1
+            delay = self.scheduler.throttled(endpoint_class, response.getheader("Retry-After"), attempt)
+            logger.info(f"{method} {url} was rate limited, retry {attempt} in {delay:.2f}s")
+
+
 @functools.lru_cache
-def moneykit_client() -> moneykit.ApiClient:
-    """Generates a Bearer token from your client id and secret to access MoneyKit.
+def moneykit_client() -> RefreshingApiClient:
+    """Creates a client that authenticates to MoneyKit with your client id and secret.
 
-    This bearer token will expire. This method does not show regenerating the token on/before expiry for simplicity.
+    The bearer token is fetched on the first request and fetched again shortly before it expires, or if MoneyKit
+    responds with an `api_error.auth.expired_access_token` error code.
 
     :returns: An authenticated client
     """
     settings = get_settings()
 
-    # Generate a bearer access token that is valid for 60 minutes.
-    # This client _should_ be cached to avoid regenerating a token on every request.
-    # The bearer token should be regenerated before expiry or after a `api_error.auth.expired_access_token` error code
-    # is returned by a request.
-
     config = moneykit.Configuration(host=settings.moneykit_url)
-    api_client = moneykit.ApiClient(config)
-
-    logger.debug(f"Authenticating to {settings.moneykit_url} as {settings.moneykit_client_id}")
-    access_token_api = moneykit.AccessTokenApi(api_client)
-    response = access_token_api.create_access_token(
-        client_id=settings.moneykit_client_id,
-        client_secret=settings.moneykit_client_secret.get_secret_value(),
-        grant_type="client_credentials",
+    token_manager = AccessTokenManager(
+        settings.moneykit_url,
+        settings.moneykit_client_id,
+        settings.moneykit_client_secret.get_secret_value(),
     )
-
-    logger.debug(f"Token will expire in {response.expires_in} seconds")
-    api_client.configuration.access_token = response.access_token
+    api_client = RefreshingApiClient(config, token_manager)
+    # urllib3 only keeps 1 connection per host alive by default, concurrent requests would open and throw away a new
+    # connection each time.
+    api_client.rest_client.pool_manager.connection_pool_kw["maxsize"] = settings.moneykit_max_connections
     return api_client
 
 
@@ -51,25 +197,156 @@ class MoneyKitWebHookVerificationError(Exception):
     pass
 
 
-class MoneyKitWebHookVerifier:
+class JwksCache:
+    """MoneyKit's webhook signing keys, parsed into public key objects, by key id.
+
+    The whole JWKS is fetched by `refresh_if_allowed` which the app calls at startup and then periodically from a
+    background task (see `app.main.lifespan`), well within the 12 hour TTL of each key. A webhook should therefore
+    always find its key already parsed in the cache, and only a key that MoneyKit started using since the last refresh
+    triggers a fetch.
+
+    With a `JwksStore` the fetched keys and the refresh rate limit are shared with the other backend processes, see
+    `app/jwks_store.py`. Without one they are per process.
+    """
+
     # It is recommended that your application caches the public key for a given key ID, but for no more than 24
     # hours. This reduces the likelihood of using an expired key to validate incoming webhooks.
     # We rotate webhook sig keys regularly
-    _key_cache: ClassVar[TTLCache[str, dict]] = TTLCache(maxsize=20, ttl=timedelta(hours=12).total_seconds())
+    TTL = timedelta(hours=12)
     # To avoid malicious requests triggering cache invalidations there needs to be some kind of grace time or other
     # logic for determining the validity of the invalidation. This example only allows cache invalidations every 5
     # minutes.
-    _cache_refreshed_at: datetime = datetime.min
+    MIN_REFRESH_INTERVAL = timedelta(minutes=5)
+    # After a failed fetch, e.g. at startup, allow another one sooner.
+    FAILED_REFRESH_BACKOFF = timedelta(seconds=10)
+
+    def __init__(self, host: str, store: JwksStore | None = None) -> None:
+        self._host = host
+        self._store = store
+        self._keys: TTLCache[str, jwt.algorithms.AllowedECKeys] = TTLCache(maxsize=20, ttl=self.TTL.total_seconds())
+        self._lock = threading.Lock()
+        # Webhooks that miss the cache at the same time wait for a single fetch instead of each starting one.
+        self._refresh_lock = asyncio.Lock()
+        # Only used without a store, the store keeps the shared equivalent.
+        self.refresh_allowed_at = datetime.min
+
+    def get(self, kid: str) -> jwt.algorithms.AllowedECKeys | None:
+        with self._lock:
+            return self._keys.get(kid)
+
+    async def refresh_if_allowed(self) -> bool:
+        """Fetch the JWKS unless this or, with a store, any process fetched it within `MIN_REFRESH_INTERVAL`.
 
-    def __init__(self, client: moneykit.ApiClient) -> None:
-        self._client = client
+        The keys another process fetched are loaded from the store instead, after waiting for the fetch if it is still
+        in progress.
+
+        The store is SQLite, whose calls can wait for another process's write lock, so they run in a worker thread
+        rather than on the event loop.
+
+        :returns: Whether the JWKS was fetched.
+        """
+        if self._store is not None:
+            claimed = await anyio.to_thread.run_sync(
+                self._store.claim_refresh, self.FAILED_REFRESH_BACKOFF.total_seconds()
+            )
+        else:
+            claimed = datetime.now() >= self.refresh_allowed_at
+            if claimed:
+                self._hold_refresh(self.FAILED_REFRESH_BACKOFF)
+        if not claimed:
+            metrics.JWKS_REFRESHES.inc("rate_limited")
+            # Rejecting webhooks signed with a rotated key until the other process is done would make MoneyKit retry
+            # them all. The wait is bounded by the claim running out, see `JwksStore.claim_refresh`.
+            while self._store is not None and await anyio.to_thread.run_sync(self._store.fetch_in_progress):
+                await asyncio.sleep(0.02)
+            await anyio.to_thread.run_sync(self.load_shared)
+            return False
+        await self._fetch()
+        return True
 
-    def verify_moneykit_webhook_request(self, verification_token: str | None, request_body: bytes) -> None:
+    def load_shared(self) -> bool:
+        """Parse the keys other processes stored since this was last called on this thread.
+
+        :returns: Whether the store had changed.
+        """
+        if self._store is None or not self._store.changed():
+            return False
+        fetched_since = time.time() - self.TTL.total_seconds()
+        with self._lock:
+            known = set(self._keys)
+        self.update([jwk for jwk in self._store.keys(fetched_since) if jwk["kid"] not in known])
+        return True
+
+    def update(self, jwks: list[dict[str, Any]]) -> None:
+        # Parse once here rather than for every webhook.
+        keys = {jwk["kid"]: jwt.algorithms.ECAlgorithm.from_jwk(jwk) for jwk in jwks}
+        with self._lock:
+            self._keys.update(keys)
+
+    async def get_or_refresh(self, kid: str) -> jwt.algorithms.AllowedECKeys | None:
+        """Look up `kid`, fetching the JWKS again if it's unknown and it wasn't refreshed recently."""
+        key = self.get(kid)
+        if key is not None:
+            metrics.JWKS_CACHE_LOOKUPS.inc("hit")
+            return key
+        if await anyio.to_thread.run_sync(self.load_shared):
+            key = self.get(kid)
+            if key is not None:
+                metrics.JWKS_CACHE_LOOKUPS.inc("shared")
+                return key
+        metrics.JWKS_CACHE_LOOKUPS.inc("miss")
+        async with self._refresh_lock:
+            # Another webhook may have refreshed the cache while we waited.
+            key = self.get(kid)
+            if key is None:
+                logger.info(f"Invalidating JWK cache. {kid} not found from previous cache.")
+                await self.refresh_if_allowed()
+                key = self.get(kid)
+        return key
+
+    async def _fetch(self) -> None:
+        try:
+            # The JWKS endpoint needs no access token. This is rare enough that a client per fetch is fine.
+            async with httpx.AsyncClient(base_url=self._host, timeout=5) as client:
+                response = await client.get("/.well-known/jwks.json")
+                response.raise_for_status()
+            jwks = response.json()["keys"]
+            self.update(jwks)
+        except Exception:
+            metrics.JWKS_REFRESHES.inc("error")
+            if self._store is not None:
+                await anyio.to_thread.run_sync(self._store.release_refresh, self.FAILED_REFRESH_BACKOFF.total_seconds())
+            raise
+        metrics.JWKS_REFRESHES.inc("success")
+        if self._store is not None:
+            await anyio.to_thread.run_sync(self._store.save, jwks, self.MIN_REFRESH_INTERVAL.total_seconds())
+        self.refresh_allowed_at = datetime.now() + self.MIN_REFRESH_INTERVAL
+        logger.info(f"Refreshed JWK cache {[jwk['kid'] for jwk in jwks]}")
+
+    def _hold_refresh(self, interval: timedelta) -> None:
+        self.refresh_allowed_at = datetime.now() + interval
+
+
+@functools.lru_cache
+def jwks_cache() -> JwksCache:
+    settings = get_settings()
+    store = JwksStore(settings.jwks_store_path) if settings.jwks_store_path else None
+    return JwksCache(settings.moneykit_url, store)
+
+
+class MoneyKitWebHookVerifier:
+    def __init__(self, cache: JwksCache) -> None:
+        self._cache = cache
+
+    async def verify_moneykit_webhook_request(self, verification_token: str | None, request_body: bytes) -> None:
         """This verifies the authenticity of an incoming webhook request from moneykit.
 
         Moneykit supplies a verification token in the header which can be compared with your own computed value using
         the raw request body.
 
+        Only looking up the signing key happens on the event loop. Checking the signature and hashing the body are CPU
+        bound and run in a worker thread so other requests aren't held up by them.
+
         Args:
             verification_token (str | None): Value from incoming webhook's `MoneyKit-Signature` HTTP header.
             request_body (bytes): Raw incoming webhook request body.
@@ -77,7 +354,22 @@ class MoneyKitWebHookVerifier:
         Raises:
             MoneyKitWebHookVerificationError: For invalid or expired tokens or when the hashes do not match.
         """
-        expected_request_body_hash = self.verify_moneykit_webhook_token(verification_token)
+        if not verification_token:
+            raise MoneyKitWebHookVerificationError("Invalid MoneyKit verification")
+        key = await self._get_key_for_token(verification_token)
+        await anyio.to_thread.run_sync(self.verify_signed_request, verification_token, key, request_body)
+
+    def verify_signed_request(
+        self, verification_token: str, key: jwt.algorithms.AllowedECKeys, request_body: bytes
+    ) -> None:
+        """Verify `verification_token` with `key` and check it holds the SHA256 of `request_body`."""
+        with metrics.WEBHOOK_VERIFY_SECONDS.time(), metrics.span("Verify webhook"):
+            self._verify_signed_request(verification_token, key, request_body)
+
+    def _verify_signed_request(
+        self, verification_token: str, key: jwt.algorithms.AllowedECKeys, request_body: bytes
+    ) -> None:
+        expected_request_body_hash = self.verify_moneykit_webhook_token(verification_token, key)
         hasher = hashlib.sha256()
         hasher.update(request_body)
         actual_request_body_hash = hasher.hexdigest()
@@ -88,26 +380,13 @@ class MoneyKitWebHookVerifier:
                 f"{expected_request_body_hash=} {actual_request_body_hash=}"
             )
 
-    def verify_moneykit_webhook_token(self, verification_token: str | None) -> str:
-        """Fetches MoneyKit Json Web Key Set to discover the correct signing key for the verification token via `kid`
-        (Key Id) in the JWT header.
-
-        It then uses this key to decode and verfiy the `verification_token`. This token contains the expected SHA256 of
-        the request body.
+    def verify_moneykit_webhook_token(self, verification_token: str, key: jwt.algorithms.AllowedECKeys) -> str:
+        """Uses the signing key found via `kid` (Key Id) in the JWT header to decode and verfiy the
+        `verification_token`. This token contains the expected SHA256 of the request body.
 
         Returns
             str: SHA256 of the expected request data.
         """
-        if not verification_token:
-            raise MoneyKitWebHookVerificationError("Invalid MoneyKit verification")
-
-        header = jwt.get_unverified_header(verification_token)
-        alg = header["alg"]
-        if alg != "ES256":
-            raise MoneyKitWebHookVerificationError("Only ES256 algorithm is supported")
-        kid = header["kid"]
-        key = self._get_key_for_id(kid)
-
         try:
             decoded_token = jwt.decode(
                 verification_token,
@@ -125,18 +404,19 @@ class MoneyKitWebHookVerifier:
         except jwt.PyJWTError:
             raise MoneyKitWebHookVerificationError("Invalid token")
 
-    def _get_key_for_id(self, kid: str) -> jwt.algorithms.ECAlgorithm:
-        if kid not in self._key_cache:
-            if datetime.now() - timedelta(minutes=5) > self._cache_refreshed_at:
-                logger.info(f"Invalidating JWK cache. {kid} not found from previous cache.")
-                access_token_api = moneykit.AccessTokenApi(self._client)
-                jwks = access_token_api.get_well_known_jwks()
-                for jwk in jwks.keys:
-                    self._key_cache[jwk["kid"]] = jwk
-                self._cache_refreshed_at = datetime.now()
-        else:
-            logger.info(f"{kid} in cache")
+    async def _get_key_for_token(self, verification_token: str) -> jwt.algorithms.AllowedECKeys:
+        """Fetches MoneyKit Json Web Key Set if needed to discover the correct signing key for the verification token
+        via `kid` (Key Id) in the JWT header."""
+        try:
+            header = jwt.get_unverified_header(verification_token)
+        except jwt.PyJWTError:
+            raise MoneyKitWebHookVerificationError("Invalid token")
+        alg = header["alg"]
+        if alg != "ES256":
+            raise MoneyKitWebHookVerificationError("Only ES256 algorithm is supported")
+        kid = header["kid"]
 
-        key = self._key_cache[kid]
-        logger.info(f"Using JWK {kid}")
-        return jwt.algorithms.ECAlgorithm.from_jwk(key)
+        key = await self._cache.get_or_refresh(kid)
+        if key is None:
+            raise MoneyKitWebHookVerificationError(f"Unknown JWK {kid}")
+        return key
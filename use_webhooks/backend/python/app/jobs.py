@@ -0,0 +1,389 @@
+"""A small durable background job queue backed by SQLite.
+
+This stands in for Celery (or similar) without needing a broker: the webhook handler enqueues a job with a single
+`INSERT` and workers started with `python -m app.worker` pick it up.
+
+Delivery is at-least-once. A worker leases a job while running it, if the worker dies the lease runs out and another
+worker runs the job again. Failed jobs are retried with exponential backoff until `max_attempts` is reached. Jobs must
+therefore be safe to run more than once.
+
+Jobs enqueued with a `coalesce_key` are collapsed: while a job with that key is still queued, enqueueing it again only
+bumps the queued job's `coalesced` count. Together with a delay this debounces bursts of identical work.
+
+Finished jobs, done or dead, are deleted by the workers once they are `finished_retention_seconds` old. The number of
+jobs in each status and the coalescing counts reported by `/metrics` are kept up to date by triggers in a `counters`
+table, so reading them doesn't scan the jobs.
+"""
+
+import contextlib
+import functools
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Iterator, NamedTuple
+
+from app.settings import get_settings
+
+logger = logging.getLogger("example.jobs")
+
+STATUSES = ("queued", "running", "done", "dead")
+
+# Run in a single transaction, so the counters are seeded from the existing rows before any trigger can fire.
+_SCHEMA = """
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_at REAL NOT NULL,
+    locked_until REAL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    coalesce_key TEXT,
+    coalesced INTEGER NOT NULL DEFAULT 0,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, run_at);
+CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at) WHERE finished_at IS NOT NULL;
+-- At most one queued job per coalesce key, this is the conflict target used to coalesce in `enqueue`.
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_queued_coalesce_key ON jobs (coalesce_key) WHERE status = 'queued';
+
+CREATE TABLE IF NOT EXISTS seen_keys (
+    key TEXT PRIMARY KEY,
+    first_seen_at REAL NOT NULL,
+    times_seen INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS seen_keys_first_seen_at ON seen_keys (first_seen_at);
+
+-- The number of jobs in each status, enqueues coalesced into a queued job and keys seen more than once. Only seeded
+-- from the existing rows when the table is first created, `INSERT OR IGNORE` leaves existing counts alone.
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO counters (name, value) SELECT 'queued', count(*) FROM jobs WHERE status = 'queued';
+INSERT OR IGNORE INTO counters (name, value) SELECT 'running', count(*) FROM jobs WHERE status = 'running';
+INSERT OR IGNORE INTO counters (name, value) SELECT 'done', count(*) FROM jobs WHERE status = 'done';
+INSERT OR IGNORE INTO counters (name, value) SELECT 'dead', count(*) FROM jobs WHERE status = 'dead';
+INSERT OR IGNORE INTO counters (name, value) SELECT 'coalesced', coalesce(sum(coalesced), 0) FROM jobs;
+INSERT OR IGNORE INTO counters (name, value) SELECT 'duplicates', coalesce(sum(times_seen - 1), 0) FROM seen_keys;
+
+CREATE TRIGGER IF NOT EXISTS jobs_counters_insert AFTER INSERT ON jobs BEGIN
+    UPDATE counters SET value = value + 1 WHERE name = NEW.status;
+END;
+CREATE TRIGGER IF NOT EXISTS jobs_counters_status AFTER UPDATE OF status ON jobs WHEN OLD.status != NEW.status BEGIN
+    UPDATE counters SET value = value - 1 WHERE name = OLD.status;
+    UPDATE counters SET value = value + 1 WHERE name = NEW.status;
+END;
+CREATE TRIGGER IF NOT EXISTS jobs_counters_delete AFTER DELETE ON jobs BEGIN
+    UPDATE counters SET value = value - 1 WHERE name = OLD.status;
+END;
+CREATE TRIGGER IF NOT EXISTS jobs_counters_coalesced AFTER UPDATE OF coalesced ON jobs BEGIN
+    UPDATE counters SET value = value + NEW.coalesced - OLD.coalesced WHERE name = 'coalesced';
+END;
+CREATE TRIGGER IF NOT EXISTS seen_keys_counters_duplicate AFTER UPDATE OF times_seen ON seen_keys BEGIN
+    UPDATE counters SET value = value + 1 WHERE name = 'duplicates';
+END;
+COMMIT;
+"""
+
+
+class Job(NamedTuple):
+    id: int
+    name: str
+    payload: dict[str, Any]
+    attempts: int
+    coalesced: int
+
+
+class JobQueue:
+    """Enqueue, claim and settle jobs stored in a SQLite database.
+
+    A `JobQueue` keeps one connection per thread, so one instance can be shared by every request handler.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_attempts: int = 5,
+        lease_seconds: float = 300.0,
+        backoff_seconds: float = 2.0,
+        seen_keys_retention_seconds: float = 24 * 60 * 60,
+        finished_retention_seconds: float = 7 * 24 * 60 * 60,
+    ) -> None:
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.backoff_seconds = backoff_seconds
+        self.seen_keys_retention_seconds = seen_keys_retention_seconds
+        self.finished_retention_seconds = finished_retention_seconds
+        self._local = threading.local()
+        # SQLite allows one writer at a time. Threads of this process take turns on this lock rather than all polling
+        # SQLite's busy handler, which starves some of them when many webhooks arrive at once.
+        self._write_lock = threading.Lock()
+        connection = self._connection()
+        self._add_finished_at(connection)
+        try:
+            connection.executescript(_SCHEMA)
+        except BaseException:
+            # Otherwise a failed statement leaves this connection holding the write lock until it's closed.
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
+
+    def enqueue(self, name: str, payload: dict[str, Any], delay: float = 0.0, coalesce_key: str | None = None) -> int:
+        """Add a job that runs in `delay` seconds.
+
+        If a job with the same `coalesce_key` is already queued no job is added, the queued job's `coalesced` count is
+        incremented instead and it keeps its original `run_at`. Waiting for a quiet period instead could postpone the
+        job forever while events keep arriving.
+
+        :returns: The id of the added, or coalesced into, job.
+        """
+        now = time.time()
+        row = (
+            self._connection()
+            .execute(
+                """
+                INSERT INTO jobs (name, payload, run_at, created_at, coalesce_key) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (coalesce_key) WHERE status = 'queued' DO UPDATE SET coalesced = coalesced + 1
+                RETURNING id
+                """,
+                (name, json.dumps(payload), now + delay, now, coalesce_key),
+            )
+            .fetchone()
+        )
+        return row[0]
+
+    def mark_seen(self, key: str) -> bool:
+        """Record `key`, e.g. a webhook idempotency key, and return whether it had already been seen.
+
+        Keys are forgotten after `seen_keys_retention_seconds`.
+        """
+        now = time.time()
+        row = (
+            self._connection()
+            .execute(
+                """
+                INSERT INTO seen_keys (key, first_seen_at) VALUES (?, ?)
+                ON CONFLICT (key) DO UPDATE SET times_seen = times_seen + 1
+                RETURNING times_seen
+                """,
+                (key, now),
+            )
+            .fetchone()
+        )
+        # Pruning on every call would add a write to each webhook, an occasional sweep keeps the table small enough.
+        if random.random() < 0.01:
+            self._connection().execute(
+                "DELETE FROM seen_keys WHERE first_seen_at < ?", (now - self.seen_keys_retention_seconds,)
+            )
+        return row[0] > 1
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Run the calls made inside the block on this thread atomically."""
+        connection = self._connection()
+        with self._write_lock:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+                connection.execute("COMMIT")
+            except BaseException:
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                raise
+
+    def claim(self) -> Job | None:
+        """Lease the next due job, or a running job whose lease has run out because its worker went away."""
+        now = time.time()
+        row = (
+            self._connection()
+            .execute(
+                """
+                UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_until = :locked_until
+                WHERE id = (
+                    SELECT id FROM jobs
+                    WHERE (status = 'queued' AND run_at <= :now) OR (status = 'running' AND locked_until <= :now)
+                    ORDER BY run_at
+                    LIMIT 1
+                )
+                RETURNING id, name, payload, attempts, coalesced
+                """,
+                {"now": now, "locked_until": now + self.lease_seconds},
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return Job(id=row[0], name=row[1], payload=json.loads(row[2]), attempts=row[3], coalesced=row[4])
+
+    def complete(self, job: Job) -> None:
+        self._connection().execute(
+            "UPDATE jobs SET status = 'done', locked_until = NULL, finished_at = ? WHERE id = ?", (time.time(), job.id)
+        )
+
+    def fail(self, job: Job, error: str) -> None:
+        """Schedule a retry with exponential backoff and jitter, or give up once `max_attempts` is reached."""
+        if job.attempts >= self.max_attempts:
+            logger.error(f"Job {job.id} {job.name} failed {job.attempts} times, giving up: {error}")
+            self._connection().execute(
+                "UPDATE jobs SET status = 'dead', locked_until = NULL, last_error = ?, finished_at = ? WHERE id = ?",
+                (error, time.time(), job.id),
+            )
+            return
+
+        delay = self.backoff_seconds * 2 ** (job.attempts - 1) * random.uniform(0.5, 1.5)
+        logger.warning(f"Job {job.id} {job.name} failed, retrying in {delay:.1f}s: {error}")
+        try:
+            self._connection().execute(
+                "UPDATE jobs SET status = 'queued', run_at = ?, locked_until = NULL, last_error = ? WHERE id = ?",
+                (time.time() + delay, error, job.id),
+            )
+        except sqlite3.IntegrityError:
+            # The same work was enqueued again while this job ran, that queued job will do it.
+            self._connection().execute(
+                "UPDATE jobs SET status = 'done', locked_until = NULL, last_error = ?, finished_at = ? WHERE id = ?",
+                (f"{error} (superseded by a queued job)", time.time(), job.id),
+            )
+
+    def prune(self, batch_size: int = 1000) -> int:
+        """Delete done and dead jobs that finished more than `finished_retention_seconds` ago.
+
+        Deleted a batch at a time so the web process isn't kept waiting to enqueue while a large backlog is removed.
+
+        :returns: The number of jobs deleted.
+        """
+        cutoff = time.time() - self.finished_retention_seconds
+        deleted = 0
+        while True:
+            cursor = self._connection().execute(
+                "DELETE FROM jobs WHERE id IN (SELECT id FROM jobs WHERE finished_at < ? LIMIT ?)", (cutoff, batch_size)
+            )
+            deleted += cursor.rowcount
+            if cursor.rowcount < batch_size:
+                return deleted
+
+    def counts(self) -> dict[str, int]:
+        """The number of jobs in each status, read from `counters` rather than counted."""
+        rows = self._connection().execute(
+            f"SELECT name, value FROM counters WHERE name IN ({', '.join('?' * len(STATUSES))})", STATUSES
+        )
+        return dict(rows.fetchall())
+
+    def coalescing_counts(self) -> dict[str, int]:
+        """How many enqueues were coalesced into an already queued job and how many keys were seen more than once."""
+        rows = self._connection().execute("SELECT name, value FROM counters WHERE name IN ('coalesced', 'duplicates')")
+        return dict(rows.fetchall())
+
+    @staticmethod
+    def _add_finished_at(connection: sqlite3.Connection) -> None:
+        """Add `finished_at` to a queue created before jobs were pruned, so `_SCHEMA` can index it."""
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(jobs)")}
+        if not columns or "finished_at" in columns:
+            return
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # Another process may have added it while this one waited for the lock.
+            columns = {row[1] for row in connection.execute("PRAGMA table_info(jobs)")}
+            if "finished_at" not in columns:
+                connection.execute("ALTER TABLE jobs ADD COLUMN finished_at REAL")
+                # Their finish time wasn't recorded, keep them for the retention period from now.
+                connection.execute("UPDATE jobs SET finished_at = ? WHERE status IN ('done', 'dead')", (time.time(),))
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit, every statement above is atomic on its own.
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            # WAL lets the web process keep enqueueing while workers write, NORMAL only fsyncs at checkpoints.
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            self._local.connection = connection
+        return connection
+
+
+@functools.lru_cache
+def get_job_queue() -> JobQueue:
+    settings = get_settings()
+    return JobQueue(
+        settings.job_queue_path,
+        max_attempts=settings.job_max_attempts,
+        finished_retention_seconds=settings.job_retention_seconds,
+    )
+
+
+class Task:
+    """A function that can be run in the background by calling `.delay(**kwargs)`, similar to a Celery task."""
+
+    def __init__(self, func: Callable[..., None]) -> None:
+        self.func = func
+        self.name = func.__name__
+        functools.update_wrapper(self, func)
+
+    def __call__(self, **kwargs: Any) -> None:
+        self.func(**kwargs)
+
+    def delay(self, **kwargs: Any) -> int:
+        return get_job_queue().enqueue(self.name, kwargs)
+
+    def debounce(self, seconds: float, **kwargs: Any) -> int:
+        """Run in `seconds`, calls with the same arguments until then are coalesced into this one."""
+        coalesce_key = f"{self.name}:{json.dumps(kwargs, sort_keys=True)}"
+        return get_job_queue().enqueue(self.name, kwargs, delay=seconds, coalesce_key=coalesce_key)
+
+
+registry: dict[str, Task] = {}
+
+
+def task(func: Callable[..., None]) -> Task:
+    """Register `func` so workers can run it by name."""
+    registered = Task(func)
+    registry[registered.name] = registered
+    return registered
+
+
+def run_worker(
+    queue: JobQueue,
+    poll_interval: float = 0.2,
+    stop: Callable[[], bool] = lambda: False,
+    prune_interval: float = 60.0,
+) -> None:
+    """Claim and run jobs until `stop()` returns True, sleeping `poll_interval` seconds whenever the queue is empty.
+
+    While idle, old finished jobs are pruned at most every `prune_interval` seconds.
+    """
+    pruned_at = 0.0
+    while not stop():
+        job = queue.claim()
+        if job is None:
+            if time.monotonic() - pruned_at >= prune_interval:
+                pruned_at = time.monotonic()
+                deleted = queue.prune()
+                if deleted:
+                    logger.info(f"Deleted {deleted} finished jobs")
+            time.sleep(poll_interval)
+            continue
+
+        registered = registry.get(job.name)
+        if registered is None:
+            queue.fail(job, f"Unknown task {job.name}")
+            continue
+        if job.coalesced:
+            logger.info(f"Job {job.id} {job.name} runs for {job.coalesced + 1} coalesced requests")
+        try:
+            registered(**job.payload)
+        except Exception as err:
+            logger.exception(f"Job {job.id} {job.name} raised")
+            queue.fail(job, repr(err))
+        else:
+            queue.complete(job)
@@ -0,0 +1,111 @@
+"""MoneyKit's webhook signing keys and the JWKS refresh rate limit, shared by every backend process on a host.
+
+Each process still keeps its own parsed keys in a `JwksCache`, this SQLite database is only consulted when a webhook's
+`kid` isn't among them. The JWKS fetched by any process is written here, so the other processes pick up a rotated key
+without fetching it themselves. Permission to fetch is claimed with a single conditional `UPDATE`, which makes the
+rate limit global: a burst of webhooks with a new or made up `kid` costs one fetch across all processes, not one per
+process (or per request).
+
+Reads go through a memory map (`PRAGMA mmap_size`) and `PRAGMA data_version` tells a process whether another process
+has written since it last looked, so a miss for a `kid` that nobody has fetched doesn't read the keys again.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from typing import Any
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jwks (
+    kid TEXT PRIMARY KEY,
+    jwk TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+-- A single row, no process may fetch the JWKS before `allowed_at`. A process is fetching it until `fetching_until`.
+CREATE TABLE IF NOT EXISTS jwks_refresh (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    allowed_at REAL NOT NULL,
+    fetching_until REAL NOT NULL
+);
+INSERT OR IGNORE INTO jwks_refresh (id, allowed_at, fetching_until) VALUES (1, 0, 0);
+"""
+
+
+class JwksStore:
+    """Keeps one connection per thread, like `JobQueue`. Times are `time.time()` so they compare across processes."""
+
+    def __init__(self, path: str, mmap_bytes: int = 1 << 20) -> None:
+        self.path = path
+        self.mmap_bytes = mmap_bytes
+        self._local = threading.local()
+        self._connection().executescript(_SCHEMA)
+
+    def keys(self, fetched_since: float) -> list[dict[str, Any]]:
+        """The JWKs fetched at or after `fetched_since`."""
+        rows = self._connection().execute("SELECT jwk FROM jwks WHERE fetched_at >= ?", (fetched_since,)).fetchall()
+        return [json.loads(jwk) for (jwk,) in rows]
+
+    def changed(self) -> bool:
+        """Whether another connection wrote to the store since the last call on this thread.
+
+        The first call on a thread always returns True.
+        """
+        version = self._connection().execute("PRAGMA data_version").fetchone()[0]
+        changed = version != getattr(self._local, "data_version", None)
+        self._local.data_version = version
+        return changed
+
+    def claim_refresh(self, hold_seconds: float) -> bool:
+        """Take the right to fetch the JWKS, unless a process already did recently.
+
+        Fetching is then not allowed again for `hold_seconds`, or until `save` or `release_refresh` is called, and
+        `fetch_in_progress` is True in the meantime.
+        """
+        now = time.time()
+        cursor = self._connection().execute(
+            "UPDATE jwks_refresh SET allowed_at = ?, fetching_until = ? WHERE id = 1 AND allowed_at <= ?",
+            (now + hold_seconds, now + hold_seconds, now),
+        )
+        return cursor.rowcount == 1
+
+    def fetch_in_progress(self) -> bool:
+        row = self._connection().execute("SELECT fetching_until FROM jwks_refresh WHERE id = 1").fetchone()
+        return row[0] > time.time()
+
+    def save(self, jwks: list[dict[str, Any]], next_refresh_in: float) -> None:
+        """Store a freshly fetched JWKS and hold off the next fetch for `next_refresh_in` seconds."""
+        now = time.time()
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                """
+                INSERT INTO jwks (kid, jwk, fetched_at) VALUES (?, ?, ?)
+                ON CONFLICT (kid) DO UPDATE SET jwk = excluded.jwk, fetched_at = excluded.fetched_at
+                """,
+                [(jwk["kid"], json.dumps(jwk), now) for jwk in jwks],
+            )
+            connection.execute(
+                "UPDATE jwks_refresh SET allowed_at = ?, fetching_until = 0 WHERE id = 1", (now + next_refresh_in,)
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def release_refresh(self, retry_in: float) -> None:
+        """After a failed fetch, allow another one in `retry_in` seconds."""
+        self._connection().execute(
+            "UPDATE jwks_refresh SET allowed_at = ?, fetching_until = 0 WHERE id = 1", (time.time() + retry_in,)
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            connection.execute(f"PRAGMA mmap_size = {int(self.mmap_bytes)}")
+            self._local.connection = connection
+        return connection
@@ -0,0 +1,87 @@
+"""A read-through cache of each link's state, including the state of its products.
+
+Dashboards poll the same links over and over, so `GET /links/{link_id}` answers from this cache and only calls
+`LinksApi.get_link` on a miss. The `link.state_changed` and `link.product_refresh` webhook handlers invalidate the link,
+so the next read fetches its new state within moments of MoneyKit reporting the change. The TTL only bounds how stale a
+link can get if a webhook is missed or lands on another API process, each of which has its own cache.
+"""
+
+import dataclasses
+import functools
+import threading
+from typing import Callable
+
+import moneykit
+import moneykit.models
+from cachetools import TTLCache
+
+from app.client import moneykit_client
+from app.settings import get_settings
+
+
+@dataclasses.dataclass
+class LinkCacheMetrics:
+    hits: int = 0
+    misses: int = 0
+    invalidations: int = 0
+
+
+class LinkCache:
+    """Bounded both by age and size: links are dropped after `ttl_seconds` and, past `max_links`, the least recently
+    used link is evicted first."""
+
+    def __init__(
+        self,
+        fetch: Callable[[str], moneykit.models.LinkCommon],
+        max_links: int,
+        ttl_seconds: float,
+    ) -> None:
+        self._fetch = fetch
+        self._links: TTLCache[str, moneykit.models.LinkCommon] = TTLCache(maxsize=max_links, ttl=ttl_seconds)
+        # Fetches in flight per link. Only while a link is being fetched, `invalidate` bumps its version so the fetch
+        # doesn't put the state from before the change back into the cache. Both are dropped once its fetches finish.
+        self._fetching: dict[str, int] = {}
+        self._versions: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.metrics = LinkCacheMetrics()
+
+    def get(self, link_id: str) -> moneykit.models.LinkCommon:
+        with self._lock:
+            link = self._links.get(link_id)
+            if link is not None:
+                self.metrics.hits += 1
+                return link
+            self.metrics.misses += 1
+            self._fetching[link_id] = self._fetching.get(link_id, 0) + 1
+            version = self._versions.get(link_id, 0)
+
+        # Not holding the lock, other links are served while this one is fetched.
+        try:
+            link = self._fetch(link_id)
+            with self._lock:
+                if self._versions.get(link_id, 0) == version:
+                    self._links[link_id] = link
+            return link
+        finally:
+            with self._lock:
+                self._fetching[link_id] -= 1
+                if not self._fetching[link_id]:
+                    del self._fetching[link_id]
+                    self._versions.pop(link_id, None)
+
+    def invalidate(self, link_id: str) -> None:
+        with self._lock:
+            self.metrics.invalidations += 1
+            self._links.pop(link_id, None)
+            if link_id in self._fetching:
+                self._versions[link_id] = self._versions.get(link_id, 0) + 1
+
+
+def _get_link(link_id: str) -> moneykit.models.LinkCommon:
+    return moneykit.LinksApi(moneykit_client()).get_link(link_id)
+
+
+@functools.lru_cache
+def link_cache() -> LinkCache:
+    settings = get_settings()
+    return LinkCache(_get_link, settings.link_cache_max_links, settings.link_cache_ttl_seconds)
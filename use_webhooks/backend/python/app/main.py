@@ -1,18 +1,159 @@
+import asyncio
+import contextlib
+import dataclasses
 import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable
 
-from fastapi import FastAPI
+import anyio.to_thread
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
 
+from app import metrics
 from app.api.linking import router as linking_router
 from app.api.links import router as links_router
 from app.api.webhooks import router as webhooks_router
+from app.client import JwksCache, RefreshingApiClient, jwks_cache, moneykit_client
+from app.jobs import JobQueue, get_job_queue
+from app.link_cache import LinkCache, link_cache
+from app.link_data import LinkDataCache, link_data_cache
 from app.settings import get_settings
 
+logger = logging.getLogger("example.main")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    # Sync route handlers (and so every MoneyKit SDK call) run in this thread pool.
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = get_settings().moneykit_max_connections
+
+    # Create the job queue's tables now, rather than in whichever webhook threads reach `get_job_queue` first.
+    await anyio.to_thread.run_sync(get_job_queue)
+
+    # Fetch and parse the webhook signing keys before the first webhook arrives, then keep them fresh. Processes started
+    # together share one fetch, the others load the keys it stores.
+    cache = jwks_cache()
+    try:
+        await cache.refresh_if_allowed()
+    except Exception:
+        logger.exception("Failed to pre-warm the JWK cache, it will be fetched by the first webhook instead")
+    refresh_task = asyncio.create_task(_refresh_jwks_periodically(cache, get_settings().jwks_refresh_seconds))
+    yield
+    refresh_task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await refresh_task
+
+
+async def _refresh_jwks_periodically(cache: JwksCache, interval: float) -> None:
+    delay = interval
+    while True:
+        await asyncio.sleep(delay)
+        try:
+            await cache.refresh_if_allowed()
+            delay = interval
+        except Exception:
+            # Retry sooner so the cached keys don't reach their TTL.
+            delay = cache.MIN_REFRESH_INTERVAL.total_seconds()
+            logger.exception(f"Failed to refresh the JWK cache, retrying in {delay:.0f}s")
+
+
+def register_client_metrics(client: Callable[[], RefreshingApiClient]) -> None:
+    """Export the token manager's and rate limiter's own metrics, read from `client()` whenever `/metrics` is
+    scraped."""
+    registry = metrics.REGISTRY
+    registry.callback(
+        "moneykit_access_token_fetches_total",
+        "Access tokens fetched from MoneyKit.",
+        "counter",
+        lambda: {(): client().token_manager.metrics.fetches},
+    )
+    registry.callback(
+        "moneykit_access_token_fetch_seconds_total",
+        "Time spent fetching access tokens.",
+        "counter",
+        lambda: {(): client().token_manager.metrics.total_fetch_seconds},
+    )
+    registry.callback(
+        "moneykit_expired_token_retries_total",
+        "Requests retried because MoneyKit rejected the access token as expired.",
+        "counter",
+        lambda: {(): client().token_manager.metrics.expired_token_retries},
+    )
+    registry.callback(
+        "moneykit_rate_limit_throttled_total",
+        "Requests MoneyKit answered with 429 Too Many Requests.",
+        "counter",
+        lambda: {(name,): m.throttled for name, m in client().scheduler.metrics.items()},
+        ["endpoint_class"],
+    )
+    registry.callback(
+        "moneykit_rate_limit_wait_seconds_total",
+        "Time requests spent waiting for the client side rate limiter.",
+        "counter",
+        lambda: {(name,): m.total_wait_seconds for name, m in client().scheduler.metrics.items()},
+        ["endpoint_class"],
+    )
+    registry.callback(
+        "moneykit_rate_limit_queue_depth",
+        "Requests currently waiting for the client side rate limiter.",
+        "gauge",
+        lambda: {(name,): m.queue_depth for name, m in client().scheduler.metrics.items()},
+        ["endpoint_class"],
+    )
+
+
+def register_job_metrics(queue: Callable[[], JobQueue]) -> None:
+    """Export the number of jobs in each status, counted in the job queue's database whenever `/metrics` is scraped."""
+    metrics.REGISTRY.callback(
+        "jobs",
+        "Background jobs in the queue, by status. Shared by every process using the queue.",
+        "gauge",
+        lambda: {(status,): count for status, count in queue().counts().items()},
+        ["status"],
+    )
+
+
+def register_link_cache_metrics(cache: Callable[[], LinkCache]) -> None:
+    metrics.REGISTRY.callback(
+        "link_cache_requests_total",
+        "Link state lookups, by whether the link was cached.",
+        "counter",
+        lambda: {("hit",): cache().metrics.hits, ("miss",): cache().metrics.misses},
+        ["result"],
+    )
+    metrics.REGISTRY.callback(
+        "link_cache_invalidations_total",
+        "Links dropped from the cache because a webhook reported a change.",
+        "counter",
+        lambda: {(): cache().metrics.invalidations},
+    )
+
+
+def register_link_data_metrics(cache: Callable[[], LinkDataCache]) -> None:
+    metrics.REGISTRY.callback(
+        "link_data_requests_total",
+        "Account and transaction lookups, by whether the link was cached, still being fetched or missing.",
+        "counter",
+        lambda: {
+            ("hit",): cache().metrics.hits,
+            ("wait",): cache().metrics.waits,
+            ("miss",): cache().metrics.misses,
+        },
+        ["result"],
+    )
+
 
 def create_app() -> FastAPI:
-    logging.basicConfig(level=get_settings().log_level)
+    settings = get_settings()
+    logging.basicConfig(level=settings.log_level)
+    metrics.configure_tracing(settings.tracing_enabled)
+    register_client_metrics(moneykit_client)
+    register_job_metrics(get_job_queue)
+    register_link_cache_metrics(link_cache)
+    register_link_data_metrics(link_data_cache)
 
-    app = FastAPI(title="Use Webhooks App")
+    app = FastAPI(title="Use Webhooks App", lifespan=lifespan)
     app.include_router(linking_router)
     app.include_router(links_router)
     app.include_router(webhooks_router)
@@ -23,11 +164,38 @@ def create_app() -> FastAPI:
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    # Added last so it's outermost and also times the other middleware.
+    app.add_middleware(metrics.MetricsMiddleware)
 
     @app.get("/health-check", include_in_schema=False)
     async def health_check() -> dict:
         return {"project": "use_webhooks/backend/python"}
 
+    @app.get("/metrics", include_in_schema=False)
+    async def prometheus_metrics() -> Response:
+        return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+    @app.get("/metrics/auth", include_in_schema=False)
+    async def auth_metrics() -> dict:
+        return dataclasses.asdict(moneykit_client().token_manager.metrics)
+
+    @app.get("/metrics/rate-limit", include_in_schema=False)
+    async def rate_limit_metrics() -> dict:
+        return {name: dataclasses.asdict(metrics) for name, metrics in moneykit_client().scheduler.metrics.items()}
+
+    @app.get("/metrics/link-cache", include_in_schema=False)
+    async def link_cache_metrics() -> dict:
+        return dataclasses.asdict(link_cache().metrics)
+
+    @app.get("/metrics/link-data", include_in_schema=False)
+    async def link_data_metrics() -> dict:
+        return dataclasses.asdict(link_data_cache().metrics)
+
+    @app.get("/metrics/jobs", include_in_schema=False)
+    async def job_metrics() -> dict:
+        queue = get_job_queue()
+        return {"status": queue.counts(), **queue.coalescing_counts()}
+
     return app
 
 
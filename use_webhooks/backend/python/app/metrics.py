@@ -0,0 +1,264 @@
+"""Prometheus metrics and optional tracing spans.
+
+Metrics are kept in this process and rendered in the Prometheus text format by `GET /metrics`. Recording a value is a
+dict lookup and a couple of additions under a lock, cheap enough to do for every request and every MoneyKit call.
+
+Spans are only created when `tracing_enabled` is set and `opentelemetry` is installed, e.g. by running the app with
+`opentelemetry-instrument` which also configures where they're exported to. Otherwise `span` does nothing.
+"""
+
+import bisect
+import contextlib
+import threading
+import time
+from typing import Any, Callable, ContextManager, Iterator, Sequence
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = tuple[str, ...]
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> Iterator[str]:
+        yield from _header(self.name, self.documentation, "counter")
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in values.items():
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._buckets = tuple(buckets)
+        # Per label set, the number of observations falling in each bucket (not cumulative, the last one is +Inf) and
+        # their sum.
+        self._counts: dict[Labels, list[int]] = {}
+        self._sums: dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            counts = self._counts.get(labels)
+            if counts is None:
+                counts = self._counts[labels] = [0] * (len(self._buckets) + 1)
+            counts[index] += 1
+            self._sums[labels] = self._sums.get(labels, 0.0) + value
+
+    @contextlib.contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self) -> Iterator[str]:
+        yield from _header(self.name, self.documentation, "histogram")
+        with self._lock:
+            counts = {labels: list(values) for labels, values in self._counts.items()}
+            sums = dict(self._sums)
+        for labels, values in counts.items():
+            cumulative = 0
+            for bound, count in zip([*self._buckets, float("inf")], values):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                yield f"{self.name}_bucket{_labels((*self.labelnames, 'le'), (*labels, le))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(sums[labels])}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}"
+
+
+class Callback:
+    """A metric whose values are read from elsewhere, e.g. an existing metrics dataclass, when `/metrics` is scraped."""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        kind: str,
+        labelnames: Sequence[str],
+        collect: Callable[[], dict[Labels, float]],
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self._collect = collect
+
+    def render(self) -> Iterator[str]:
+        yield from _header(self.name, self.documentation, self.kind)
+        for labels, value in self._collect().items():
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class Registry:
+    def __init__(self) -> None:
+        # By name, registering a metric again replaces it.
+        self._metrics: dict[str, Counter | Histogram | Callback] = {}
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        counter = Counter(name, documentation, labelnames)
+        self._metrics[name] = counter
+        return counter
+
+    def histogram(
+        self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        histogram = Histogram(name, documentation, labelnames, buckets)
+        self._metrics[name] = histogram
+        return histogram
+
+    def callback(
+        self,
+        name: str,
+        documentation: str,
+        kind: str,
+        collect: Callable[[], dict[Labels, float]],
+        labelnames: Sequence[str] = (),
+    ) -> None:
+        self._metrics[name] = Callback(name, documentation, kind, labelnames, collect)
+
+    def render(self) -> str:
+        return "".join(f"{line}\n" for metric in list(self._metrics.values()) for line in metric.render())
+
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "http_request_duration_seconds", "Time spent handling requests, by route.", ["method", "route", "status"]
+)
+MONEYKIT_REQUEST_SECONDS = REGISTRY.histogram(
+    "moneykit_request_duration_seconds",
+    "Time spent on each request to the MoneyKit API, by endpoint. Retries are observed separately.",
+    ["endpoint", "status"],
+)
+LINK_WARM_UP_SECONDS = REGISTRY.histogram(
+    "link_warm_up_duration_seconds",
+    "Time from a token exchange until the new link's accounts and transactions are cached, by outcome.",
+    ["result"],
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+JWKS_CACHE_LOOKUPS = REGISTRY.counter(
+    "jwks_cache_lookups_total",
+    "Webhook signing key lookups, by whether the key was cached, stored by another process or missing.",
+    ["result"],
+)
+JWKS_REFRESHES = REGISTRY.counter(
+    "jwks_refreshes_total", "Fetches of MoneyKit's JWKS, by outcome, or skipped as rate limited.", ["result"]
+)
+WEBHOOK_VERIFY_SECONDS = REGISTRY.histogram(
+    "webhook_verify_duration_seconds",
+    "Time spent checking a webhook's signature and body hash, excluding the key lookup.",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1),
+)
+WEBHOOK_DECODE_SECONDS = REGISTRY.histogram(
+    "webhook_decode_duration_seconds",
+    "Time spent parsing a verified webhook's body into its model, by event.",
+    ["event"],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025),
+)
+
+
+class MetricsMiddleware:
+    """Observes `HTTP_REQUEST_SECONDS` for every request, labelled with the route's path template rather than the
+    actual path so the number of label values stays bounded. The time is up to the last byte of the response."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        finished: float | None = None
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status, finished
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                finished = time.perf_counter()
+
+        started = time.perf_counter()
+        with span(f"HTTP {scope['method']}") as current_span:
+            try:
+                await self.app(scope, receive, send_with_status)
+            finally:
+                # FastAPI adds the matched route to the scope while routing.
+                route = scope.get("route")
+                path = getattr(route, "path", "unmatched")
+                # Background tasks, such as the link warm-up, run after the response within the same call and
+                # aren't counted.
+                elapsed = (finished if finished is not None else time.perf_counter()) - started
+                HTTP_REQUEST_SECONDS.observe(elapsed, scope["method"], path, str(status))
+                if current_span is not None:
+                    current_span.update_name(f"{scope['method']} {path}")
+                    current_span.set_attribute("http.route", path)
+                    current_span.set_attribute("http.response.status_code", status)
+
+
+_tracer: Any = None
+_NO_SPAN = contextlib.nullcontext()
+
+
+def configure_tracing(enabled: bool) -> None:
+    global _tracer
+    _tracer = trace.get_tracer("moneykit.examples") if enabled and trace is not None else None
+
+
+def span(name: str, **attributes: Any) -> ContextManager[Any]:
+    """A span around the `with` block, or nothing when tracing is disabled."""
+    if _tracer is None:
+        return _NO_SPAN
+    return _tracer.start_as_current_span(name, attributes=attributes)
+
+
+def _header(name: str, documentation: str, kind: str) -> Iterator[str]:
+    yield f"# HELP {name} {documentation}"
+    yield f"# TYPE {name} {kind}"
+
+
+def _labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
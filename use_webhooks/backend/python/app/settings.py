@@ -10,6 +10,34 @@ class Settings(pydantic_settings.BaseSettings):
     moneykit_client_id: str
     moneykit_client_secret: pydantic.SecretStr
     frontend_oauth_redirect_uri: str = "http://localhost:3000"
+    # The SDK is synchronous so each in-flight MoneyKit call occupies one of FastAPI's worker threads. Both the thread
+    # pool and the SDK's connection pool are sized with this so every thread can reuse a kept-alive connection.
+    moneykit_max_connections: int = 40
+    # SQLite database holding the background job queue, shared by the backend and `python -m app.worker`.
+    job_queue_path: str = "jobs.sqlite3"
+    job_max_attempts: int = 5
+    job_worker_processes: int = 2
+    # Done and dead jobs are deleted by the workers once they finished this long ago.
+    job_retention_seconds: float = 7 * 24 * 60 * 60
+    # `transactions.updates_available` webhooks for a link received within this window trigger a single sync.
+    transactions_sync_debounce_seconds: float = 10.0
+    # Webhook signing keys are cached for 12 hours, refetch them well before that so webhooks never wait on a fetch.
+    jwks_refresh_seconds: float = 6 * 60 * 60
+    # SQLite database sharing the fetched signing keys and the JWKS refresh rate limit between backend processes, see
+    # `app/jwks_store.py`. Empty keeps both per process.
+    jwks_store_path: str = "jwks.sqlite3"
+    # `GET /links/{link_id}` caches link states, invalidated by webhooks. The TTL only matters if a webhook is missed.
+    link_cache_ttl_seconds: float = 60.0
+    link_cache_max_links: int = 10_000
+    # Fetch a new link's accounts and transactions in the background straight after the token exchange, see
+    # `app/link_data.py`. They're then kept for the TTL, for at most this many links.
+    link_warm_up_enabled: bool = True
+    link_data_ttl_seconds: float = 5 * 60
+    link_data_max_links: int = 1_000
+    # A request for a link that is already being fetched waits this long for it, then fetches the link itself.
+    link_data_wait_seconds: float = 10.0
+    # Create tracing spans for requests and MoneyKit calls, needs `opentelemetry` installed, see `app/metrics.py`.
+    tracing_enabled: bool = False
 
     class Config:
         case_sensitive = False
@@ -0,0 +1,56 @@
+"""Background jobs started by the webhook handler, run by `python -m app.worker`.
+
+Jobs are delivered at least once so each of these must be safe to run again. Most fetch the latest data from MoneyKit
+rather than trusting the webhook payload, which makes that straightforward. `update_link_state` stores the state the
+webhook carries instead, so it must ignore a state older than the one already stored.
+"""
+
+import logging
+
+import moneykit
+
+from app.client import moneykit_client
+from app.jobs import task
+
+logger = logging.getLogger("example.tasks")
+
+
+@task
+def update_link_state(
+    link_id: str,
+    state: str | None = None,
+    error_code: str | None = None,
+    error_message: str | None = None,
+    changed_at: str | None = None,
+) -> None:
+    """Store the state a `link.state_changed` webhook reported, without calling `LinksApi.get_link`."""
+    if state is None:
+        # Enqueued before the webhook's state was passed along, fetch it instead.
+        link = moneykit.LinksApi(moneykit_client()).get_link(link_id)
+        state = link.state.value
+        error_code = link.error_code.value if link.error_code else None
+    logger.info(f"{link_id}: {state=} {error_code=} {error_message=} {changed_at=}")
+    # Next step: store it in your database, unless the stored state changed after `changed_at` (webhooks can arrive
+    # out of order or be delivered again). See `cache_transactions/python/link_state.py`, e.g.
+    # `link_state.apply_link_state_changed`, for an upsert that does this.
+
+
+@task
+def do_thing_with_product(link_id: str, product: str) -> None:
+    logger.info(f"{link_id}: {product} has been refreshed")
+    # Next step: fetch the refreshed product, e.g. `moneykit.AccountsApi(moneykit_client()).get_accounts(link_id)`
+
+
+@task
+def sync_transactions(link_id: str) -> None:
+    transactions_api = moneykit.TransactionsApi(moneykit_client())
+    # Next step: load the cursor you stored for this link, `None` syncs from the start of its history.
+    # See `cache_transactions/python` for how to apply the changes and store the cursor in your database.
+    cursor = None
+    has_more = True
+    while has_more:
+        response = transactions_api.get_transactions_sync(link_id, cursor=cursor)
+        diff = response.transactions
+        logger.info(f"{link_id}: {len(diff.created)} created, {len(diff.updated)} updated, {len(diff.removed)} removed")
+        has_more = response.has_more
+        cursor = response.cursor.next
@@ -0,0 +1,92 @@
+"""Decodes webhook payloads and dispatches them to the handler registered for their event and schema version.
+
+A payload is decoded in two steps. First only `webhook_event` and `webhook_major_version` are read, which is enough to
+pick the schema without building the whole payload. Then the payload is validated with that schema's `TypeAdapter`,
+built once when the handler was registered.
+
+A breaking change to a payload comes with a new `webhook_major_version`. Handle it by registering another handler for
+the new version, events of a version without a handler are reported as unhandled.
+"""
+
+import dataclasses
+import logging
+from typing import Any, Callable, TypeVar
+
+import pydantic
+
+from app import metrics
+
+logger = logging.getLogger("example.webhook_registry")
+
+WebhookT = TypeVar("WebhookT", bound=pydantic.BaseModel)
+
+
+class WebhookEnvelope(pydantic.BaseModel):
+    """The keys every webhook payload has, regardless of its event and version."""
+
+    webhook_event: str
+    # Payloads from before versioning was introduced don't have this.
+    webhook_major_version: int = 1
+    webhook_idempotency_key: str
+
+
+@dataclasses.dataclass(frozen=True)
+class RegisteredWebhook:
+    adapter: pydantic.TypeAdapter
+    handler: Callable[[Any], None]
+
+
+@dataclasses.dataclass(frozen=True)
+class DecodedWebhook:
+    envelope: WebhookEnvelope
+    webhook: pydantic.BaseModel
+    handler: Callable[[Any], None]
+
+    def handle(self) -> None:
+        self.handler(self.webhook)
+
+
+class WebhookRegistry:
+    _envelope_adapter = pydantic.TypeAdapter(WebhookEnvelope)
+
+    def __init__(self) -> None:
+        self._webhooks: dict[tuple[str, int], RegisteredWebhook] = {}
+
+    def handler(
+        self, webhook_event: str, major_version: int, model: type[WebhookT]
+    ) -> Callable[[Callable[[WebhookT], None]], Callable[[WebhookT], None]]:
+        """Register the decorated function to handle `webhook_event` payloads of `major_version`, parsed as `model`."""
+
+        def register(func: Callable[[WebhookT], None]) -> Callable[[WebhookT], None]:
+            key = (webhook_event, major_version)
+            if key in self._webhooks:
+                raise ValueError(f"A handler for {webhook_event} v{major_version} is already registered")
+            self._webhooks[key] = RegisteredWebhook(adapter=pydantic.TypeAdapter(model), handler=func)
+            return func
+
+        return register
+
+    def decode(self, body: bytes) -> DecodedWebhook | None:
+        """Parse `body` with the schema registered for its event and version.
+
+        :returns: `None` if the payload is invalid or no handler is registered for it.
+        """
+        try:
+            envelope = self._envelope_adapter.validate_json(body)
+        except pydantic.ValidationError:
+            logger.info("Webhook is missing its event, version or idempotency key")
+            return None
+
+        registered = self._webhooks.get((envelope.webhook_event, envelope.webhook_major_version))
+        if registered is None:
+            logger.info(f"No handler for {envelope.webhook_event} v{envelope.webhook_major_version}")
+            return None
+
+        try:
+            # Only registered events are observed so the number of label values stays bounded.
+            with metrics.WEBHOOK_DECODE_SECONDS.time(envelope.webhook_event):
+                webhook = registered.adapter.validate_json(body)
+        except pydantic.ValidationError as err:
+            logger.info(f"Invalid {envelope.webhook_event} v{envelope.webhook_major_version} webhook: {err}")
+            return None
+        return DecodedWebhook(envelope=envelope, webhook=webhook, handler=registered.handler)
@@ -0,0 +1,94 @@
+"""Runs the background jobs enqueued by the webhook handler.
+
+    python -m app.worker [--processes N]
+
+Each process claims and runs one job at a time. Stop with Ctrl+C (or SIGTERM), jobs already running are finished first.
+"""
+
+import argparse
+import importlib
+import logging
+import multiprocessing
+import signal
+from multiprocessing.synchronize import Event
+from typing import Sequence
+
+from app.jobs import JobQueue, run_worker
+from app.settings import get_settings
+
+logger = logging.getLogger("example.worker")
+
+TASK_MODULES = ("app.tasks",)
+
+
+def start_workers(
+    processes: int,
+    stop: Event,
+    queue_path: str,
+    max_attempts: int,
+    task_modules: Sequence[str] = TASK_MODULES,
+    log_level: str = "INFO",
+    retention_seconds: float = 7 * 24 * 60 * 60,
+) -> list[multiprocessing.Process]:
+    workers = [
+        multiprocessing.Process(
+            target=_work,
+            args=(stop, queue_path, max_attempts, task_modules, log_level, retention_seconds),
+            name=f"worker-{i}",
+            daemon=True,
+        )
+        for i in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def _work(
+    stop: Event,
+    queue_path: str,
+    max_attempts: int,
+    task_modules: Sequence[str],
+    log_level: str,
+    retention_seconds: float,
+) -> None:
+    logging.basicConfig(level=log_level)
+    # The parent process handles Ctrl+C and tells every worker to stop through `stop`.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for module in task_modules:
+        importlib.import_module(module)
+    queue = JobQueue(queue_path, max_attempts=max_attempts, finished_retention_seconds=retention_seconds)
+    run_worker(queue, stop=stop.is_set)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    settings = get_settings()
+    parser.add_argument("--processes", type=int, default=settings.job_worker_processes)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=settings.log_level)
+    stop = multiprocessing.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+
+    workers = start_workers(
+        args.processes,
+        stop,
+        settings.job_queue_path,
+        settings.job_max_attempts,
+        log_level=settings.log_level,
+        retention_seconds=settings.job_retention_seconds,
+    )
+    logger.info(f"Started {len(workers)} workers")
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        stop.set()
+    logger.info("Waiting for running jobs to finish")
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == "__main__":
+    main()
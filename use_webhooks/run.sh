@@ -6,6 +6,9 @@ echo "📋 Next steps:"
 echo "   1. Visit http://localhost:3000 in your browser, and create a new link.";\
 
 RUN_TARGETS="backend_$BACKEND frontend"
+if [ "$BACKEND" = "python" ]; then
+    RUN_TARGETS="$RUN_TARGETS worker_python"
+fi
 
 docker compose \
     -f docker-compose.yml \